@@ -7,7 +7,8 @@ ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+# tz_aware so BSON dates come back as UTC-aware datetimes
+client = AsyncIOMotorClient(mongo_url, tz_aware=True)
 db = client[os.environ['DB_NAME']]
 
 # Collection references
@@ -22,3 +23,8 @@ reminders_collection = db.reminders
 deliverables_collection = db.deliverables
 exchange_rates_collection = db.exchange_rates
 subscriptions_collection = db.subscriptions
+user_stats_collection = db.user_stats
+counters_collection = db.counters
+job_leases_collection = db.job_leases
+email_outbox_collection = db.email_outbox
+pdf_branding_collection = db.pdf_branding
@@ -1,6 +1,10 @@
-from pydantic import BaseModel, EmailStr, Field
-from typing import Optional, List, Literal
+from pydantic import BaseModel, EmailStr, Field, BeforeValidator
+from typing import Optional, List, Literal, Annotated
 from datetime import datetime
+from utils.dates import to_iso
+
+# Stored as a BSON date, returned as the same ISO-8601 string as before
+IsoTimestamp = Annotated[str, BeforeValidator(to_iso)]
 
 # User Models
 class UserCreate(BaseModel):
@@ -21,11 +25,39 @@ class User(BaseModel):
     subscription_plan: Literal["free", "pro", "agency"] = "free"
     subscription_status: Literal["active", "inactive", "cancelled"] = "active"
     invoice_count: int = 0
-    created_at: str
+    invoice_prefix: Optional[str] = None
+    invoice_number_format: Optional[str] = None
+    locale: Optional[str] = None
+    # IANA timezone and local hours [start, end) for automated reminders
+    timezone: Optional[str] = None
+    reminder_window_start: Optional[int] = None
+    reminder_window_end: Optional[int] = None
+    created_at: IsoTimestamp
 
 class UserUpdate(BaseModel):
     full_name: Optional[str] = None
     base_currency: Optional[str] = None
+    invoice_prefix: Optional[str] = None
+    invoice_number_format: Optional[str] = None
+    locale: Optional[str] = None
+    timezone: Optional[str] = None
+    reminder_window_start: Optional[int] = Field(None, ge=0, le=23)
+    reminder_window_end: Optional[int] = Field(None, ge=1, le=24)
+
+# Invoice PDF branding; unset fields use the default look
+class PdfBrandingUpdate(BaseModel):
+    title: Optional[str] = Field(None, max_length=80)
+    primary_color: Optional[str] = Field(None, pattern=r"^#[0-9A-Fa-f]{6}$")
+    secondary_color: Optional[str] = Field(None, pattern=r"^#[0-9A-Fa-f]{6}$")
+    font: Optional[Literal["Helvetica", "Times-Roman", "Courier"]] = None
+    footer_text: Optional[str] = Field(None, max_length=300)
+
+class PdfBranding(PdfBrandingUpdate):
+    user_id: str
+    version: Optional[str] = None
+    has_logo: bool = False
+    logo_content_type: Optional[str] = None
+    updated_at: Optional[IsoTimestamp] = None
 
 # Client Models
 class ClientCreate(BaseModel):
@@ -45,7 +77,7 @@ class Client(BaseModel):
     avg_payment_days: float = 0.0
     total_paid: float = 0.0
     total_pending: float = 0.0
-    created_at: str
+    created_at: IsoTimestamp
 
 # Project Models
 class ProjectCreate(BaseModel):
@@ -65,7 +97,7 @@ class ProjectLog(BaseModel):
     date: str
     description: str
     hours: float
-    created_at: str
+    created_at: IsoTimestamp
 
 class Project(BaseModel):
     id: str
@@ -79,7 +111,7 @@ class Project(BaseModel):
     remaining_balance: float = 0.0
     deadline: Optional[str] = None
     linked_invoice_id: Optional[str] = None
-    created_at: str
+    created_at: IsoTimestamp
 
 # Invoice Models
 class InvoiceItemCreate(BaseModel):
@@ -128,13 +160,39 @@ class Invoice(BaseModel):
     total_amount: float
     currency: str
     exchange_rate: float
-    due_date: str
+    due_date: IsoTimestamp
     status: Literal["draft", "sent", "viewed", "paid", "overdue"] = "draft"
     auto_reminders: bool
-    created_at: str
+    created_at: IsoTimestamp
+    sent_at: Optional[IsoTimestamp] = None
+    paid_at: Optional[IsoTimestamp] = None
+    next_reminder_at: Optional[IsoTimestamp] = None
+    next_reminder_type: Optional[str] = None
+
+class InvoiceImport(InvoiceCreate):
+    """One invoice in a bulk import; historical invoices keep their own number, status and dates"""
+    invoice_number: Optional[str] = None
+    status: Literal["draft", "sent", "viewed", "paid", "overdue"] = "draft"
+    created_at: Optional[str] = None
     sent_at: Optional[str] = None
     paid_at: Optional[str] = None
 
+# Bulk Import Models
+class ImportRowResult(BaseModel):
+    row: int
+    status: Literal["created", "failed"]
+    id: Optional[str] = None
+    invoice_number: Optional[str] = None
+    errors: List[str] = []
+
+class ImportReport(BaseModel):
+    total: int
+    created: int
+    failed: int
+    results: List[ImportRowResult]
+    # Set when the upload could not be read to the end
+    error: Optional[str] = None
+
 # Payment Models
 class PaymentCreate(BaseModel):
     invoice_id: str
@@ -149,7 +207,7 @@ class Payment(BaseModel):
     amount: float
     currency: str
     status: Literal["pending", "completed", "failed"] = "pending"
-    created_at: str
+    created_at: IsoTimestamp
 
 # Reminder Models
 class ReminderGenerate(BaseModel):
@@ -161,9 +219,10 @@ class Reminder(BaseModel):
     invoice_id: str
     reminder_type: str
     message: str
-    sent_at: Optional[str] = None
+    sent_at: Optional[IsoTimestamp] = None
     channel: str = "email"
-    created_at: str
+    email_status: Optional[Literal["queued", "sent", "failed"]] = None
+    created_at: IsoTimestamp
 
 # Deliverable Models
 class DeliverableCreate(BaseModel):
@@ -180,7 +239,7 @@ class Deliverable(BaseModel):
     file_size: int
     is_locked: bool = True
     preview_path: Optional[str] = None
-    created_at: str
+    created_at: IsoTimestamp
 
 # Analytics Models
 class DashboardStats(BaseModel):
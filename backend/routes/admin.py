@@ -1,6 +1,11 @@
 from fastapi import APIRouter, HTTPException, Depends
 from database import users_collection, subscriptions_collection
 from utils.auth import get_current_user
+from utils.dates import utc_now
+from utils.email_outbox import outbox_worker, outbox_depth
+from utils.reminder_text import reminder_text_engine
+from utils.pdf_pool import pdf_pool
+from utils.pdf_cache import pdf_cache
 from datetime import datetime, timezone
 import uuid
 
@@ -29,7 +34,7 @@ async def upgrade_subscription(plan: str, current_user: dict = Depends(get_curre
         "plan": plan,
         "status": "active",
         "current_period_end": None,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": utc_now()
     }
     
     await subscriptions_collection.insert_one(subscription_doc)
@@ -59,3 +64,25 @@ async def trigger_reminders_manually(current_user: dict = Depends(get_current_us
         return {"message": "Reminder check completed successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to run reminder check: {str(e)}")
+
+@router.get("/email-outbox")
+async def email_outbox_status(current_user: dict = Depends(get_current_user)):
+    """Outbox depth by status and this worker's delivery metrics"""
+    return {
+        "queue": await outbox_depth(),
+        "metrics": outbox_worker.metrics.snapshot()
+    }
+
+@router.get("/reminder-text-cache")
+async def reminder_text_cache_status(current_user: dict = Depends(get_current_user)):
+    """Hit rate and LLM calls of this worker's reminder template cache"""
+    return reminder_text_engine.metrics()
+
+@router.get("/pdf-renders")
+async def pdf_render_status(current_user: dict = Depends(get_current_user)):
+    """PDF pool queue depth and this worker's render and cache metrics"""
+    return {
+        "queue": pdf_pool.depth(),
+        "metrics": pdf_pool.metrics.snapshot(),
+        "cache": pdf_cache.metrics()
+    }
@@ -1,108 +1,70 @@
 from fastapi import APIRouter, HTTPException, Depends
 from models import DashboardStats
-from database import invoices_collection, payments_collection, clients_collection
+from database import invoices_collection, payments_collection, clients_collection, users_collection
 from utils.auth import get_current_user
+from utils.dashboard_stats import revenue_trend_pipeline
+from utils.user_stats import get_dashboard_from_rollup
+from utils.dates import parse_timestamp
 from datetime import datetime, timezone, timedelta
+from typing import Literal, Optional
 
 router = APIRouter()
 
 @router.get("/dashboard", response_model=DashboardStats)
 async def get_dashboard_stats(current_user: dict = Depends(get_current_user)):
-    # Get all invoices for user
-    invoices = await invoices_collection.find({"user_id": current_user["user_id"]}, {"_id": 0}).to_list(10000)
-    
-    total_outstanding = 0.0
-    paid_this_month = 0.0
-    overdue_amount = 0.0
-    late_fee_collected = 0.0
-    payment_days = []
-    
-    total_invoices = len(invoices)
-    paid_invoices = 0
-    pending_invoices = 0
-    overdue_invoices = 0
-    
-    now = datetime.now(timezone.utc)
-    first_day_of_month = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    
-    for invoice in invoices:
-        status = invoice["status"]
-        amount = invoice["total_amount"]
-        
-        if status == "paid":
-            paid_invoices += 1
-            late_fee_collected += invoice.get("late_fee_amount", 0.0)
-            
-            # Check if paid this month
-            if invoice.get("paid_at"):
-                paid_at = datetime.fromisoformat(invoice["paid_at"].replace('Z', '+00:00'))
-                if paid_at >= first_day_of_month:
-                    paid_this_month += amount
-                
-                # Calculate payment days
-                created_at = datetime.fromisoformat(invoice["created_at"].replace('Z', '+00:00'))
-                days_to_pay = (paid_at - created_at).days
-                payment_days.append(days_to_pay)
-        
-        elif status in ["sent", "viewed"]:
-            pending_invoices += 1
-            total_outstanding += amount
-            
-            # Check if overdue
-            due_date = datetime.fromisoformat(invoice["due_date"].replace('Z', '+00:00'))
-            if now > due_date:
-                overdue_invoices += 1
-                overdue_amount += amount
-        
-        elif status == "overdue":
-            overdue_invoices += 1
-            overdue_amount += amount
-            total_outstanding += amount
-    
-    # Calculate average payment time
-    average_payment_time = sum(payment_days) / len(payment_days) if payment_days else 0.0
-    
-    return DashboardStats(
-        total_outstanding=round(total_outstanding, 2),
-        paid_this_month=round(paid_this_month, 2),
-        overdue_amount=round(overdue_amount, 2),
-        average_payment_time=round(average_payment_time, 1),
-        late_fee_collected=round(late_fee_collected, 2),
-        total_invoices=total_invoices,
-        paid_invoices=paid_invoices,
-        pending_invoices=pending_invoices,
-        overdue_invoices=overdue_invoices
-    )
+    # Single read of the incrementally maintained rollup (see utils/user_stats.py)
+    return await get_dashboard_from_rollup(current_user["user_id"])
+
+def _period_label(period: datetime, granularity: str) -> str:
+    if granularity == "quarter":
+        return f"{period.year}-Q{(period.month - 1) // 3 + 1}"
+    if granularity == "month":
+        return period.strftime("%Y-%m")
+    return period.strftime("%Y-%m-%d")
+
+def _parse_range_bound(value: Optional[str], name: str) -> Optional[datetime]:
+    if value is None:
+        return None
+    try:
+        return parse_timestamp(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid {name} date")
 
 @router.get("/revenue-trend")
-async def get_revenue_trend(current_user: dict = Depends(get_current_user)):
-    # Get paid invoices from last 6 months
-    six_months_ago = datetime.now(timezone.utc) - timedelta(days=180)
+async def get_revenue_trend(
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    granularity: Literal["day", "week", "month", "quarter"] = "month",
+    normalize_currency: bool = False,
+    current_user: dict = Depends(get_current_user)
+):
+    # Defaults to the last 6 months, bucketed by month
+    end_date = _parse_range_bound(end, "end") or datetime.now(timezone.utc)
+    start_date = _parse_range_bound(start, "start") or end_date - timedelta(days=180)
+    if start_date >= end_date:
+        raise HTTPException(status_code=400, detail="start must be before end")
     
-    invoices = await invoices_collection.find({
-        "user_id": current_user["user_id"],
-        "status": "paid",
-        "paid_at": {"$exists": True}
-    }, {"_id": 0}).to_list(10000)
+    base_currency = None
+    if normalize_currency:
+        user = await users_collection.find_one({"id": current_user["user_id"]}, {"_id": 0, "base_currency": 1})
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
+        base_currency = user.get("base_currency", "USD")
     
-    # Group by month
-    monthly_revenue = {}
-    
-    for invoice in invoices:
-        paid_at = datetime.fromisoformat(invoice["paid_at"].replace('Z', '+00:00'))
-        if paid_at >= six_months_ago:
-            month_key = paid_at.strftime("%Y-%m")
-            if month_key not in monthly_revenue:
-                monthly_revenue[month_key] = 0.0
-            monthly_revenue[month_key] += invoice["total_amount"]
+    pipeline = revenue_trend_pipeline(current_user["user_id"], start_date, end_date, granularity, base_currency)
     
     # Format for chart
     trend_data = []
-    for month, revenue in sorted(monthly_revenue.items()):
-        trend_data.append({
-            "month": month,
-            "revenue": round(revenue, 2)
-        })
+    async for bucket in invoices_collection.aggregate(pipeline):
+        label = _period_label(bucket["_id"]["period"], granularity)
+        row = {
+            "period": label,
+            "currency": bucket["_id"]["currency"],
+            "revenue": round(bucket["revenue"], 2)
+        }
+        if granularity == "month":
+            row["month"] = label
+        trend_data.append(row)
     
     return trend_data
 
@@ -2,6 +2,8 @@ from fastapi import APIRouter, HTTPException, Depends
 from models import UserCreate, UserLogin, User
 from database import users_collection
 from utils.auth import hash_password, verify_password, create_token, get_current_user
+from utils.user_stats import create_user_stats
+from utils.dates import utc_now
 import uuid
 from datetime import datetime, timezone
 
@@ -25,10 +27,11 @@ async def register(user_data: UserCreate):
         "subscription_plan": "free",
         "subscription_status": "active",
         "invoice_count": 0,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": utc_now()
     }
     
     await users_collection.insert_one(user_doc)
+    await create_user_stats(user_id)
     
     # Create token
     token = create_token(user_id, user_data.email)
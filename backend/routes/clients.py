@@ -1,13 +1,20 @@
-from fastapi import APIRouter, HTTPException, Depends
-from models import ClientCreate, Client
+from fastapi import APIRouter, HTTPException, Depends, Query, Response, Body, UploadFile, File
+from models import ClientCreate, Client, ImportReport
 from database import clients_collection
 from utils.auth import get_current_user
+from utils.pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, paginate, set_next_cursor, stream_ndjson
+from utils.projection import build_projection, serialize_fields
+from utils.dates import utc_now
+from utils.bulk_import import import_clients, json_chunks, csv_client_chunks
 import uuid
 from datetime import datetime, timezone
-from typing import List
+from typing import List, Optional
 
 router = APIRouter()
 
+# What client pickers display; ?fields=all returns everything
+CLIENT_LIST_FIELDS = ["name", "email", "company", "payment_score"]
+
 @router.post("/", response_model=Client)
 async def create_client(client_data: ClientCreate, current_user: dict = Depends(get_current_user)):
     client_id = str(uuid.uuid4())
@@ -22,23 +29,49 @@ async def create_client(client_data: ClientCreate, current_user: dict = Depends(
         "avg_payment_days": 0.0,
         "total_paid": 0.0,
         "total_pending": 0.0,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": utc_now()
     }
     
     await clients_collection.insert_one(client_doc)
     return Client(**client_doc)
 
-@router.get("/", response_model=List[Client])
-async def get_clients(current_user: dict = Depends(get_current_user)):
-    clients = await clients_collection.find({"user_id": current_user["user_id"]}, {"_id": 0}).to_list(1000)
-    return [Client(**client) for client in clients]
+@router.post("/import", response_model=ImportReport)
+async def import_clients_json(rows: List[dict] = Body(...), current_user: dict = Depends(get_current_user)):
+    """Create many clients from a JSON array; failures are reported per row"""
+    return await import_clients(current_user["user_id"], json_chunks(rows))
+
+@router.post("/import/csv", response_model=ImportReport)
+async def import_clients_csv(file: UploadFile = File(...), current_user: dict = Depends(get_current_user)):
+    """Create many clients from a CSV upload (name,email,phone,company)"""
+    return await import_clients(current_user["user_id"], csv_client_chunks(file))
+
+@router.get("/")
+async def get_clients(
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    projection = build_projection(fields, Client, CLIENT_LIST_FIELDS)
+    clients, next_cursor = await paginate(clients_collection, {"user_id": current_user["user_id"]}, limit, cursor, projection)
+    set_next_cursor(response, next_cursor)
+    if projection is None:
+        return [Client(**client) for client in clients]
+    return [serialize_fields(client) for client in clients]
 
-@router.get("/{client_id}", response_model=Client)
-async def get_client(client_id: str, current_user: dict = Depends(get_current_user)):
-    client = await clients_collection.find_one({"id": client_id, "user_id": current_user["user_id"]}, {"_id": 0})
+@router.get("/export")
+async def export_clients(current_user: dict = Depends(get_current_user)):
+    """Stream all clients as NDJSON"""
+    return stream_ndjson(clients_collection, {"user_id": current_user["user_id"]}, Client, filename="clients.ndjson")
+
+@router.get("/{client_id}")
+async def get_client(client_id: str, fields: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+    projection = build_projection(fields, Client)
+    client = await clients_collection.find_one({"id": client_id, "user_id": current_user["user_id"]}, projection or {"_id": 0})
     if not client:
         raise HTTPException(status_code=404, detail="Client not found")
-    return Client(**client)
+    return Client(**client) if projection is None else serialize_fields(client)
 
 @router.put("/{client_id}", response_model=Client)
 async def update_client(client_id: str, client_data: ClientCreate, current_user: dict = Depends(get_current_user)):
@@ -1,12 +1,15 @@
-from fastapi import APIRouter, HTTPException, Depends, UploadFile, File
+from fastapi import APIRouter, HTTPException, Depends, UploadFile, File, Query, Response
 from fastapi.responses import FileResponse
 from models import Deliverable
 from database import deliverables_collection, invoices_collection
 from utils.auth import get_current_user
+from utils.pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, paginate, set_next_cursor
+from utils.dates import utc_now
 import uuid
 import os
 from datetime import datetime, timezone
 from pathlib import Path
+from typing import Optional
 import shutil
 
 router = APIRouter()
@@ -62,7 +65,7 @@ async def upload_deliverable(
         "file_size": file_size,
         "is_locked": True,
         "preview_path": None,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": utc_now()
     }
     
     await deliverables_collection.insert_one(deliverable_doc)
@@ -70,13 +73,20 @@ async def upload_deliverable(
     return Deliverable(**deliverable_doc)
 
 @router.get("/invoice/{invoice_id}")
-async def get_invoice_deliverables(invoice_id: str, current_user: dict = Depends(get_current_user)):
+async def get_invoice_deliverables(
+    invoice_id: str,
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
     # Verify invoice
     invoice = await invoices_collection.find_one({"id": invoice_id, "user_id": current_user["user_id"]}, {"_id": 0})
     if not invoice:
         raise HTTPException(status_code=404, detail="Invoice not found")
     
-    deliverables = await deliverables_collection.find({"invoice_id": invoice_id}, {"_id": 0}).to_list(1000)
+    deliverables, next_cursor = await paginate(deliverables_collection, {"invoice_id": invoice_id}, limit, cursor)
+    set_next_cursor(response, next_cursor)
     return [Deliverable(**d) for d in deliverables]
 
 @router.get("/download/{deliverable_id}")
@@ -1,122 +1,151 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Query, Response, Body, UploadFile, File, Header
 from fastapi.responses import StreamingResponse
-from models import InvoiceCreate, Invoice, InvoiceItem
+from models import InvoiceCreate, Invoice, InvoiceItem, ImportReport
 from database import invoices_collection, invoice_items_collection, clients_collection, projects_collection, users_collection, deliverables_collection
 from utils.auth import get_current_user
-from utils.invoice_helpers import calculate_invoice_totals, generate_invoice_number
-from utils.pdf_generator import generate_invoice_pdf
+from utils.invoice_helpers import (
+    SUBSCRIPTION_LIMITS, EMBED_INVOICE_ITEMS, build_invoice_doc, generate_invoice_number,
+    reserve_invoice_quota, release_invoice_quota, build_invoice_items, fetch_invoice_items,
+    invoice_items_digest
+)
+from utils.pdf_pool import pdf_pool
+from utils.pdf_cache import pdf_cache, pdf_cache_key, etag_matches
+from utils.pdf_branding import fetch_branding
+from utils.pdf_export import export_invoice_pdfs
+from utils.user_stats import record_invoice_change, apply_invoice_update, rollup_generation
+from utils.reminder_schedule import refresh_reminder_schedule
+from utils.pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, paginate, set_next_cursor, stream_ndjson
+from utils.projection import build_projection, serialize_fields
+from utils.dates import utc_now, parse_timestamp, timestamp_range
+from utils.bulk_import import import_invoices, json_chunks, csv_invoice_chunks
 import uuid
-from datetime import datetime, timezone
-from typing import List
+from datetime import date, datetime, time, timedelta, timezone
+from typing import List, Literal, Optional
 
 router = APIRouter()
 
-SUBSCRIPTION_LIMITS = {
-    "free": 3,
-    "pro": float("inf"),
-    "agency": float("inf")
-}
+# What the invoice list and dashboard display; ?fields=all returns everything
+INVOICE_LIST_FIELDS = ["invoice_number", "client_id", "total_amount", "currency", "status", "due_date"]
+# Full invoice minus embedded line items (served by /{invoice_id}/items)
+INVOICE_PROJECTION = {"_id": 0, "items": 0}
 
 @router.post("/", response_model=Invoice)
 async def create_invoice(invoice_data: InvoiceCreate, current_user: dict = Depends(get_current_user)):
-    # Check subscription limits
-    user = await users_collection.find_one({"id": current_user["user_id"]}, {"_id": 0})
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+    # Round trips are constant in the number of items: client check, quota
+    # reservation, invoice insert, one insert_many for items, rollup update
+    try:
+        due_date = parse_timestamp(invoice_data.due_date)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid due date")
     
-    invoice_count = user.get("invoice_count", 0)
-    limit = SUBSCRIPTION_LIMITS.get(user["subscription_plan"], 3)
+    # Verify client exists
+    client = await clients_collection.find_one({"id": invoice_data.client_id, "user_id": current_user["user_id"]}, {"_id": 0, "id": 1})
+    if not client:
+        raise HTTPException(status_code=404, detail="Client not found")
     
-    if invoice_count >= limit:
+    # Check subscription limit and count the invoice in one atomic update
+    user = await reserve_invoice_quota(current_user["user_id"])
+    if not user:
+        user = await users_collection.find_one({"id": current_user["user_id"]}, {"_id": 0, "subscription_plan": 1})
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
         raise HTTPException(
             status_code=403, 
             detail=f"Invoice limit reached for {user['subscription_plan']} plan. Upgrade to Pro for unlimited invoices."
         )
     
-    # Verify client exists
-    client = await clients_collection.find_one({"id": invoice_data.client_id, "user_id": current_user["user_id"]}, {"_id": 0})
-    if not client:
-        raise HTTPException(status_code=404, detail="Client not found")
+    # Until the items are written, any failure removes what was written and
+    # gives the reserved quota back
+    invoice_doc = None
+    try:
+        invoice_number = await generate_invoice_number(user)
+        invoice_doc = build_invoice_doc(current_user["user_id"], invoice_data, invoice_number, due_date)
+        
+        item_docs = build_invoice_items(invoice_doc["id"], invoice_data.items)
+        if EMBED_INVOICE_ITEMS:
+            invoice_doc["items"] = item_docs
+        
+        generation = await rollup_generation(current_user["user_id"])
+        await invoices_collection.insert_one(invoice_doc)
+        
+        # Create invoice items
+        if item_docs and not EMBED_INVOICE_ITEMS:
+            await invoice_items_collection.insert_many(item_docs, ordered=False)
+    except Exception:
+        if invoice_doc:
+            await invoice_items_collection.delete_many({"invoice_id": invoice_doc["id"]})
+            await invoices_collection.delete_one({"id": invoice_doc["id"]})
+        await release_invoice_quota(current_user["user_id"])
+        raise
+    
+    await record_invoice_change(None, invoice_doc, generation)
     
-    # Calculate totals
-    totals = calculate_invoice_totals(
-        invoice_data.items,
-        invoice_data.tax_percentage,
-        invoice_data.discount_type,
-        invoice_data.discount_value,
-        invoice_data.late_fee_enabled,
-        invoice_data.late_fee_percentage,
-        invoice_data.due_date
+    return Invoice(**invoice_doc)
+
+@router.post("/import", response_model=ImportReport)
+async def import_invoices_json(rows: List[dict] = Body(...), current_user: dict = Depends(get_current_user)):
+    """Create many invoices from a JSON array of InvoiceImport rows; failures are reported per row"""
+    return await import_invoices(current_user["user_id"], json_chunks(rows))
+
+@router.post("/import/csv", response_model=ImportReport)
+async def import_invoices_csv(file: UploadFile = File(...), current_user: dict = Depends(get_current_user)):
+    """Create many invoices from a CSV upload, one line item per row"""
+    return await import_invoices(current_user["user_id"], csv_invoice_chunks(file))
+
+@router.get("/")
+async def get_invoices(
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    projection = build_projection(fields, Invoice, INVOICE_LIST_FIELDS)
+    invoices, next_cursor = await paginate(invoices_collection, {"user_id": current_user["user_id"]}, limit, cursor, projection or INVOICE_PROJECTION)
+    set_next_cursor(response, next_cursor)
+    if projection is None:
+        return [Invoice(**invoice) for invoice in invoices]
+    return [serialize_fields(invoice) for invoice in invoices]
+
+@router.get("/export")
+async def export_invoices(current_user: dict = Depends(get_current_user)):
+    """Stream all invoices as NDJSON"""
+    return stream_ndjson(invoices_collection, {"user_id": current_user["user_id"]}, Invoice, INVOICE_PROJECTION, filename="invoices.ndjson")
+
+@router.get("/export/pdf")
+async def export_invoice_pdfs_zip(
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    status: Optional[List[Literal["draft", "sent", "viewed", "paid", "overdue"]]] = Query(None),
+    current_user: dict = Depends(get_current_user)
+):
+    """Stream the PDFs of invoices created between start_date and end_date
+    (inclusive) and/or in the given statuses as a ZIP archive"""
+    if start_date and end_date and start_date > end_date:
+        raise HTTPException(status_code=400, detail="start_date must not be after end_date")
+    
+    # Legacy string created_at values still match until the migration finishes
+    query = timestamp_range(
+        "created_at",
+        start=datetime.combine(start_date, time.min, tzinfo=timezone.utc) if start_date else None,
+        end=datetime.combine(end_date + timedelta(days=1), time.min, tzinfo=timezone.utc) if end_date else None,
     )
+    if status:
+        query["status"] = {"$in": status}
     
-    # Get exchange rate (default to 1 for same currency)
-    exchange_rate = 1.0
-    
-    invoice_id = str(uuid.uuid4())
-    invoice_number = generate_invoice_number()
-    
-    invoice_doc = {
-        "id": invoice_id,
-        "user_id": current_user["user_id"],
-        "client_id": invoice_data.client_id,
-        "project_id": invoice_data.project_id,
-        "invoice_number": invoice_number,
-        "subtotal": totals["subtotal"],
-        "tax_amount": totals["tax_amount"],
-        "tax_percentage": invoice_data.tax_percentage,
-        "discount_amount": totals["discount_amount"],
-        "discount_type": invoice_data.discount_type,
-        "discount_value": invoice_data.discount_value,
-        "late_fee_amount": totals["late_fee_amount"],
-        "late_fee_enabled": invoice_data.late_fee_enabled,
-        "late_fee_percentage": invoice_data.late_fee_percentage,
-        "late_fee_days": invoice_data.late_fee_days,
-        "total_amount": totals["total_amount"],
-        "currency": invoice_data.currency,
-        "exchange_rate": exchange_rate,
-        "due_date": invoice_data.due_date,
-        "status": "draft",
-        "auto_reminders": invoice_data.auto_reminders,
-        "created_at": datetime.now(timezone.utc).isoformat(),
-        "sent_at": None,
-        "paid_at": None
-    }
-    
-    await invoices_collection.insert_one(invoice_doc)
-    
-    # Create invoice items
-    for item_data in invoice_data.items:
-        item_id = str(uuid.uuid4())
-        item_amount = item_data.quantity * item_data.rate
-        item_doc = {
-            "id": item_id,
-            "invoice_id": invoice_id,
-            "description": item_data.description,
-            "quantity": item_data.quantity,
-            "rate": item_data.rate,
-            "amount": round(item_amount, 2)
-        }
-        await invoice_items_collection.insert_one(item_doc)
-    
-    # Update invoice count
-    await users_collection.update_one(
-        {"id": current_user["user_id"]},
-        {"$inc": {"invoice_count": 1}}
+    return StreamingResponse(
+        export_invoice_pdfs(current_user["user_id"], query),
+        media_type="application/zip",
+        headers={"Content-Disposition": "attachment; filename=invoices.zip"}
     )
-    
-    return Invoice(**invoice_doc)
 
-@router.get("/", response_model=List[Invoice])
-async def get_invoices(current_user: dict = Depends(get_current_user)):
-    invoices = await invoices_collection.find({"user_id": current_user["user_id"]}, {"_id": 0}).to_list(1000)
-    return [Invoice(**invoice) for invoice in invoices]
-
-@router.get("/{invoice_id}", response_model=Invoice)
-async def get_invoice(invoice_id: str, current_user: dict = Depends(get_current_user)):
-    invoice = await invoices_collection.find_one({"id": invoice_id, "user_id": current_user["user_id"]}, {"_id": 0})
+@router.get("/{invoice_id}")
+async def get_invoice(invoice_id: str, fields: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+    projection = build_projection(fields, Invoice)
+    invoice = await invoices_collection.find_one({"id": invoice_id, "user_id": current_user["user_id"]}, projection or INVOICE_PROJECTION)
     if not invoice:
         raise HTTPException(status_code=404, detail="Invoice not found")
-    return Invoice(**invoice)
+    return Invoice(**invoice) if projection is None else serialize_fields(invoice)
 
 @router.get("/{invoice_id}/items", response_model=List[InvoiceItem])
 async def get_invoice_items(invoice_id: str, current_user: dict = Depends(get_current_user)):
@@ -125,22 +154,22 @@ async def get_invoice_items(invoice_id: str, current_user: dict = Depends(get_cu
     if not invoice:
         raise HTTPException(status_code=404, detail="Invoice not found")
     
-    items = await invoice_items_collection.find({"invoice_id": invoice_id}, {"_id": 0}).to_list(1000)
+    items = await fetch_invoice_items(invoice)
     return [InvoiceItem(**item) for item in items]
 
 @router.put("/{invoice_id}/send")
 async def send_invoice(invoice_id: str, current_user: dict = Depends(get_current_user)):
-    invoice = await invoices_collection.find_one({"id": invoice_id, "user_id": current_user["user_id"]}, {"_id": 0})
+    invoice = await apply_invoice_update(
+        {"id": invoice_id, "user_id": current_user["user_id"]},
+        {
+            "status": "sent",
+            "sent_at": utc_now()
+        }
+    )
     if not invoice:
         raise HTTPException(status_code=404, detail="Invoice not found")
     
-    await invoices_collection.update_one(
-        {"id": invoice_id},
-        {"$set": {
-            "status": "sent",
-            "sent_at": datetime.now(timezone.utc).isoformat()
-        }}
-    )
+    await refresh_reminder_schedule(invoice)
     
     return {"message": "Invoice sent successfully"}
 
@@ -167,7 +196,7 @@ async def get_public_invoice(invoice_id: str):
         raise HTTPException(status_code=404, detail="Invoice not found")
     
     # Get invoice items
-    items = await invoice_items_collection.find({"invoice_id": invoice_id}, {"_id": 0}).to_list(1000)
+    items = await fetch_invoice_items(invoice)
     
     # Get deliverables
     deliverables = await deliverables_collection.find({"invoice_id": invoice_id}, {"_id": 0}).to_list(1000)
@@ -190,71 +219,56 @@ async def get_public_invoice(invoice_id: str):
     }
 
 
-@router.get("/{invoice_id}/pdf")
-async def download_invoice_pdf(invoice_id: str, current_user: dict = Depends(get_current_user)):
-    """Generate and download invoice as PDF"""
-    # Get invoice
-    invoice = await invoices_collection.find_one({"id": invoice_id, "user_id": current_user["user_id"]}, {"_id": 0})
-    if not invoice:
-        raise HTTPException(status_code=404, detail="Invoice not found")
-    
-    # Get invoice items
-    items = await invoice_items_collection.find({"invoice_id": invoice_id}, {"_id": 0}).to_list(1000)
-    
+async def _invoice_pdf_response(invoice: dict, if_none_match: Optional[str]) -> Response:
+    """Serve an invoice PDF from the cache or the PDF pool, or 304 if the
+    client's copy is current"""
     # Get client
     client = await clients_collection.find_one({"id": invoice["client_id"]}, {"_id": 0})
     
     # Get user info
-    user = await users_collection.find_one({"id": current_user["user_id"]}, {"_id": 0, "password_hash": 0})
+    user = await users_collection.find_one({"id": invoice["user_id"]}, {"_id": 0, "password_hash": 0})
     
     company_data = {
         "name": user.get("full_name", ""),
         "email": user.get("email", "")
     }
+    branding = await fetch_branding(invoice["user_id"])
+    
+    # The hash of the PDF's inputs is both the cache key and the ETag
+    key = pdf_cache_key(invoice, await invoice_items_digest(invoice), client, company_data, branding)
+    etag = f'"{key}"'
+    # Revalidate on every use: the invoice can change after it is downloaded
+    cache_headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=cache_headers)
     
-    # Generate PDF
-    pdf_buffer = generate_invoice_pdf(invoice, items, client, company_data)
+    # Generate PDF off the event loop, unless cached
+    pdf = await pdf_cache.get_or_render(key, lambda: pdf_pool.render(invoice, client, company_data, branding))
     
     # Return as downloadable file
     filename = f"invoice_{invoice['invoice_number']}.pdf"
+    return Response(
+        content=pdf,
+        media_type="application/pdf",
+        headers={"Content-Disposition": f"attachment; filename={filename}", **cache_headers}
+    )
 
+@router.get("/{invoice_id}/pdf")
+async def download_invoice_pdf(invoice_id: str, if_none_match: Optional[str] = Header(None),
+                               current_user: dict = Depends(get_current_user)):
+    """Generate and download invoice as PDF"""
+    invoice = await invoices_collection.find_one({"id": invoice_id, "user_id": current_user["user_id"]}, {"_id": 0})
+    if not invoice:
+        raise HTTPException(status_code=404, detail="Invoice not found")
+    
+    return await _invoice_pdf_response(invoice, if_none_match)
 
 @router.get("/public/{invoice_id}/pdf")
-async def download_public_invoice_pdf(invoice_id: str):
+async def download_public_invoice_pdf(invoice_id: str, if_none_match: Optional[str] = Header(None)):
     """Public PDF download for client portal (no auth required)"""
-    # Get invoice
     invoice = await invoices_collection.find_one({"id": invoice_id}, {"_id": 0})
     if not invoice:
         raise HTTPException(status_code=404, detail="Invoice not found")
     
-    # Get invoice items
-    items = await invoice_items_collection.find({"invoice_id": invoice_id}, {"_id": 0}).to_list(1000)
-    
-    # Get client
-    client = await clients_collection.find_one({"id": invoice["client_id"]}, {"_id": 0})
-    
-    # Get user info
-    user = await users_collection.find_one({"id": invoice["user_id"]}, {"_id": 0, "password_hash": 0})
-    
-    company_data = {
-        "name": user.get("full_name", ""),
-        "email": user.get("email", "")
-    }
-    
-    # Generate PDF
-    pdf_buffer = generate_invoice_pdf(invoice, items, client, company_data)
-    
-    # Return as downloadable file
-    filename = f"invoice_{invoice['invoice_number']}.pdf"
-    return StreamingResponse(
-        pdf_buffer,
-        media_type="application/pdf",
-        headers={"Content-Disposition": f"attachment; filename={filename}"}
-    )
-
-    return StreamingResponse(
-        pdf_buffer,
-        media_type="application/pdf",
-        headers={"Content-Disposition": f"attachment; filename={filename}"}
-    )
+    return await _invoice_pdf_response(invoice, if_none_match)
 
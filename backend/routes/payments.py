@@ -2,6 +2,9 @@ from fastapi import APIRouter, HTTPException, Depends, Request
 from models import Payment
 from database import payments_collection, invoices_collection, deliverables_collection, clients_collection
 from utils.auth import get_current_user
+from utils.user_stats import apply_invoice_update
+from utils.reminder_schedule import CLEAR_REMINDER_SCHEDULE
+from utils.dates import utc_now
 from emergentintegrations.payments.stripe.checkout import StripeCheckout, CheckoutSessionRequest, CheckoutSessionResponse, CheckoutStatusResponse
 import uuid
 from datetime import datetime, timezone
@@ -56,7 +59,7 @@ async def create_checkout_session(request: Request, invoice_id: str, origin_url:
         "amount": invoice["total_amount"],
         "currency": invoice["currency"],
         "status": "pending",
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": utc_now()
     }
     
     await payments_collection.insert_one(payment_doc)
@@ -92,12 +95,13 @@ async def get_checkout_status(session_id: str):
             )
             
             # Update invoice
-            await invoices_collection.update_one(
+            invoice = await apply_invoice_update(
                 {"id": payment["invoice_id"]},
-                {"$set": {
+                {
                     "status": "paid",
-                    "paid_at": datetime.now(timezone.utc).isoformat()
-                }}
+                    "paid_at": utc_now(),
+                    **CLEAR_REMINDER_SCHEDULE
+                }
             )
             
             # Unlock deliverables
@@ -107,7 +111,6 @@ async def get_checkout_status(session_id: str):
             )
             
             # Update client payment stats
-            invoice = await invoices_collection.find_one({"id": payment["invoice_id"]}, {"_id": 0})
             if invoice:
                 await clients_collection.update_one(
                     {"id": invoice["client_id"]},
@@ -147,12 +150,13 @@ async def stripe_webhook(request: Request):
                 )
                 
                 # Update invoice
-                await invoices_collection.update_one(
+                await apply_invoice_update(
                     {"id": payment["invoice_id"]},
-                    {"$set": {
+                    {
                         "status": "paid",
-                        "paid_at": datetime.now(timezone.utc).isoformat()
-                    }}
+                        "paid_at": utc_now(),
+                        **CLEAR_REMINDER_SCHEDULE
+                    }
                 )
                 
                 # Unlock deliverables
@@ -1,13 +1,19 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Query, Response
 from models import ProjectCreate, Project, ProjectLogCreate, ProjectLog
 from database import projects_collection, project_logs_collection, clients_collection
 from utils.auth import get_current_user
+from utils.pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, paginate, set_next_cursor, stream_ndjson
+from utils.projection import build_projection, serialize_fields
+from utils.dates import utc_now
 import uuid
 from datetime import datetime, timezone
-from typing import List
+from typing import List, Optional
 
 router = APIRouter()
 
+# What the projects page displays; ?fields=all returns everything
+PROJECT_LIST_FIELDS = ["client_id", "name", "total_value", "currency", "completion_percentage", "deadline"]
+
 @router.post("/", response_model=Project)
 async def create_project(project_data: ProjectCreate, current_user: dict = Depends(get_current_user)):
     # Verify client exists
@@ -28,23 +34,39 @@ async def create_project(project_data: ProjectCreate, current_user: dict = Depen
         "remaining_balance": project_data.total_value,
         "deadline": project_data.deadline,
         "linked_invoice_id": None,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": utc_now()
     }
     
     await projects_collection.insert_one(project_doc)
     return Project(**project_doc)
 
-@router.get("/", response_model=List[Project])
-async def get_projects(current_user: dict = Depends(get_current_user)):
-    projects = await projects_collection.find({"user_id": current_user["user_id"]}, {"_id": 0}).to_list(1000)
-    return [Project(**project) for project in projects]
+@router.get("/")
+async def get_projects(
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    projection = build_projection(fields, Project, PROJECT_LIST_FIELDS)
+    projects, next_cursor = await paginate(projects_collection, {"user_id": current_user["user_id"]}, limit, cursor, projection)
+    set_next_cursor(response, next_cursor)
+    if projection is None:
+        return [Project(**project) for project in projects]
+    return [serialize_fields(project) for project in projects]
 
-@router.get("/{project_id}", response_model=Project)
-async def get_project(project_id: str, current_user: dict = Depends(get_current_user)):
-    project = await projects_collection.find_one({"id": project_id, "user_id": current_user["user_id"]}, {"_id": 0})
+@router.get("/export")
+async def export_projects(current_user: dict = Depends(get_current_user)):
+    """Stream all projects as NDJSON"""
+    return stream_ndjson(projects_collection, {"user_id": current_user["user_id"]}, Project, filename="projects.ndjson")
+
+@router.get("/{project_id}")
+async def get_project(project_id: str, fields: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+    projection = build_projection(fields, Project)
+    project = await projects_collection.find_one({"id": project_id, "user_id": current_user["user_id"]}, projection or {"_id": 0})
     if not project:
         raise HTTPException(status_code=404, detail="Project not found")
-    return Project(**project)
+    return Project(**project) if projection is None else serialize_fields(project)
 
 @router.post("/{project_id}/logs", response_model=ProjectLog)
 async def add_project_log(project_id: str, log_data: ProjectLogCreate, current_user: dict = Depends(get_current_user)):
@@ -60,20 +82,27 @@ async def add_project_log(project_id: str, log_data: ProjectLogCreate, current_u
         "date": datetime.now(timezone.utc).strftime("%Y-%m-%d"),
         "description": log_data.description,
         "hours": log_data.hours,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": utc_now()
     }
     
     await project_logs_collection.insert_one(log_doc)
     return ProjectLog(**log_doc)
 
 @router.get("/{project_id}/logs", response_model=List[ProjectLog])
-async def get_project_logs(project_id: str, current_user: dict = Depends(get_current_user)):
+async def get_project_logs(
+    project_id: str,
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
     # Verify project exists
     project = await projects_collection.find_one({"id": project_id, "user_id": current_user["user_id"]}, {"_id": 0})
     if not project:
         raise HTTPException(status_code=404, detail="Project not found")
     
-    logs = await project_logs_collection.find({"project_id": project_id}, {"_id": 0}).to_list(1000)
+    logs, next_cursor = await paginate(project_logs_collection, {"project_id": project_id}, limit, cursor)
+    set_next_cursor(response, next_cursor)
     return [ProjectLog(**log) for log in logs]
 
 @router.put("/{project_id}/completion")
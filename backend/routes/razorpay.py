@@ -1,6 +1,9 @@
 from fastapi import APIRouter, HTTPException, Request, Depends
 from database import invoices_collection, payments_collection, deliverables_collection, clients_collection, users_collection, subscriptions_collection
 from utils.auth import get_current_user
+from utils.user_stats import apply_invoice_update
+from utils.reminder_schedule import CLEAR_REMINDER_SCHEDULE
+from utils.dates import utc_now
 import razorpay
 import os
 import hmac
@@ -62,7 +65,7 @@ async def create_razorpay_order(invoice_id: str, current_user: dict = Depends(ge
             "currency": invoice["currency"],
             "status": "pending",
             "payment_method": "razorpay",
-            "created_at": datetime.now(timezone.utc).isoformat()
+            "created_at": utc_now()
         }
         
         await payments_collection.insert_one(payment_doc)
@@ -165,17 +168,18 @@ async def verify_payment(
             {"$set": {
                 "razorpay_payment_id": razorpay_payment_id,
                 "status": "completed",
-                "verified_at": datetime.now(timezone.utc).isoformat()
+                "verified_at": utc_now()
             }}
         )
         
         # Update invoice status
-        await invoices_collection.update_one(
+        invoice = await apply_invoice_update(
             {"id": payment["invoice_id"]},
-            {"$set": {
+            {
                 "status": "paid",
-                "paid_at": datetime.now(timezone.utc).isoformat()
-            }}
+                "paid_at": utc_now(),
+                **CLEAR_REMINDER_SCHEDULE
+            }
         )
         
         # Unlock deliverables (Pay-to-Unlock feature)
@@ -185,7 +189,6 @@ async def verify_payment(
         )
         
         # Update client payment stats
-        invoice = await invoices_collection.find_one({"id": payment["invoice_id"]}, {"_id": 0})
         if invoice:
             await clients_collection.update_one(
                 {"id": invoice["client_id"]},
@@ -225,7 +228,7 @@ async def verify_subscription_payment(
             raise HTTPException(status_code=400, detail="Invalid signature")
         
         # Calculate subscription end date (30 days from now)
-        subscription_end = datetime.now(timezone.utc) + timedelta(days=30)
+        subscription_end = utc_now() + timedelta(days=30)
         
         # Update user subscription
         await users_collection.update_one(
@@ -245,10 +248,10 @@ async def verify_subscription_payment(
             "razorpay_payment_id": razorpay_payment_id,
             "plan": plan,
             "status": "active",
-            "start_date": datetime.now(timezone.utc).isoformat(),
-            "end_date": subscription_end.isoformat(),
+            "start_date": utc_now(),
+            "end_date": subscription_end,
             "auto_renew": False,
-            "created_at": datetime.now(timezone.utc).isoformat()
+            "created_at": utc_now()
         }
         
         await subscriptions_collection.insert_one(subscription_doc)
@@ -313,17 +316,18 @@ async def razorpay_webhook(request: Request):
                         "razorpay_payment_id": payment_id,
                         "status": "completed",
                         "webhook_event": event,
-                        "updated_at": datetime.now(timezone.utc).isoformat()
+                        "updated_at": utc_now()
                     }}
                 )
                 
                 # Update invoice status
-                await invoices_collection.update_one(
+                await apply_invoice_update(
                     {"id": payment["invoice_id"]},
-                    {"$set": {
+                    {
                         "status": "paid",
-                        "paid_at": datetime.now(timezone.utc).isoformat()
-                    }}
+                        "paid_at": utc_now(),
+                        **CLEAR_REMINDER_SCHEDULE
+                    }
                 )
                 
                 # Unlock deliverables
@@ -344,7 +348,7 @@ async def razorpay_webhook(request: Request):
                     "status": "failed",
                     "webhook_event": event,
                     "error_reason": payment_entity.get("error_description"),
-                    "updated_at": datetime.now(timezone.utc).isoformat()
+                    "updated_at": utc_now()
                 }}
             )
             
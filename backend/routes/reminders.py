@@ -1,72 +1,24 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Query, Response
 from models import ReminderGenerate, Reminder
 from database import reminders_collection, invoices_collection, clients_collection, users_collection
 from utils.auth import get_current_user
-from emergentintegrations.llm.chat import LlmChat, UserMessage
+from utils.pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, paginate, set_next_cursor
+from utils.dates import utc_now
+from utils.reminder_schedule import refresh_reminder_schedule
+from utils.email_outbox import enqueue_email
+from utils.reminder_text import generate_ai_reminder
+from utils.email_templates import render_reminder_email
 import uuid
-from datetime import datetime, timezone
+from typing import Optional
 import os
-import asyncio
-import resend
 from dotenv import load_dotenv
 
 load_dotenv()
 
 router = APIRouter()
 
-EMERGENT_LLM_KEY = os.getenv("EMERGENT_LLM_KEY")
-RESEND_API_KEY = os.getenv("RESEND_API_KEY")
 SENDER_EMAIL = os.getenv("SENDER_EMAIL", "noreply@clientnudge.ai")
 
-resend.api_key = RESEND_API_KEY
-
-async def generate_ai_reminder(invoice_data: dict, client_data: dict, reminder_type: str, user_plan: str) -> str:
-    """Generate AI-powered reminder message"""
-    
-    # Check if user has Pro/Agency plan
-    if user_plan == "free":
-        # Return template-based reminder for free users
-        templates = {
-            "polite": f"Hi {client_data['name']},\n\nThis is a friendly reminder that invoice {invoice_data['invoice_number']} for ${invoice_data['total_amount']} {invoice_data['currency']} is due on {invoice_data['due_date']}.\n\nPlease let me know if you have any questions.\n\nBest regards",
-            "firm": f"Dear {client_data['name']},\n\nInvoice {invoice_data['invoice_number']} for ${invoice_data['total_amount']} {invoice_data['currency']} is now overdue. Please arrange payment at your earliest convenience.\n\nThank you",
-            "final": f"URGENT: Dear {client_data['name']},\n\nThis is a final notice for invoice {invoice_data['invoice_number']} (${invoice_data['total_amount']} {invoice_data['currency']}), which is now significantly overdue. Please settle this immediately to avoid further action.\n\nRegards",
-            "late_fee_warning": f"Dear {client_data['name']},\n\nPlease note that invoice {invoice_data['invoice_number']} is overdue. As per our terms, a late fee of {invoice_data.get('late_fee_percentage', 5)}% will be applied if payment is not received promptly.\n\nCurrent amount due: ${invoice_data['total_amount']} {invoice_data['currency']}\n\nThank you"
-        }
-        return templates.get(reminder_type, templates["polite"])
-    
-    # AI-powered reminder for Pro/Agency users
-    prompt_context = f"""Generate a professional payment reminder email for:
-    
-Client: {client_data['name']} ({client_data['company'] or 'Individual'})
-Invoice Number: {invoice_data['invoice_number']}
-Amount: ${invoice_data['total_amount']} {invoice_data['currency']}
-Due Date: {invoice_data['due_date']}
-Status: {invoice_data['status']}
-Reminder Type: {reminder_type}
-
-Guidelines:
-- Be professional and {reminder_type}
-- Keep it concise (3-4 sentences)
-- Don't use subject line
-- Don't sign off with a name
-- Focus on the payment request
-"""
-    
-    try:
-        chat = LlmChat(
-            api_key=EMERGENT_LLM_KEY,
-            session_id=f"reminder-{invoice_data['id']}-{datetime.now().timestamp()}",
-            system_message="You are a professional payment reminder assistant. Generate concise, professional reminder messages."
-        ).with_model("openai", "gpt-5.2")
-        
-        user_message = UserMessage(text=prompt_context)
-        response = await chat.send_message(user_message)
-        
-        return response
-    except Exception as e:
-        # Fallback to template if AI fails
-        return f"Reminder: Invoice {invoice_data['invoice_number']} for ${invoice_data['total_amount']} {invoice_data['currency']} requires your attention. Due date: {invoice_data['due_date']}."
-
 @router.post("/generate")
 async def generate_reminder(reminder_data: ReminderGenerate, current_user: dict = Depends(get_current_user)):
     # Get invoice
@@ -83,7 +35,8 @@ async def generate_reminder(reminder_data: ReminderGenerate, current_user: dict
     user = await users_collection.find_one({"id": current_user["user_id"]}, {"_id": 0})
     
     # Generate AI message
-    message = await generate_ai_reminder(invoice, client, reminder_data.reminder_type, user["subscription_plan"])
+    message = await generate_ai_reminder(invoice, client, reminder_data.reminder_type, user["subscription_plan"],
+                                         locale=user.get("locale"))
     
     # Create reminder record
     reminder_id = str(uuid.uuid4())
@@ -94,7 +47,7 @@ async def generate_reminder(reminder_data: ReminderGenerate, current_user: dict
         "message": message,
         "sent_at": None,
         "channel": "email",
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": utc_now()
     }
     
     await reminders_collection.insert_one(reminder_doc)
@@ -121,57 +74,44 @@ async def send_reminder(reminder_id: str, current_user: dict = Depends(get_curre
     # Get user info
     user = await users_collection.find_one({"id": current_user["user_id"]}, {"_id": 0})
     
-    # Send email via Resend
-    html_content = f"""
-    <div style="font-family: Inter, sans-serif; max-width: 600px; margin: 0 auto;">
-        <h2 style="color: #4361EE;">Payment Reminder</h2>
-        <div style="white-space: pre-wrap; line-height: 1.6;">
-            {reminder['message']}
-        </div>
-        <hr style="margin: 30px 0; border: none; border-top: 1px solid #e5e7eb;">
-        <p style="font-size: 14px; color: #6b7280;">
-            <strong>Invoice Details:</strong><br>
-            Invoice #: {invoice['invoice_number']}<br>
-            Amount: ${invoice['total_amount']} {invoice['currency']}<br>
-            Due Date: {invoice['due_date']}
-        </p>
-        <a href="{os.getenv('FRONTEND_URL', 'http://localhost:3000')}/invoice/{invoice['id']}" 
-           style="display: inline-block; background: #4361EE; color: white; padding: 12px 24px; 
-                  text-decoration: none; border-radius: 6px; margin-top: 20px;">
-            View & Pay Invoice
-        </a>
-        <p style="margin-top: 30px; font-size: 12px; color: #9ca3af;">
-            Sent from {user['full_name']} via ClientNudge AI
-        </p>
-    </div>
-    """
-    
     params = {
         "from": SENDER_EMAIL,
         "to": [client["email"]],
-        "subject": f"Payment Reminder: Invoice {invoice['invoice_number']}",
-        "html": html_content
+        **render_reminder_email(invoice, user, reminder["message"])
     }
     
     try:
-        email = await asyncio.to_thread(resend.Emails.send, params)
+        # Delivered by the outbox worker; sending the same reminder twice queues it once
+        email, queued = await enqueue_email(params, f"reminder:{reminder_id}", reminder_id)
+        if not queued:
+            return {"message": "Reminder already sent", "email_id": email["id"]}
         
         # Update reminder as sent
+        sent_at = utc_now()
         await reminders_collection.update_one(
             {"id": reminder_id},
-            {"$set": {"sent_at": datetime.now(timezone.utc).isoformat()}}
+            {"$set": {"sent_at": sent_at, "email_status": "queued"}}
         )
+        # A manual reminder also pushes back the next automated one
+        await refresh_reminder_schedule(invoice, last_sent_at=sent_at, user=user)
         
-        return {"message": "Reminder sent successfully", "email_id": email.get("id")}
+        return {"message": "Reminder sent successfully", "email_id": email["id"]}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to send reminder: {str(e)}")
 
 @router.get("/invoice/{invoice_id}")
-async def get_invoice_reminders(invoice_id: str, current_user: dict = Depends(get_current_user)):
+async def get_invoice_reminders(
+    invoice_id: str,
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
     # Verify invoice belongs to user
     invoice = await invoices_collection.find_one({"id": invoice_id, "user_id": current_user["user_id"]}, {"_id": 0})
     if not invoice:
         raise HTTPException(status_code=404, detail="Invoice not found")
     
-    reminders = await reminders_collection.find({"invoice_id": invoice_id}, {"_id": 0}).to_list(1000)
+    reminders, next_cursor = await paginate(reminders_collection, {"invoice_id": invoice_id}, limit, cursor)
+    set_next_cursor(response, next_cursor)
     return [Reminder(**reminder) for reminder in reminders]
@@ -1,7 +1,17 @@
-from fastapi import APIRouter, HTTPException, Depends
-from models import UserUpdate
-from database import users_collection
+from fastapi import APIRouter, BackgroundTasks, HTTPException, Depends, UploadFile, File
+from fastapi.concurrency import run_in_threadpool
+from models import UserUpdate, PdfBrandingUpdate, PdfBranding
+from database import users_collection, pdf_branding_collection
 from utils.auth import get_current_user
+from utils.invoice_helpers import format_invoice_number
+from utils.reminder_schedule import DEFAULT_WINDOW_START, DEFAULT_WINDOW_END, backfill_reminder_schedule
+from utils.pdf_branding import BRANDING_LOGO_MAX_BYTES, BRANDING_LOGO_TYPES, fetch_branding, branding_view, is_valid_logo
+from utils.dates import utc_now
+from pymongo import ReturnDocument
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+import uuid
+
+SEND_WINDOW_FIELDS = ("timezone", "reminder_window_start", "reminder_window_end")
 
 router = APIRouter()
 
@@ -13,12 +23,36 @@ async def get_user_profile(current_user: dict = Depends(get_current_user)):
     return user
 
 @router.put("/")
-async def update_user_profile(user_update: UserUpdate, current_user: dict = Depends(get_current_user)):
+async def update_user_profile(user_update: UserUpdate, background_tasks: BackgroundTasks, current_user: dict = Depends(get_current_user)):
     update_data = {k: v for k, v in user_update.model_dump().items() if v is not None}
     
     if not update_data:
         raise HTTPException(status_code=400, detail="No data to update")
     
+    if "invoice_number_format" in update_data:
+        number_format = update_data["invoice_number_format"]
+        if "{seq" not in number_format:
+            raise HTTPException(status_code=400, detail="Invoice number format must include {seq}")
+        try:
+            format_invoice_number(number_format, "INV", 1)
+        except (KeyError, IndexError, ValueError, AttributeError, TypeError):
+            raise HTTPException(status_code=400, detail="Invalid invoice number format")
+    
+    if "timezone" in update_data:
+        try:
+            ZoneInfo(update_data["timezone"])
+        except (ZoneInfoNotFoundError, ValueError):
+            raise HTTPException(status_code=400, detail="Unknown timezone")
+    
+    send_window_changed = any(field in update_data for field in SEND_WINDOW_FIELDS)
+    if send_window_changed:
+        current = await users_collection.find_one({"id": current_user["user_id"]}, {"_id": 0, "reminder_window_start": 1, "reminder_window_end": 1})
+        window = {**(current or {}), **update_data}
+        start = window.get("reminder_window_start")
+        end = window.get("reminder_window_end")
+        if (DEFAULT_WINDOW_START if start is None else start) >= (DEFAULT_WINDOW_END if end is None else end):
+            raise HTTPException(status_code=400, detail="Reminder window must start before it ends")
+    
     result = await users_collection.update_one(
         {"id": current_user["user_id"]},
         {"$set": update_data}
@@ -27,5 +61,56 @@ async def update_user_profile(user_update: UserUpdate, current_user: dict = Depe
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
     
+    # Move open invoices' next reminders into the new window, after responding:
+    # it touches every open invoice of the user
+    if send_window_changed:
+        background_tasks.add_task(backfill_reminder_schedule, user_id=current_user["user_id"])
+    
     user = await users_collection.find_one({"id": current_user["user_id"]}, {"_id": 0, "password_hash": 0})
     return user
+
+async def _save_branding(user_id: str, changes: dict) -> PdfBranding:
+    """Apply branding changes under a new version, so cached templates and PDFs are replaced"""
+    branding = await pdf_branding_collection.find_one_and_update(
+        {"user_id": user_id},
+        {"$set": {**changes, "version": str(uuid.uuid4()), "updated_at": utc_now()}},
+        projection={"_id": 0},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return PdfBranding(**branding_view(branding))
+
+@router.get("/branding", response_model=PdfBranding)
+async def get_pdf_branding(current_user: dict = Depends(get_current_user)):
+    branding = await fetch_branding(current_user["user_id"])
+    return PdfBranding(**branding_view(branding or {"user_id": current_user["user_id"]}))
+
+@router.put("/branding", response_model=PdfBranding)
+async def update_pdf_branding(branding_update: PdfBrandingUpdate, current_user: dict = Depends(get_current_user)):
+    # Fields sent as null go back to the default look
+    changes = branding_update.model_dump(exclude_unset=True)
+    if not changes:
+        raise HTTPException(status_code=400, detail="No data to update")
+    return await _save_branding(current_user["user_id"], changes)
+
+@router.put("/branding/logo", response_model=PdfBranding)
+async def upload_pdf_logo(file: UploadFile = File(...), current_user: dict = Depends(get_current_user)):
+    if file.content_type not in BRANDING_LOGO_TYPES:
+        raise HTTPException(status_code=400, detail="Logo must be a PNG or JPEG image")
+    
+    content = await file.read()
+    if len(content) > BRANDING_LOGO_MAX_BYTES:
+        raise HTTPException(status_code=400, detail=f"Logo exceeds {BRANDING_LOGO_MAX_BYTES // 1024}KB limit")
+    if not await run_in_threadpool(is_valid_logo, content):
+        raise HTTPException(status_code=400, detail="Logo could not be read as an image")
+    
+    return await _save_branding(current_user["user_id"], {"logo": content, "logo_content_type": file.content_type})
+
+@router.delete("/branding/logo", response_model=PdfBranding)
+async def delete_pdf_logo(current_user: dict = Depends(get_current_user)):
+    return await _save_branding(current_user["user_id"], {"logo": None, "logo_content_type": None})
+
+@router.delete("/branding")
+async def reset_pdf_branding(current_user: dict = Depends(get_current_user)):
+    await pdf_branding_collection.delete_one({"user_id": current_user["user_id"]})
+    return {"message": "Branding reset to default"}
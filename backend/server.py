@@ -12,12 +12,17 @@ import uuid
 import bcrypt
 import jwt
 from typing import Optional
+from contextlib import asynccontextmanager
 
 # Import routes
 from routes import auth, users, clients, projects, invoices, payments, reminders, analytics, deliverables, admin, razorpay
 
 # Import scheduler
 from utils.scheduler import start_scheduler, stop_scheduler
+from utils.indexes import ensure_indexes
+from utils.email_outbox import outbox_worker
+from utils.pdf_pool import pdf_pool
+from utils.pagination import NEXT_CURSOR_HEADER
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -27,8 +32,23 @@ mongo_url = os.environ['MONGO_URL']
 client = AsyncIOMotorClient(mongo_url)
 db = client[os.environ['DB_NAME']]
 
+logger = logging.getLogger(__name__)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await ensure_indexes()
+    start_scheduler()
+    outbox_worker.start()
+    logger.info("Application started with automated reminder scheduler")
+    yield
+    # Drain running jobs before the database client goes away
+    await stop_scheduler()
+    await outbox_worker.stop()
+    pdf_pool.shutdown()
+    client.close()
+
 # Create the main app
-app = FastAPI(title="ClientNudge AI API")
+app = FastAPI(title="ClientNudge AI API", lifespan=lifespan)
 
 # Create API router
 api_router = APIRouter(prefix="/api")
@@ -64,6 +84,8 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    # Lets the browser read the keyset pagination cursor on cross-origin list calls
+    expose_headers=[NEXT_CURSOR_HEADER],
 )
 
 # Configure logging
@@ -71,14 +93,3 @@ logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
-logger = logging.getLogger(__name__)
-
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    stop_scheduler()
-    client.close()
-
-@app.on_event("startup")
-async def startup_event():
-    start_scheduler()
-    logger.info("Application started with automated reminder scheduler")
@@ -0,0 +1,345 @@
+"""
+Bulk import of clients and invoices from a JSON array or a CSV upload.
+
+Rows are processed in chunks of ``IMPORT_CHUNK_SIZE``. Every chunk costs a
+fixed number of round trips: one client lookup, one quota reservation, one
+counter update for invoice numbers, one ``insert_many`` each for invoices and
+line items, and one rollup update. A bad row never fails the request; it is
+reported with its errors in the per-row result. Near the plan limit, rows
+that still fit are imported and only the rest fail. An invoice whose line
+items cannot be written is removed again and reported as failed. A CSV that
+cannot be read partway through ends the import: the report lists the rows
+already handled and carries the parse error in ``error``.
+
+Benchmark against the configured database (throwaway user, cleaned up after):
+
+    python -m utils.bulk_import bench [--rows 10000]
+
+CSV layout: clients use ``name,email,phone,company``. Invoices use the
+``InvoiceImport`` fields plus ``description,quantity,rate`` for one line item
+per row; consecutive rows sharing an ``invoice_number`` form one invoice. A
+row may name its client by ``client_email`` instead of ``client_id``.
+"""
+from fastapi import UploadFile
+from starlette.concurrency import run_in_threadpool
+from pydantic import ValidationError
+from pymongo.errors import BulkWriteError
+from models import ClientCreate, InvoiceImport, ImportRowResult, ImportReport
+from database import clients_collection, invoices_collection, invoice_items_collection, users_collection, user_stats_collection, counters_collection
+from utils.invoice_helpers import (
+    EMBED_INVOICE_ITEMS, build_invoice_doc, build_invoice_items, generate_invoice_numbers,
+    reserve_available_quota, release_invoice_quota, invoice_sequence_key
+)
+from utils.user_stats import record_new_invoices, rollup_generation
+from utils.reminder_schedule import reminder_schedule, send_window
+from utils.dates import utc_now, parse_timestamp
+from datetime import timedelta
+from itertools import islice
+from typing import AsyncIterator, Iterator, List, Optional, Tuple
+import argparse
+import asyncio
+import csv
+import io
+import os
+import sys
+import time
+import uuid
+
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "500"))
+
+ITEM_COLUMNS = ("description", "quantity", "rate")
+
+Record = Tuple[int, dict]
+
+def _validation_errors(exc: ValidationError) -> List[str]:
+    return [f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}" for error in exc.errors()]
+
+def _failed(row: int, *errors: str) -> ImportRowResult:
+    return ImportRowResult(row=row, status="failed", errors=list(errors))
+
+async def json_chunks(rows: List[dict]) -> AsyncIterator[List[Record]]:
+    for start in range(0, len(rows), IMPORT_CHUNK_SIZE):
+        yield [(start + offset + 1, row) for offset, row in enumerate(rows[start:start + IMPORT_CHUNK_SIZE])]
+
+def _csv_rows(upload: UploadFile) -> Iterator[Record]:
+    """(row number, row) for each data row; blank cells are dropped so model defaults apply"""
+    reader = csv.DictReader(io.TextIOWrapper(upload.file, encoding="utf-8-sig", newline=""))
+    for row_number, row in enumerate(reader, start=1):
+        yield row_number, {key.strip(): value.strip() for key, value in row.items() if key and value and value.strip()}
+
+def _csv_invoice_records(rows: Iterator[Record]) -> Iterator[Record]:
+    """Fold consecutive line-item rows of the same invoice into one record"""
+    current = None
+    for row_number, row in rows:
+        item = {column: row.pop(column) for column in ITEM_COLUMNS if column in row}
+        number = row.get("invoice_number")
+        if current and number and current[1].get("invoice_number") == number:
+            current[1]["items"].append(item)
+            continue
+        if current:
+            yield current
+        current = (row_number, {**row, "items": [item] if item else []})
+    if current:
+        yield current
+
+class InvalidUpload(Exception):
+    """The upload cannot be read any further"""
+
+async def csv_chunks(records: Iterator[Record]) -> AsyncIterator[List[Record]]:
+    """Read the upload a chunk at a time, off the event loop"""
+    while True:
+        try:
+            chunk = await run_in_threadpool(lambda: list(islice(records, IMPORT_CHUNK_SIZE)))
+        except (UnicodeDecodeError, csv.Error) as e:
+            raise InvalidUpload(f"Invalid CSV: {e}")
+        if not chunk:
+            return
+        yield chunk
+
+def csv_client_chunks(upload: UploadFile) -> AsyncIterator[List[Record]]:
+    return csv_chunks(_csv_rows(upload))
+
+def csv_invoice_chunks(upload: UploadFile) -> AsyncIterator[List[Record]]:
+    return csv_chunks(_csv_invoice_records(_csv_rows(upload)))
+
+def _report(results: List[ImportRowResult], error: Optional[str] = None) -> ImportReport:
+    results.sort(key=lambda result: result.row)
+    created = sum(1 for result in results if result.status == "created")
+    return ImportReport(total=len(results), created=created, failed=len(results) - created, results=results, error=error)
+
+def _write_errors(exc: BulkWriteError) -> dict:
+    """insert_many index -> error message"""
+    errors = {}
+    for error in exc.details.get("writeErrors", []):
+        if error.get("code") == 11000:
+            errors[error["index"]] = f"Duplicate value: {error.get('keyValue')}"
+        else:
+            errors[error["index"]] = error.get("errmsg", "Write failed")
+    return errors
+
+async def _insert_chunk(collection, docs: List[dict]) -> dict:
+    if not docs:
+        return {}
+    try:
+        await collection.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        return _write_errors(e)
+    return {}
+
+async def _import_client_chunk(user_id: str, chunk: List[Record], results: List[ImportRowResult]):
+    rows, docs = [], []
+    for row_number, row in chunk:
+        try:
+            client_data = ClientCreate(**row)
+        except ValidationError as e:
+            results.append(_failed(row_number, *_validation_errors(e)))
+            continue
+        rows.append(row_number)
+        docs.append({
+            "id": str(uuid.uuid4()),
+            "user_id": user_id,
+            "name": client_data.name,
+            "email": client_data.email,
+            "phone": client_data.phone,
+            "company": client_data.company,
+            "payment_score": "medium",
+            "avg_payment_days": 0.0,
+            "total_paid": 0.0,
+            "total_pending": 0.0,
+            "created_at": utc_now()
+        })
+
+    errors = await _insert_chunk(clients_collection, docs)
+    for index, (row_number, doc) in enumerate(zip(rows, docs)):
+        if index in errors:
+            results.append(_failed(row_number, errors[index]))
+        else:
+            results.append(ImportRowResult(row=row_number, status="created", id=doc["id"]))
+
+async def import_clients(user_id: str, chunks: AsyncIterator[List[Record]]) -> ImportReport:
+    results = []
+    try:
+        async for chunk in chunks:
+            await _import_client_chunk(user_id, chunk, results)
+    except InvalidUpload as e:
+        # Report the rows already imported along with the error
+        return _report(results, str(e))
+    return _report(results)
+
+async def _resolve_clients(user_id: str, chunk: List[Record]) -> set:
+    """Fill client_id from client_email and return the client ids this user owns"""
+    ids = {row["client_id"] for _, row in chunk if row.get("client_id")}
+    emails = {row["client_email"] for _, row in chunk if not row.get("client_id") and row.get("client_email")}
+    if not ids and not emails:
+        return set()
+
+    by_email = {}
+    owned = set()
+    async for client in clients_collection.find(
+        {"user_id": user_id, "$or": [{"id": {"$in": list(ids)}}, {"email": {"$in": list(emails)}}]},
+        {"_id": 0, "id": 1, "email": 1}
+    ):
+        owned.add(client["id"])
+        by_email.setdefault(client["email"], client["id"])
+
+    for _, row in chunk:
+        if not row.get("client_id") and row.get("client_email") in by_email:
+            row["client_id"] = by_email[row["client_email"]]
+    return owned
+
+def _validate_invoice(row: dict) -> Tuple[InvoiceImport, dict]:
+    """Parse the row; returns the model and its timestamps as datetimes"""
+    invoice_data = InvoiceImport(**row)
+    if not invoice_data.items:
+        raise ValueError("items: at least one line item is required")
+    try:
+        dates = {
+            field: parse_timestamp(getattr(invoice_data, field))
+            for field in ("due_date", "created_at", "sent_at", "paid_at")
+        }
+    except ValueError:
+        raise ValueError("Invalid date")
+    return invoice_data, dates
+
+async def _limit_message(user_id: str) -> str:
+    user = await users_collection.find_one({"id": user_id}, {"_id": 0, "subscription_plan": 1})
+    if not user:
+        return "User not found"
+    return f"Invoice limit reached for {user['subscription_plan']} plan. Upgrade to Pro for unlimited invoices."
+
+async def _insert_items(item_docs: List[List[dict]], skip: dict) -> dict:
+    """Insert the line items of the invoices that were written.
+
+    Returns invoice index -> error for invoices with an item that failed;
+    those invoices and their other items are deleted again.
+    """
+    owners, items = [], []
+    for index, invoice_items in enumerate(item_docs):
+        if index not in skip:
+            owners.extend([index] * len(invoice_items))
+            items.extend(invoice_items)
+    errors = {owners[item_index]: f"Line item: {message}" for item_index, message in (await _insert_chunk(invoice_items_collection, items)).items()}
+    if errors:
+        invoice_ids = [item_docs[index][0]["invoice_id"] for index in errors]
+        await invoice_items_collection.delete_many({"invoice_id": {"$in": invoice_ids}})
+        await invoices_collection.delete_many({"id": {"$in": invoice_ids}})
+    return errors
+
+async def _import_invoice_chunk(user_id: str, chunk: List[Record], results: List[ImportRowResult]):
+    owned_clients = await _resolve_clients(user_id, chunk)
+
+    valid = []
+    for row_number, row in chunk:
+        if not row.get("client_id") and row.get("client_email"):
+            results.append(_failed(row_number, "Client not found"))
+            continue
+        try:
+            invoice_data, dates = _validate_invoice(row)
+        except ValidationError as e:
+            results.append(_failed(row_number, *_validation_errors(e)))
+            continue
+        except ValueError as e:
+            results.append(_failed(row_number, str(e)))
+            continue
+        if invoice_data.client_id not in owned_clients:
+            results.append(_failed(row_number, "Client not found"))
+            continue
+        valid.append((row_number, invoice_data, dates))
+    if not valid:
+        return
+
+    # Check subscription limit and count the rows that fit in one atomic update
+    user, reserved = await reserve_available_quota(user_id, len(valid))
+    if reserved < len(valid):
+        message = await _limit_message(user_id)
+        results.extend(_failed(row_number, message) for row_number, _, _ in valid[reserved:])
+        valid = valid[:reserved]
+    if not valid:
+        return
+
+    missing_numbers = sum(1 for _, invoice_data, _ in valid if not invoice_data.invoice_number)
+    numbers = iter(await generate_invoice_numbers(user, missing_numbers) if missing_numbers else [])
+
+    invoice_docs, item_docs = [], []
+    for row_number, invoice_data, dates in valid:
+        doc = build_invoice_doc(user_id, invoice_data, invoice_data.invoice_number or next(numbers), dates["due_date"])
+        doc["status"] = invoice_data.status
+        for field in ("created_at", "sent_at", "paid_at"):
+            if dates[field]:
+                doc[field] = dates[field]
+        doc.update(reminder_schedule(doc, None, utc_now(), send_window(user)))
+        items = build_invoice_items(doc["id"], invoice_data.items)
+        if EMBED_INVOICE_ITEMS:
+            doc["items"] = items
+        else:
+            item_docs.append(items)
+        invoice_docs.append(doc)
+
+    generation = await rollup_generation(user_id)
+    errors = await _insert_chunk(invoices_collection, invoice_docs)
+    if item_docs:
+        errors.update(await _insert_items(item_docs, errors))
+    if errors:
+        await release_invoice_quota(user_id, len(errors))
+
+    created = []
+    for index, (row_number, _, _) in enumerate(valid):
+        doc = invoice_docs[index]
+        if index in errors:
+            results.append(_failed(row_number, errors[index]))
+            continue
+        created.append(doc)
+        results.append(ImportRowResult(row=row_number, status="created", id=doc["id"], invoice_number=doc["invoice_number"]))
+
+    await record_new_invoices(user_id, created, generation)
+
+async def import_invoices(user_id: str, chunks: AsyncIterator[List[Record]]) -> ImportReport:
+    results = []
+    try:
+        async for chunk in chunks:
+            await _import_invoice_chunk(user_id, chunk, results)
+    except InvalidUpload as e:
+        # Report the rows already imported along with the error
+        return _report(results, str(e))
+    return _report(results)
+
+async def _bench(rows: int) -> Tuple[float, ImportReport]:
+    """Import ``rows`` one-item invoices for a throwaway user; returns (seconds, report)"""
+    user_id = f"bench-{uuid.uuid4()}"
+    client_id = str(uuid.uuid4())
+    now = utc_now()
+    await users_collection.insert_one({
+        "id": user_id, "email": f"{user_id}@example.com", "full_name": "Import Benchmark",
+        "subscription_plan": "agency", "invoice_count": 0, "created_at": now
+    })
+    await clients_collection.insert_one({"id": client_id, "user_id": user_id, "name": "Bench Client",
+                                         "email": "client@example.com", "created_at": now})
+    due_date = (now + timedelta(days=30)).isoformat()
+    records = [{"client_id": client_id, "due_date": due_date,
+                "items": [{"description": f"Line {row}", "quantity": 1, "rate": 100.0}]} for row in range(rows)]
+    try:
+        started = time.perf_counter()
+        report = await import_invoices(user_id, json_chunks(records))
+        return time.perf_counter() - started, report
+    finally:
+        invoice_ids = [doc["id"] async for doc in invoices_collection.find({"user_id": user_id}, {"_id": 0, "id": 1})]
+        await invoice_items_collection.delete_many({"invoice_id": {"$in": invoice_ids}})
+        await invoices_collection.delete_many({"user_id": user_id})
+        await clients_collection.delete_many({"user_id": user_id})
+        await user_stats_collection.delete_many({"user_id": user_id})
+        await counters_collection.delete_many({"_id": invoice_sequence_key(user_id)})
+        await users_collection.delete_one({"id": user_id})
+
+async def _main(argv):
+    parser = argparse.ArgumentParser(description="Bulk invoice import")
+    parser.add_argument("command", choices=["bench"])
+    parser.add_argument("--rows", type=int, default=10000)
+    args = parser.parse_args(argv)
+
+    seconds, report = await _bench(args.rows)
+    print(f"Imported {report.created} of {report.total} invoices in {seconds:.2f}s "
+          f"({report.created / seconds:,.0f} invoices/s, chunks of {IMPORT_CHUNK_SIZE})")
+    return 0 if report.failed == 0 else 1
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(_main(sys.argv[1:])))
@@ -0,0 +1,109 @@
+from datetime import datetime, timezone
+from database import invoices_collection
+from models import DashboardStats
+from utils.dates import timestamp_range
+
+MS_PER_DAY = 24 * 60 * 60 * 1000
+
+def _as_date(field):
+    """Coerce a stored timestamp (ISO string or date) to a BSON date, null if absent/invalid"""
+    return {"$convert": {"input": field, "to": "date", "onError": None, "onNull": None}}
+
+def dashboard_pipeline(user_id: str, now: datetime) -> list:
+    """Aggregation computing every DashboardStats field for one user in a single pass"""
+    first_day_of_month = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+    is_paid = {"$eq": ["$status", "paid"]}
+    is_pending = {"$in": ["$status", ["sent", "viewed"]]}
+    is_overdue_status = {"$eq": ["$status", "overdue"]}
+    has_paid_at = {"$ne": ["$_paid_at", None]}
+    # Sent/viewed invoices past their due date count as overdue even before
+    # the scheduler flips their status
+    is_overdue = {"$or": [
+        is_overdue_status,
+        {"$and": [is_pending, {"$ne": ["$_due_date", None]}, {"$gt": [now, "$_due_date"]}]},
+    ]}
+
+    return [
+        {"$match": {"user_id": user_id}},
+        {"$project": {
+            "_id": 0,
+            "status": 1,
+            "total_amount": 1,
+            "late_fee_amount": {"$ifNull": ["$late_fee_amount", 0.0]},
+            "_paid_at": _as_date("$paid_at"),
+            "_created_at": _as_date("$created_at"),
+            "_due_date": _as_date("$due_date"),
+        }},
+        {"$group": {
+            "_id": None,
+            "total_invoices": {"$sum": 1},
+            "paid_invoices": {"$sum": {"$cond": [is_paid, 1, 0]}},
+            "pending_invoices": {"$sum": {"$cond": [is_pending, 1, 0]}},
+            "overdue_invoices": {"$sum": {"$cond": [is_overdue, 1, 0]}},
+            "total_outstanding": {"$sum": {"$cond": [{"$or": [is_pending, is_overdue_status]}, "$total_amount", 0]}},
+            "overdue_amount": {"$sum": {"$cond": [is_overdue, "$total_amount", 0]}},
+            "late_fee_collected": {"$sum": {"$cond": [is_paid, "$late_fee_amount", 0]}},
+            "paid_this_month": {"$sum": {"$cond": [
+                {"$and": [is_paid, has_paid_at, {"$gte": ["$_paid_at", first_day_of_month]}]},
+                "$total_amount",
+                0,
+            ]}},
+            # $avg skips nulls, so only paid invoices with a paid_at contribute
+            "average_payment_time": {"$avg": {"$cond": [
+                {"$and": [is_paid, has_paid_at]},
+                {"$floor": {"$divide": [{"$subtract": ["$_paid_at", "$_created_at"]}, MS_PER_DAY]}},
+                None,
+            ]}},
+        }},
+    ]
+
+async def compute_dashboard_stats(user_id: str, now: datetime = None) -> DashboardStats:
+    """Compute dashboard stats in MongoDB with one round trip"""
+    now = now or datetime.now(timezone.utc)
+    results = await invoices_collection.aggregate(dashboard_pipeline(user_id, now)).to_list(1)
+    row = results[0] if results else {}
+
+    return DashboardStats(
+        total_outstanding=round(row.get("total_outstanding", 0.0), 2),
+        paid_this_month=round(row.get("paid_this_month", 0.0), 2),
+        overdue_amount=round(row.get("overdue_amount", 0.0), 2),
+        average_payment_time=round(row.get("average_payment_time") or 0.0, 1),
+        late_fee_collected=round(row.get("late_fee_collected", 0.0), 2),
+        total_invoices=row.get("total_invoices", 0),
+        paid_invoices=row.get("paid_invoices", 0),
+        pending_invoices=row.get("pending_invoices", 0),
+        overdue_invoices=row.get("overdue_invoices", 0)
+    )
+
+def revenue_trend_pipeline(user_id: str, start: datetime, end: datetime, granularity: str,
+                           base_currency: str = None) -> list:
+    """Paid revenue bucketed by period in the database.
+
+    With ``base_currency`` every invoice is converted with its stored
+    ``exchange_rate`` and reported in that currency; otherwise revenue is
+    grouped per invoice currency so different currencies are never summed.
+    Invoices whose ``paid_at`` is still a legacy string are included too.
+    """
+    if base_currency:
+        amount = {"$multiply": ["$total_amount", {"$ifNull": ["$exchange_rate", 1.0]}]}
+        currency = {"$literal": base_currency}
+    else:
+        amount = "$total_amount"
+        currency = "$currency"
+
+    return [
+        {"$match": {
+            "user_id": user_id,
+            "status": "paid",
+            **timestamp_range("paid_at", start, end),
+        }},
+        {"$group": {
+            "_id": {
+                "period": {"$dateTrunc": {"date": _as_date("$paid_at"), "unit": granularity, "startOfWeek": "monday"}},
+                "currency": currency,
+            },
+            "revenue": {"$sum": amount},
+        }},
+        {"$sort": {"_id.period": 1, "_id.currency": 1}},
+    ]
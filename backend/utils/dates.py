@@ -0,0 +1,51 @@
+from datetime import datetime, timezone
+from typing import Optional, Union
+
+def utc_now() -> datetime:
+    """Current UTC time at BSON (millisecond) precision, so what we return
+    on create matches what a later read gives back"""
+    now = datetime.now(timezone.utc)
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+def parse_timestamp(value: Union[str, datetime, None]) -> Optional[datetime]:
+    """Timezone-aware datetime from a stored timestamp.
+
+    Accepts BSON dates and legacy ISO strings (documents not yet migrated);
+    naive values are taken to be UTC.
+    """
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        parsed = value
+    else:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+def timestamp_range(field: str, start: Optional[datetime] = None, end: Optional[datetime] = None) -> dict:
+    """Query filter for ``start <= field < end``, matching BSON dates and
+    legacy ISO strings (documents not yet migrated). Either bound may be
+    left out; with neither the filter is empty.
+
+    Strings are compared as text, which orders them correctly because every
+    timestamp the app wrote as a string was UTC with an explicit offset.
+    """
+    bounds = [(operator, parse_timestamp(value)) for operator, value in (("$gte", start), ("$lt", end)) if value]
+    if not bounds:
+        return {}
+    return {"$or": [
+        {field: {operator: value for operator, value in bounds}},
+        {field: {operator: value.astimezone(timezone.utc).isoformat() for operator, value in bounds}},
+    ]}
+
+def to_iso(value: Union[str, datetime, None]) -> Optional[str]:
+    """ISO-8601 string as the API has always returned it"""
+    if isinstance(value, datetime):
+        return parse_timestamp(value).isoformat()
+    return value
+
+def format_date(value: Union[str, datetime, None]) -> str:
+    """YYYY-MM-DD for emails and reminder text"""
+    parsed = parse_timestamp(value)
+    return parsed.strftime("%Y-%m-%d") if parsed else ""
@@ -0,0 +1,287 @@
+"""
+Durable email outbox.
+
+Request handlers and the reminder scheduler only ``enqueue_email``. That
+inserts a document into ``email_outbox`` and returns immediately. The
+``OutboxWorker`` running in the app process drains the outbox in batches
+through the provider's batch API (Resend: up to 100 emails per call).
+Failed emails are retried with exponential backoff until
+``OUTBOX_MAX_ATTEMPTS``.
+
+Every API worker starts an OutboxWorker, but only the one holding the
+``email_outbox`` lease (utils.leases) sends. The rest stand by and take over
+once it stops renewing. ``EMAIL_RATE_LIMIT`` therefore caps the whole
+deployment, not each process.
+
+Every email has an idempotency key, so enqueueing the same email twice
+stores it once. The key is also sent to the provider, so a batch retried
+after a crash is not delivered twice. ``EMAIL_PROVIDER=fake`` swaps in
+``FakeEmailProvider``, which records emails instead of sending them.
+"""
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+from database import email_outbox_collection, reminders_collection
+from utils.dates import utc_now
+from utils.leases import Lease
+from utils.rate_limit import TokenBucket
+from datetime import timedelta
+from typing import List, Optional, Tuple
+from dotenv import load_dotenv
+import asyncio
+import hashlib
+import logging
+import os
+import time
+import uuid
+import resend
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+EMAIL_PROVIDER = os.getenv("EMAIL_PROVIDER", "resend")
+OUTBOX_BATCH_SIZE = min(100, int(os.getenv("OUTBOX_BATCH_SIZE", "100")))
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "5"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BASE_BACKOFF_SECONDS = float(os.getenv("OUTBOX_BASE_BACKOFF_SECONDS", "30"))
+OUTBOX_MAX_BACKOFF_SECONDS = float(os.getenv("OUTBOX_MAX_BACKOFF_SECONDS", "3600"))
+# A claimed batch not finished within this long (worker died) is picked up again
+OUTBOX_CLAIM_SECONDS = float(os.getenv("OUTBOX_CLAIM_SECONDS", "300"))
+# Provider API calls per second across all workers (0 = unlimited)
+EMAIL_RATE_LIMIT = float(os.getenv("EMAIL_RATE_LIMIT", "2"))
+
+resend.api_key = os.getenv("RESEND_API_KEY")
+
+async def enqueue_email(params: dict, idempotency_key: str, reminder_id: str = None) -> Tuple[dict, bool]:
+    """Store an email for delivery; returns (outbox doc, whether it was new)"""
+    now = utc_now()
+    doc = {
+        "id": str(uuid.uuid4()),
+        "idempotency_key": idempotency_key,
+        "params": params,
+        "reminder_id": reminder_id,
+        "status": "pending",
+        "attempts": 0,
+        "next_attempt_at": now,
+        "claim": None,
+        "claimed_until": None,
+        "provider_id": None,
+        "last_error": None,
+        "created_at": now,
+        "sent_at": None
+    }
+    try:
+        await email_outbox_collection.insert_one(doc)
+    except DuplicateKeyError:
+        existing = await email_outbox_collection.find_one({"idempotency_key": idempotency_key}, {"_id": 0})
+        return existing, False
+    doc.pop("_id", None)
+    return doc, True
+
+def backoff_delay(attempts: int) -> timedelta:
+    """Delay before retry number ``attempts`` (1-based)"""
+    seconds = OUTBOX_BASE_BACKOFF_SECONDS * 2 ** (attempts - 1)
+    return timedelta(seconds=min(seconds, OUTBOX_MAX_BACKOFF_SECONDS))
+
+class ResendProvider:
+    """Sends through Resend's batch endpoint"""
+
+    async def send_batch(self, messages: List[dict]) -> List[dict]:
+        """Send outbox docs; returns one {"ok", "id", "error"} per message, in order"""
+        keys = "".join(message["idempotency_key"] for message in messages)
+        options = {
+            "idempotency_key": hashlib.sha256(keys.encode()).hexdigest(),
+            "batch_validation": "permissive",
+        }
+        response = await asyncio.to_thread(resend.Batch.send, [message["params"] for message in messages], options)
+
+        errors = {error["index"]: error["message"] for error in response.get("errors") or []}
+        sent = iter(response.get("data") or [])
+        results = []
+        for index in range(len(messages)):
+            if index in errors:
+                results.append({"ok": False, "id": None, "error": errors[index]})
+            else:
+                results.append({"ok": True, "id": next(sent, {}).get("id"), "error": None})
+        return results
+
+class FakeEmailProvider:
+    """Local stand-in that records emails instead of sending them.
+
+    Like the real provider it ignores repeated idempotency keys. Addresses
+    in ``fail_addresses`` are rejected, and the first ``fail_batches`` calls
+    raise to simulate an outage.
+    """
+
+    def __init__(self, fail_addresses=(), fail_batches: int = 0):
+        self.fail_addresses = set(fail_addresses)
+        self.fail_batches = fail_batches
+        self.sent = []
+        self.calls = 0
+        self._seen = {}
+
+    async def send_batch(self, messages: List[dict]) -> List[dict]:
+        self.calls += 1
+        if self.calls <= self.fail_batches:
+            raise ConnectionError("fake provider unavailable")
+
+        results = []
+        for message in messages:
+            key = message["idempotency_key"]
+            if any(address in self.fail_addresses for address in message["params"]["to"]):
+                results.append({"ok": False, "id": None, "error": "rejected by fake provider"})
+                continue
+            if key not in self._seen:
+                self._seen[key] = f"fake-{len(self.sent) + 1}"
+                self.sent.append(message["params"])
+            results.append({"ok": True, "id": self._seen[key], "error": None})
+        return results
+
+def default_provider():
+    return FakeEmailProvider() if EMAIL_PROVIDER == "fake" else ResendProvider()
+
+class OutboxMetrics:
+    def __init__(self):
+        self.batches = 0
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.send_seconds = 0.0
+        self.max_send_seconds = 0.0
+        self.queue_seconds = 0.0
+        self.max_queue_seconds = 0.0
+        self.started = time.monotonic()
+
+    def record_batch(self, seconds: float):
+        self.batches += 1
+        self.send_seconds += seconds
+        self.max_send_seconds = max(self.max_send_seconds, seconds)
+
+    def record_sent(self, queued_seconds: float):
+        self.sent += 1
+        self.queue_seconds += queued_seconds
+        self.max_queue_seconds = max(self.max_queue_seconds, queued_seconds)
+
+    def snapshot(self) -> dict:
+        uptime = time.monotonic() - self.started
+        return {
+            "batches": self.batches,
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed,
+            "emails_per_second": round(self.sent / uptime, 3) if uptime else 0.0,
+            "avg_batch_send_seconds": round(self.send_seconds / self.batches, 3) if self.batches else 0.0,
+            "max_batch_send_seconds": round(self.max_send_seconds, 3),
+            "avg_queue_seconds": round(self.queue_seconds / self.sent, 3) if self.sent else 0.0,
+            "max_queue_seconds": round(self.max_queue_seconds, 3),
+        }
+
+class OutboxWorker:
+    def __init__(self, provider=None, batch_size: int = OUTBOX_BATCH_SIZE, poll_seconds: float = OUTBOX_POLL_SECONDS,
+                 limiter: TokenBucket = None, lease: Lease = None):
+        self.provider = provider or default_provider()
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+        self.limiter = limiter or TokenBucket(EMAIL_RATE_LIMIT)
+        # Re-taken before every batch, which also renews it
+        self.lease = lease or Lease("email_outbox")
+        self.metrics = OutboxMetrics()
+        self._task = None
+        self._stopping = None
+
+    async def _claim(self) -> List[dict]:
+        """Atomically take up to batch_size due emails for this worker"""
+        now = utc_now()
+        due = {"$or": [
+            {"status": "pending", "next_attempt_at": {"$lte": now}},
+            {"status": "sending", "claimed_until": {"$lt": now}},
+        ]}
+        candidates = await email_outbox_collection.find(due, {"_id": 0, "id": 1}) \
+            .sort("next_attempt_at", 1).limit(self.batch_size).to_list(self.batch_size)
+        if not candidates:
+            return []
+
+        claim = str(uuid.uuid4())
+        await email_outbox_collection.update_many(
+            {"id": {"$in": [doc["id"] for doc in candidates]}, **due},
+            {"$set": {"status": "sending", "claim": claim, "claimed_until": now + timedelta(seconds=OUTBOX_CLAIM_SECONDS)}}
+        )
+        return await email_outbox_collection.find({"claim": claim}, {"_id": 0}).to_list(self.batch_size)
+
+    async def drain_once(self) -> int:
+        """Send one batch; returns how many emails were attempted"""
+        messages = await self._claim()
+        if not messages:
+            return 0
+
+        await self.limiter.acquire()
+        started = time.monotonic()
+        try:
+            results = await self.provider.send_batch(messages)
+        except Exception as e:
+            logger.error(f"Email batch of {len(messages)} failed: {e}")
+            results = [{"ok": False, "id": None, "error": str(e)}] * len(messages)
+        self.metrics.record_batch(time.monotonic() - started)
+
+        now = utc_now()
+        outbox_updates, reminder_updates = [], []
+        for message, result in zip(messages, results):
+            attempts = message["attempts"] + 1
+            if result["ok"]:
+                changes = {"status": "sent", "sent_at": now, "provider_id": result["id"], "last_error": None}
+                self.metrics.record_sent((now - message["created_at"]).total_seconds())
+            elif attempts >= OUTBOX_MAX_ATTEMPTS:
+                changes = {"status": "failed", "last_error": result["error"]}
+                self.metrics.failed += 1
+                logger.error(f"Giving up on email {message['id']} after {attempts} attempts: {result['error']}")
+            else:
+                changes = {"status": "pending", "next_attempt_at": now + backoff_delay(attempts), "last_error": result["error"]}
+                self.metrics.retried += 1
+            changes.update({"attempts": attempts, "claim": None, "claimed_until": None})
+            outbox_updates.append(UpdateOne({"id": message["id"], "claim": message["claim"]}, {"$set": changes}))
+            if message.get("reminder_id") and changes["status"] in ("sent", "failed"):
+                reminder_updates.append(UpdateOne({"id": message["reminder_id"]}, {"$set": {"email_status": changes["status"]}}))
+
+        await email_outbox_collection.bulk_write(outbox_updates, ordered=False)
+        if reminder_updates:
+            await reminders_collection.bulk_write(reminder_updates, ordered=False)
+        return len(messages)
+
+    async def run(self):
+        """Drain continuously while holding the outbox lease, sleeping when
+        the outbox is empty or another worker holds it"""
+        while not self._stopping.is_set():
+            try:
+                attempted = await self.drain_once() if await self.lease.acquire() else 0
+            except Exception as e:
+                logger.error(f"Email outbox worker error: {e}")
+                attempted = 0
+            if not attempted:
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), timeout=self.poll_seconds)
+                except asyncio.TimeoutError:
+                    pass
+
+    def start(self):
+        """Start draining on the running event loop (the app lifespan)"""
+        self._stopping = asyncio.Event()
+        self._task = asyncio.create_task(self.run())
+        logger.info("Email outbox worker started")
+
+    async def stop(self):
+        """Finish the batch in flight, then stop"""
+        if not self._task:
+            return
+        self._stopping.set()
+        await self._task
+        self._task = None
+        if self.lease.held:
+            # Let a standby worker take over without waiting for the TTL
+            await self.lease.release()
+        logger.info("Email outbox worker stopped")
+
+async def outbox_depth() -> dict:
+    """Emails per outbox status"""
+    rows = await email_outbox_collection.aggregate([{"$group": {"_id": "$status", "count": {"$sum": 1}}}]).to_list(None)
+    return {row["_id"]: row["count"] for row in rows}
+
+outbox_worker = OutboxWorker()
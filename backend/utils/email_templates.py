@@ -0,0 +1,115 @@
+"""
+Reminder email rendering.
+
+The templates are compiled once, when the module is imported, in an
+autoescaping Jinja2 environment. Reminder text, client and user names can
+therefore never inject markup. Every email has an HTML body and a plain-text
+alternative. Rendering one email is only a template call, so the scheduler
+renders each email as it is queued.
+
+Benchmark with:
+
+    python -m utils.email_templates bench [--count N]
+"""
+from jinja2 import Environment, DictLoader, StrictUndefined, select_autoescape
+from utils.dates import format_date
+from dotenv import load_dotenv
+import argparse
+import os
+import sys
+import time
+
+load_dotenv()
+
+FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:3000")
+
+_TEMPLATES = {
+    "reminder.html": """\
+<div style="font-family: Inter, sans-serif; max-width: 600px; margin: 0 auto;">
+    <h2 style="color: #4361EE;">Payment Reminder</h2>
+    <div style="white-space: pre-wrap; line-height: 1.6;">{{ message }}</div>
+    <hr style="margin: 30px 0; border: none; border-top: 1px solid #e5e7eb;">
+    <p style="font-size: 14px; color: #6b7280;">
+        <strong>Invoice Details:</strong><br>
+        Invoice #: {{ invoice_number }}<br>
+        Amount: ${{ amount }} {{ currency }}<br>
+        Due Date: {{ due_date }}
+    </p>
+    <a href="{{ link }}"
+       style="display: inline-block; background: #4361EE; color: white; padding: 12px 24px;
+              text-decoration: none; border-radius: 6px; margin-top: 20px;">
+        View & Pay Invoice
+    </a>
+    <p style="margin-top: 30px; font-size: 12px; color: #9ca3af;">
+        {% if automated %}Automated reminder from{% else %}Sent from{% endif %} {{ sender_name }} via ClientNudge AI
+    </p>
+</div>
+""",
+    "reminder.txt": """\
+{{ message }}
+
+Invoice Details:
+Invoice #: {{ invoice_number }}
+Amount: ${{ amount }} {{ currency }}
+Due Date: {{ due_date }}
+
+View & Pay Invoice: {{ link }}
+
+{% if automated %}Automated reminder from{% else %}Sent from{% endif %} {{ sender_name }} via ClientNudge AI
+""",
+}
+
+_env = Environment(
+    loader=DictLoader(_TEMPLATES),
+    autoescape=select_autoescape(enabled_extensions=("html",), default_for_string=False),
+    undefined=StrictUndefined,
+    keep_trailing_newline=True,
+)
+_HTML = _env.get_template("reminder.html")
+_TEXT = _env.get_template("reminder.txt")
+
+def _context(invoice: dict, user: dict, message: str, automated: bool) -> dict:
+    # Automated reminders link to the public portal, manual ones to the invoice page
+    path = "portal" if automated else "invoice"
+    return {
+        "message": message,
+        "invoice_number": invoice["invoice_number"],
+        "amount": invoice["total_amount"],
+        "currency": invoice["currency"],
+        "due_date": format_date(invoice["due_date"]),
+        "link": f"{FRONTEND_URL}/{path}/{invoice['id']}",
+        "sender_name": user["full_name"],
+        "automated": automated,
+    }
+
+def render_reminder_email(invoice: dict, user: dict, message: str, automated: bool = False) -> dict:
+    """Subject, HTML and plain-text body of one reminder email"""
+    context = _context(invoice, user, message, automated)
+    return {
+        "subject": f"Payment Reminder: Invoice {invoice['invoice_number']}",
+        "html": _HTML.render(context),
+        "text": _TEXT.render(context),
+    }
+
+def _bench(count: int) -> float:
+    invoice = {"id": "0f8c", "invoice_number": "INV-00042", "total_amount": 1250.0,
+               "currency": "USD", "due_date": "2026-01-31T00:00:00+00:00"}
+    user = {"full_name": "Ada <Lovelace> & Co"}
+    message = "Hi <b>Client</b>,\n\nInvoice INV-00042 for $1250.0 USD is now overdue.\n\nThank you"
+    started = time.perf_counter()
+    for _ in range(count):
+        render_reminder_email(invoice, user, message, automated=True)
+    return time.perf_counter() - started
+
+def _main(argv):
+    parser = argparse.ArgumentParser(description="Reminder email rendering")
+    parser.add_argument("command", choices=["bench"])
+    parser.add_argument("--count", type=int, default=10000)
+    args = parser.parse_args(argv)
+
+    seconds = _bench(args.count)
+    print(f"Rendered {args.count} reminder emails in {seconds:.3f}s ({args.count / seconds:,.0f} emails/s)")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(_main(sys.argv[1:]))
@@ -0,0 +1,224 @@
+"""
+Declarative MongoDB index registry.
+
+Indexes are applied idempotently at startup by ``ensure_indexes()``. The same
+module doubles as a maintenance command:
+
+    python -m utils.indexes            # create/verify all indexes
+    python -m utils.indexes --explain  # explain() every route query, report COLLSCANs
+"""
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+from database import db
+from datetime import datetime
+from utils.dates import timestamp_range
+import asyncio
+import argparse
+import logging
+import sys
+
+logger = logging.getLogger(__name__)
+
+# collection name -> indexes the routes and scheduler rely on
+INDEXES = {
+    "users": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+    ],
+    "clients": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("user_id", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)], name="user_created_id"),
+        IndexModel([("user_id", ASCENDING), ("email", ASCENDING)], name="user_email"),
+    ],
+    "projects": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("user_id", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)], name="user_created_id"),
+    ],
+    "project_logs": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("project_id", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)], name="project_created_id"),
+    ],
+    "invoices": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("user_id", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)], name="user_created_id"),
+        IndexModel([("user_id", ASCENDING), ("status", ASCENDING), ("paid_at", ASCENDING)], name="user_status_paid"),
+        IndexModel([("status", ASCENDING), ("auto_reminders", ASCENDING)], name="status_auto_reminders"),
+        IndexModel([("next_reminder_at", ASCENDING)], name="next_reminder"),
+        IndexModel([("user_id", ASCENDING), ("invoice_number", ASCENDING)], name="user_invoice_number_unique", unique=True),
+    ],
+    "invoice_items": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("invoice_id", ASCENDING)], name="invoice"),
+    ],
+    "payments": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("invoice_id", ASCENDING)], name="invoice"),
+        IndexModel(
+            [("razorpay_order_id", ASCENDING)],
+            name="razorpay_order_unique",
+            unique=True,
+            partialFilterExpression={"razorpay_order_id": {"$type": "string"}},
+        ),
+        IndexModel(
+            [("stripe_session_id", ASCENDING)],
+            name="stripe_session_unique",
+            unique=True,
+            partialFilterExpression={"stripe_session_id": {"$type": "string"}},
+        ),
+    ],
+    "reminders": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("invoice_id", ASCENDING), ("sent_at", DESCENDING)], name="invoice_sent"),
+        IndexModel([("invoice_id", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)], name="invoice_created_id"),
+    ],
+    "deliverables": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("invoice_id", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)], name="invoice_created_id"),
+    ],
+    "user_stats": [
+        IndexModel([("user_id", ASCENDING)], name="user_unique", unique=True),
+    ],
+    "email_outbox": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("idempotency_key", ASCENDING)], name="idempotency_key_unique", unique=True),
+        IndexModel([("status", ASCENDING), ("next_attempt_at", ASCENDING)], name="status_next_attempt"),
+        IndexModel([("status", ASCENDING), ("claimed_until", ASCENDING)], name="status_claimed_until"),
+        IndexModel([("claim", ASCENDING)], name="claim"),
+    ],
+    "pdf_branding": [
+        IndexModel([("user_id", ASCENDING)], name="user_unique", unique=True),
+    ],
+    "subscriptions": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("user_id", ASCENDING)], name="user"),
+        IndexModel([("status", ASCENDING), ("end_date", ASCENDING)], name="status_end_date"),
+    ],
+}
+
+# Indexes superseded by a wider key above; dropped if still present
+OBSOLETE_INDEXES = {
+    "clients": ["user_created"],
+    "projects": ["user_created"],
+    "project_logs": ["project_created"],
+    "invoices": ["user_created", "user_status"],
+    "deliverables": ["invoice"],
+}
+
+# (label, collection, filter, sort) for the lookups each route issues.
+# Values are placeholders; only the shape matters to the planner.
+ROUTE_QUERIES = [
+    ("auth.register/login: user by email", "users", {"email": "user@example.com"}, None),
+    ("auth.me: user by id", "users", {"id": "u"}, None),
+    ("clients.list", "clients", {"user_id": "u"}, [("created_at", ASCENDING), ("id", ASCENDING)]),
+    ("clients.get", "clients", {"id": "c", "user_id": "u"}, None),
+    ("clients.import: by email", "clients", {"user_id": "u", "email": {"$in": ["client@example.com"]}}, None),
+    ("projects.list", "projects", {"user_id": "u"}, [("created_at", ASCENDING), ("id", ASCENDING)]),
+    ("projects.get", "projects", {"id": "p", "user_id": "u"}, None),
+    ("projects.logs", "project_logs", {"project_id": "p"}, [("created_at", ASCENDING), ("id", ASCENDING)]),
+    ("invoices.list", "invoices", {"user_id": "u"}, [("created_at", ASCENDING), ("id", ASCENDING)]),
+    ("invoices.get", "invoices", {"id": "i", "user_id": "u"}, None),
+    ("invoices.public", "invoices", {"id": "i"}, None),
+    ("invoices.items", "invoice_items", {"invoice_id": "i"}, None),
+    ("analytics.revenue_trend", "invoices", {"user_id": "u", "status": "paid", **timestamp_range("paid_at", datetime(2024, 1, 1), datetime(2024, 7, 1))}, None),
+    ("payments.by_stripe_session", "payments", {"stripe_session_id": "s"}, None),
+    ("razorpay.by_order", "payments", {"razorpay_order_id": "o"}, None),
+    ("reminders.get", "reminders", {"id": "r"}, None),
+    ("reminders.for_invoice", "reminders", {"invoice_id": "i"}, [("created_at", ASCENDING), ("id", ASCENDING)]),
+    ("scheduler.last_reminders", "reminders", {"invoice_id": {"$in": ["i", "j"]}, "sent_at": {"$ne": None}}, [("invoice_id", ASCENDING), ("sent_at", DESCENDING)]),
+    ("scheduler.clients", "clients", {"id": {"$in": ["c", "d"]}}, None),
+    ("scheduler.users", "users", {"id": {"$in": ["u", "v"]}}, None),
+    ("scheduler.due_invoices", "invoices", {"next_reminder_at": {"$lte": datetime(2024, 1, 1)}, "status": {"$in": ["sent", "viewed", "overdue"]}, "auto_reminders": True}, None),
+    ("reminder_schedule.backfill", "invoices", {"status": {"$in": ["sent", "viewed", "overdue"]}, "auto_reminders": True}, None),
+    ("scheduler.expired_subscriptions", "subscriptions", {"status": "active", **timestamp_range("end_date", end=datetime(2024, 1, 1))}, [("end_date", ASCENDING)]),
+    ("scheduler.renewed_subscriptions", "subscriptions", {"user_id": {"$in": ["u", "v"]}, "status": "active", **timestamp_range("end_date", start=datetime(2024, 1, 1))}, None),
+    ("deliverables.for_invoice", "deliverables", {"invoice_id": "i"}, [("created_at", ASCENDING), ("id", ASCENDING)]),
+    ("admin.subscription", "subscriptions", {"user_id": "u"}, None),
+    ("analytics.dashboard_rollup", "user_stats", {"user_id": "u"}, None),
+    ("analytics.dashboard_due_today", "invoices", {"user_id": "u", "status": {"$in": ["sent", "viewed"]}, **timestamp_range("due_date", datetime(2024, 1, 1), datetime(2024, 1, 1, 12))}, None),
+    ("email_outbox.due", "email_outbox", {"status": "pending", "next_attempt_at": {"$lte": datetime(2024, 1, 1)}}, [("next_attempt_at", ASCENDING)]),
+    ("email_outbox.claimed", "email_outbox", {"claim": "c"}, None),
+    ("pdf_branding.for_user", "pdf_branding", {"user_id": "u"}, None),
+    ("invoices.export_pdf", "invoices", {"user_id": "u", **timestamp_range("created_at", datetime(2024, 7, 1), datetime(2024, 10, 1)), "status": {"$in": ["sent", "paid"]}}, [("created_at", ASCENDING), ("id", ASCENDING)]),
+]
+
+async def ensure_indexes():
+    """Create every registered index. Safe to call on each startup."""
+    incomplete = set()
+    for collection_name, models in INDEXES.items():
+        collection = db[collection_name]
+        for model in models:
+            try:
+                await collection.create_indexes([model])
+            except OperationFailure as e:
+                # Keep going: one conflicting index (e.g. duplicate data under a
+                # new unique constraint) must not block the rest or the app.
+                logger.error(f"Could not create index {collection_name}.{model.document['name']}: {e}")
+                incomplete.add(collection_name)
+
+    # Only once their replacements exist, so queries are never left without one
+    for collection_name, names in OBSOLETE_INDEXES.items():
+        if collection_name in incomplete:
+            logger.warning(f"Keeping superseded {collection_name} indexes {names}: a replacement failed to build")
+            continue
+        existing = await db[collection_name].index_information()
+        for name in names:
+            if name not in existing:
+                continue
+            try:
+                await db[collection_name].drop_index(name)
+                logger.info(f"Dropped superseded index {collection_name}.{name}")
+            except OperationFailure as e:
+                # Another worker starting at the same time may have dropped it first
+                logger.info(f"Superseded index {collection_name}.{name} not dropped: {e}")
+    logger.info("Database indexes ensured")
+
+def _plan_stages(plan):
+    """Yield every stage name in an explain() plan tree"""
+    if not isinstance(plan, dict):
+        return
+    if "stage" in plan:
+        yield plan["stage"]
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            yield from _plan_stages(plan[key])
+    for child in plan.get("inputStages", []):
+        yield from _plan_stages(child)
+
+async def explain_route_queries():
+    """Run explain() on each route query and return a report row per query"""
+    report = []
+    for label, collection_name, query, sort in ROUTE_QUERIES:
+        cursor = db[collection_name].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explanation = await cursor.explain()
+        winning_plan = explanation.get("queryPlanner", {}).get("winningPlan", {})
+        stages = list(_plan_stages(winning_plan))
+        report.append({
+            "label": label,
+            "collection": collection_name,
+            "stages": stages,
+            "collscan": "COLLSCAN" in stages,
+        })
+    return report
+
+async def _main(argv):
+    parser = argparse.ArgumentParser(description="Provision and audit MongoDB indexes")
+    parser.add_argument("--explain", action="store_true", help="report route queries that still COLLSCAN")
+    args = parser.parse_args(argv)
+
+    await ensure_indexes()
+    if not args.explain:
+        return 0
+
+    report = await explain_route_queries()
+    for row in report:
+        marker = "COLLSCAN" if row["collscan"] else "ok"
+        print(f"{marker:9} {row['label']:40} {' <- '.join(row['stages'])}")
+    collscans = [row for row in report if row["collscan"]]
+    print(f"\n{len(collscans)} of {len(report)} route queries use a collection scan")
+    return 1 if collscans else 0
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    sys.exit(asyncio.run(_main(sys.argv[1:])))
@@ -1,6 +1,27 @@
 from datetime import datetime, timezone
-from typing import List
-from models import InvoiceItemCreate
+from typing import List, Optional, Tuple, Union
+from pymongo import ReturnDocument
+from models import InvoiceItemCreate, InvoiceCreate
+from database import users_collection, invoice_items_collection
+from utils.dates import utc_now, parse_timestamp
+from utils.sequences import invoice_sequences
+from utils.pdf_cache import ItemsDigest, PDF_ITEM_PROJECTION, PDF_ITEMS_BATCH_SIZE
+import uuid
+import os
+
+SUBSCRIPTION_LIMITS = {
+    "free": 3,
+    "pro": float("inf"),
+    "agency": float("inf")
+}
+DEFAULT_INVOICE_LIMIT = 3
+
+# Store line items inside the invoice document instead of invoice_items
+EMBED_INVOICE_ITEMS = os.getenv("EMBED_INVOICE_ITEMS", "false").lower() == "true"
+
+# Users can override both with invoice_prefix / invoice_number_format
+INVOICE_NUMBER_PREFIX = os.getenv("INVOICE_NUMBER_PREFIX", "INV")
+INVOICE_NUMBER_FORMAT = os.getenv("INVOICE_NUMBER_FORMAT", "{prefix}-{seq:05d}")
 
 def calculate_invoice_totals(
     items: List[InvoiceItemCreate],
@@ -9,7 +30,7 @@ def calculate_invoice_totals(
     discount_value: float,
     late_fee_enabled: bool,
     late_fee_percentage: float,
-    due_date: str
+    due_date: Union[str, datetime]
 ) -> dict:
     # Calculate subtotal
     subtotal = sum(item.quantity * item.rate for item in items)
@@ -28,7 +49,7 @@ def calculate_invoice_totals(
     # Calculate late fee if applicable
     late_fee_amount = 0.0
     if late_fee_enabled:
-        due_date_obj = datetime.fromisoformat(due_date.replace('Z', '+00:00'))
+        due_date_obj = parse_timestamp(due_date)
         now = datetime.now(timezone.utc)
         if now > due_date_obj:
             late_fee_amount = (subtotal - discount_amount) * (late_fee_percentage / 100)
@@ -44,6 +65,168 @@ def calculate_invoice_totals(
         "total_amount": round(total_amount, 2)
     }
 
-def generate_invoice_number() -> str:
-    timestamp = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S")
-    return f"INV-{timestamp}"
+def format_invoice_number(number_format: str, prefix: str, seq: int, now: Optional[datetime] = None) -> str:
+    """Render an invoice number; placeholders: prefix, seq, year, month, day, date"""
+    now = now or datetime.now(timezone.utc)
+    return number_format.format(
+        prefix=prefix,
+        seq=seq,
+        year=now.strftime("%Y"),
+        month=now.strftime("%m"),
+        day=now.strftime("%d"),
+        date=now.strftime("%Y%m%d")
+    )
+
+def invoice_sequence_key(user_id: str) -> str:
+    """Counter id of a user's invoice number sequence"""
+    return f"invoice_number:{user_id}"
+
+def _number_style(user: dict):
+    return (
+        user.get("invoice_number_format") or INVOICE_NUMBER_FORMAT,
+        user.get("invoice_prefix") or INVOICE_NUMBER_PREFIX
+    )
+
+async def generate_invoice_number(user: dict) -> str:
+    """Next number from the user's own atomic sequence"""
+    seq = await invoice_sequences.next(invoice_sequence_key(user["id"]))
+    number_format, prefix = _number_style(user)
+    return format_invoice_number(number_format, prefix, seq)
+
+async def generate_invoice_numbers(user: dict, count: int) -> List[str]:
+    """``count`` consecutive numbers with a single counter update (bulk imports)"""
+    first = await invoice_sequences.take(invoice_sequence_key(user["id"]), count)
+    number_format, prefix = _number_style(user)
+    now = datetime.now(timezone.utc)
+    return [format_invoice_number(number_format, prefix, seq, now) for seq in range(first, first + count)]
+
+def _within_limit(count: int) -> dict:
+    """Filter matching users who can create ``count`` more invoices on their plan"""
+    def room_for(limit):
+        return {"$or": [
+            {"invoice_count": {"$lte": limit - count}},
+            {"invoice_count": {"$exists": False}}
+        ]}
+
+    unlimited = [plan for plan, limit in SUBSCRIPTION_LIMITS.items() if limit == float("inf")]
+    branches = [{"subscription_plan": {"$in": unlimited}}]
+    for plan, limit in SUBSCRIPTION_LIMITS.items():
+        if limit != float("inf"):
+            branches.append({"subscription_plan": plan, **room_for(limit)})
+    branches.append({"subscription_plan": {"$nin": list(SUBSCRIPTION_LIMITS)}, **room_for(DEFAULT_INVOICE_LIMIT)})
+    return {"$or": branches}
+
+async def reserve_invoice_quota(user_id: str, count: int = 1) -> Optional[dict]:
+    """Atomically check the plan limit and bump invoice_count by ``count``.
+
+    Returns the updated user, or None when the user is missing or over the
+    limit; concurrent creates can never push a plan past its limit.
+    """
+    return await users_collection.find_one_and_update(
+        {"id": user_id, **_within_limit(count)},
+        {"$inc": {"invoice_count": count}},
+        projection={"_id": 0, "password_hash": 0},
+        return_document=ReturnDocument.AFTER
+    )
+
+async def reserve_available_quota(user_id: str, count: int) -> Tuple[Optional[dict], int]:
+    """Reserve as much of ``count`` as the plan still allows.
+
+    Returns (updated user, number reserved), or (None, 0) when nothing fits.
+    Each retry follows a concurrent change and asks for strictly less.
+    """
+    while count > 0:
+        user = await reserve_invoice_quota(user_id, count)
+        if user:
+            return user, count
+        current = await users_collection.find_one({"id": user_id}, {"_id": 0, "subscription_plan": 1, "invoice_count": 1})
+        if not current:
+            break
+        limit = SUBSCRIPTION_LIMITS.get(current.get("subscription_plan"), DEFAULT_INVOICE_LIMIT)
+        if limit == float("inf"):
+            # Upgraded since the update; int() of an infinite room would raise
+            count -= 1
+        else:
+            count = min(count - 1, int(limit - current.get("invoice_count", 0)))
+    return None, 0
+
+async def release_invoice_quota(user_id: str, count: int = 1):
+    """Give back quota reserved for invoices that were never written"""
+    await users_collection.update_one({"id": user_id}, {"$inc": {"invoice_count": -count}})
+
+def build_invoice_doc(user_id: str, invoice_data: InvoiceCreate, invoice_number: str, due_date: datetime) -> dict:
+    """New invoice document with totals computed from its items"""
+    totals = calculate_invoice_totals(
+        invoice_data.items,
+        invoice_data.tax_percentage,
+        invoice_data.discount_type,
+        invoice_data.discount_value,
+        invoice_data.late_fee_enabled,
+        invoice_data.late_fee_percentage,
+        due_date
+    )
+    
+    # Get exchange rate (default to 1 for same currency)
+    exchange_rate = 1.0
+    
+    return {
+        "id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "client_id": invoice_data.client_id,
+        "project_id": invoice_data.project_id,
+        "invoice_number": invoice_number,
+        "subtotal": totals["subtotal"],
+        "tax_amount": totals["tax_amount"],
+        "tax_percentage": invoice_data.tax_percentage,
+        "discount_amount": totals["discount_amount"],
+        "discount_type": invoice_data.discount_type,
+        "discount_value": invoice_data.discount_value,
+        "late_fee_amount": totals["late_fee_amount"],
+        "late_fee_enabled": invoice_data.late_fee_enabled,
+        "late_fee_percentage": invoice_data.late_fee_percentage,
+        "late_fee_days": invoice_data.late_fee_days,
+        "total_amount": totals["total_amount"],
+        "currency": invoice_data.currency,
+        "exchange_rate": exchange_rate,
+        "due_date": due_date,
+        "status": "draft",
+        "auto_reminders": invoice_data.auto_reminders,
+        "created_at": utc_now(),
+        "sent_at": None,
+        "paid_at": None,
+        "next_reminder_at": None,
+        "next_reminder_type": None
+    }
+
+def build_invoice_items(invoice_id: str, items: List[InvoiceItemCreate]) -> List[dict]:
+    return [
+        {
+            "id": str(uuid.uuid4()),
+            "invoice_id": invoice_id,
+            "description": item.description,
+            "quantity": item.quantity,
+            "rate": item.rate,
+            "amount": round(item.quantity * item.rate, 2)
+        }
+        for item in items
+    ]
+
+async def fetch_invoice_items(invoice: dict) -> List[dict]:
+    """Line items of an invoice, whether embedded or in invoice_items"""
+    if "items" in invoice:
+        return invoice["items"]
+    return await invoice_items_collection.find({"invoice_id": invoice["id"]}, {"_id": 0}).to_list(None)
+
+async def invoice_items_digest(invoice: dict) -> str:
+    """Digest of an invoice's line items for the PDF cache key, read a batch at a time"""
+    digest = ItemsDigest()
+    if "items" in invoice:
+        digest.update(invoice["items"])
+        return digest.hexdigest()
+    cursor = invoice_items_collection.find({"invoice_id": invoice["id"]}, PDF_ITEM_PROJECTION) \
+        .batch_size(PDF_ITEMS_BATCH_SIZE)
+    while True:
+        items = await cursor.to_list(PDF_ITEMS_BATCH_SIZE)
+        if not items:
+            return digest.hexdigest()
+        digest.update(items)
@@ -0,0 +1,145 @@
+"""
+MongoDB leases so each scheduled job runs in exactly one process.
+
+Every worker's scheduler fires, but a run only proceeds in the process that
+holds the job's lease document in ``job_leases``. The holder renews it with
+a heartbeat every third of the TTL. If the heartbeat cannot renew, the run is
+cancelled, because another process may already have taken over. A crashed
+holder simply stops renewing. Once its lease expires, a waiting process
+picks the job up and reruns it unless the run was recorded as completed.
+"""
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from database import job_leases_collection
+from utils.dates import utc_now
+from datetime import timedelta
+from typing import Awaitable, Callable, Dict
+import asyncio
+import logging
+import os
+import socket
+import uuid
+import zlib
+
+logger = logging.getLogger(__name__)
+
+LEASE_TTL_SECONDS = float(os.getenv("LEASE_TTL_SECONDS", "60"))
+# How long other processes keep waiting to take over an unfinished run
+FAILOVER_WINDOW_SECONDS = float(os.getenv("FAILOVER_WINDOW_SECONDS", "3600"))
+
+OWNER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+class Lease:
+    def __init__(self, name: str, ttl: float = LEASE_TTL_SECONDS, owner: str = OWNER_ID):
+        self.name = name
+        self.ttl = ttl
+        self.owner = owner
+        self.held = False
+        self.completed_run = None
+
+    async def acquire(self) -> bool:
+        """Take the lease if it is free, expired or already ours"""
+        now = utc_now()
+        try:
+            lease = await job_leases_collection.find_one_and_update(
+                {"_id": self.name, "$or": [{"expires_at": {"$lte": now}}, {"owner": self.owner}]},
+                {"$set": {"owner": self.owner, "expires_at": now + timedelta(seconds=self.ttl), "acquired_at": now}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # The document exists and someone else holds it
+            return False
+        self.held = True
+        self.completed_run = lease.get("completed_run")
+        return True
+
+    async def renew(self) -> bool:
+        result = await job_leases_collection.update_one(
+            {"_id": self.name, "owner": self.owner},
+            {"$set": {"expires_at": utc_now() + timedelta(seconds=self.ttl)}}
+        )
+        self.held = result.matched_count == 1
+        return self.held
+
+    async def release(self, completed_run: str = None):
+        changes = {"expires_at": utc_now()}
+        if completed_run:
+            changes["completed_run"] = completed_run
+        await job_leases_collection.update_one({"_id": self.name, "owner": self.owner}, {"$set": changes})
+        self.held = False
+
+    async def heartbeat(self, holder: asyncio.Task):
+        """Renew until cancelled; cancel ``holder`` if the lease is lost"""
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                renewed = await self.renew()
+            except Exception as e:
+                logger.error(f"Lease {self.name} heartbeat failed: {e}")
+                renewed = False
+            if not renewed:
+                logger.warning(f"Lost lease {self.name}; stopping the run")
+                holder.cancel()
+                return
+
+async def run_exclusive(name: str, run_key: str, job: Callable[[], Awaitable]) -> str:
+    """Run ``job`` for ``run_key`` if this process can take the lease.
+
+    Returns "completed", "done" (already finished elsewhere), "held" (another
+    process owns it), "lost" (lease lost mid-run) or "failed".
+    """
+    lease = Lease(name)
+    if not await lease.acquire():
+        return "held"
+    if lease.completed_run == run_key:
+        await lease.release()
+        return "done"
+
+    heartbeat = asyncio.create_task(lease.heartbeat(asyncio.current_task()))
+    try:
+        await job()
+    except asyncio.CancelledError:
+        if lease.held:
+            raise
+        asyncio.current_task().uncancel()
+        return "lost"
+    except Exception as e:
+        logger.error(f"Leased job {name} failed: {e}")
+        await lease.release()
+        return "failed"
+    finally:
+        heartbeat.cancel()
+
+    await lease.release(completed_run=run_key)
+    return "completed"
+
+async def run_until_done(jobs: Dict[str, Callable[[], Awaitable]], run_key: str,
+                         window: float = FAILOVER_WINDOW_SECONDS) -> Dict[str, str]:
+    """Work through leased jobs (e.g. shards) until each has completed somewhere.
+
+    Processes start at different jobs (by hash of the owner id) so shards
+    spread across workers. Jobs held by another process are retried once per
+    lease TTL. This is how an unfinished run is taken over after its holder
+    dies.
+    """
+    names = sorted(jobs)
+    start = zlib.crc32(OWNER_ID.encode()) % len(names)
+    pending = names[start:] + names[:start]
+    outcomes = {}
+    deadline = asyncio.get_running_loop().time() + window
+
+    while pending:
+        waiting = []
+        for name in pending:
+            outcome = await run_exclusive(name, run_key, jobs[name])
+            outcomes[name] = outcome
+            if outcome in ("held", "lost"):
+                waiting.append(name)
+        pending = waiting
+        if pending:
+            if asyncio.get_running_loop().time() >= deadline:
+                logger.warning(f"Gave up waiting for {pending} to complete run {run_key}")
+                break
+            await asyncio.sleep(LEASE_TTL_SECONDS)
+    return outcomes
@@ -0,0 +1,115 @@
+"""
+Online migration of ISO-string timestamps to native BSON dates.
+
+Converts documents in small batches while the API keeps serving traffic.
+Every update is guarded on the original string value, so a concurrent write
+always wins, and only string-typed fields are selected, so the command can be
+stopped and re-run at any point:
+
+    python -m utils.migrate_timestamps [--batch-size 500] [--pause 0.05] [--dry-run]
+"""
+from pymongo import UpdateOne
+from database import db
+from utils.dates import parse_timestamp
+import asyncio
+import argparse
+import logging
+import sys
+
+logger = logging.getLogger(__name__)
+
+# collection name -> timestamp fields stored by the routes and scheduler
+TIMESTAMP_FIELDS = {
+    "users": ["created_at"],
+    "clients": ["created_at"],
+    "projects": ["created_at"],
+    "project_logs": ["created_at"],
+    "invoices": ["created_at", "due_date", "sent_at", "paid_at"],
+    "payments": ["created_at", "verified_at", "updated_at"],
+    "reminders": ["created_at", "sent_at"],
+    "deliverables": ["created_at"],
+    "subscriptions": ["created_at", "start_date", "end_date", "cancelled_at"],
+    "user_stats": ["updated_at"],
+}
+
+async def migrate_collection(collection_name: str, fields: list, batch_size: int = 500,
+                             pause: float = 0.0, dry_run: bool = False) -> dict:
+    """Convert string timestamps in one collection; returns counts"""
+    collection = db[collection_name]
+    string_filter = {"$or": [{field: {"$type": "string"}} for field in fields]}
+    projection = {field: 1 for field in fields}
+    counts = {"scanned": 0, "converted": 0, "unparseable": 0}
+    last_id = None
+
+    while True:
+        # Page by _id rather than holding one cursor open for the whole run
+        query = dict(string_filter)
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        batch = await collection.find(query, projection).sort("_id", 1).limit(batch_size).to_list(batch_size)
+        if not batch:
+            break
+        last_id = batch[-1]["_id"]
+
+        operations = []
+        for doc in batch:
+            counts["scanned"] += 1
+            guard = {"_id": doc["_id"]}
+            changes = {}
+            for field in fields:
+                value = doc.get(field)
+                if not isinstance(value, str):
+                    continue
+                try:
+                    parsed = parse_timestamp(value)
+                except ValueError:
+                    counts["unparseable"] += 1
+                    logger.warning(f"{collection_name} {doc['_id']}: cannot parse {field}={value!r}")
+                    continue
+                if parsed is None:
+                    continue
+                guard[field] = value
+                changes[field] = parsed
+            if changes:
+                operations.append(UpdateOne(guard, {"$set": changes}))
+
+        if operations and not dry_run:
+            result = await collection.bulk_write(operations, ordered=False)
+            counts["converted"] += result.modified_count
+        elif operations:
+            counts["converted"] += len(operations)
+
+        if pause:
+            await asyncio.sleep(pause)
+
+    return counts
+
+async def migrate_all(batch_size: int = 500, pause: float = 0.0, dry_run: bool = False) -> dict:
+    summary = {}
+    for collection_name, fields in TIMESTAMP_FIELDS.items():
+        summary[collection_name] = await migrate_collection(collection_name, fields, batch_size, pause, dry_run)
+        logger.info(f"{collection_name}: {summary[collection_name]}")
+    return summary
+
+async def _main(argv):
+    parser = argparse.ArgumentParser(description="Convert ISO-string timestamps to BSON dates")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--pause", type=float, default=0.0, help="seconds to sleep between batches")
+    parser.add_argument("--dry-run", action="store_true", help="count documents without writing")
+    parser.add_argument("--collection", choices=sorted(TIMESTAMP_FIELDS), help="only this collection")
+    args = parser.parse_args(argv)
+
+    if args.collection:
+        counts = await migrate_collection(args.collection, TIMESTAMP_FIELDS[args.collection],
+                                          args.batch_size, args.pause, args.dry_run)
+        summary = {args.collection: counts}
+    else:
+        summary = await migrate_all(args.batch_size, args.pause, args.dry_run)
+
+    for collection_name, counts in summary.items():
+        print(f"{collection_name:15} scanned={counts['scanned']} converted={counts['converted']} unparseable={counts['unparseable']}")
+    return 1 if any(counts["unparseable"] for counts in summary.values()) else 0
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    sys.exit(asyncio.run(_main(sys.argv[1:])))
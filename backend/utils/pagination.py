@@ -0,0 +1,96 @@
+"""
+Keyset pagination and NDJSON streaming for list endpoints.
+
+Lists are ordered by ``(created_at, id)``; the opaque cursor encodes the last
+row of a page, so each page is an index range scan no matter how deep it is.
+The cursor for the next page is returned in the ``X-Next-Cursor`` header,
+which keeps the JSON array response bodies unchanged.
+
+Until the timestamp migration has run, ``created_at`` may still be a legacy
+ISO string. MongoDB sorts strings before dates and compares values of one
+type only, so the cursor keeps the stored type and value. A page that ends on
+a string continues with the later strings and then every date.
+"""
+from fastapi import HTTPException, Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from utils.dates import parse_timestamp
+from datetime import datetime
+from typing import Optional, Tuple, Type, Union
+import base64
+import json
+
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 1000
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+SORT_ORDER = [("created_at", 1), ("id", 1)]
+
+def encode_cursor(doc: dict) -> str:
+    created_at = doc["created_at"]
+    if isinstance(created_at, str):
+        # Legacy string timestamp: kept verbatim so it compares as stored
+        payload = {"c": created_at, "i": doc["id"], "s": True}
+    else:
+        payload = {"c": parse_timestamp(created_at).isoformat(), "i": doc["id"]}
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[Union[datetime, str], str]:
+    """(created_at as stored: a datetime or a legacy string, id)"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if payload.get("s"):
+            if not isinstance(payload["c"], str):
+                raise TypeError("string cursor without a string timestamp")
+            return payload["c"], payload["i"]
+        return parse_timestamp(payload["c"]), payload["i"]
+    except (ValueError, KeyError, TypeError, AttributeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def _after_cursor(query: dict, cursor: Optional[str]) -> dict:
+    if not cursor:
+        return query
+    created_at, last_id = decode_cursor(cursor)
+    after = [
+        {"created_at": {"$gt": created_at}},
+        {"created_at": created_at, "id": {"$gt": last_id}},
+    ]
+    if isinstance(created_at, str):
+        # Dates sort after every string
+        after.append({"created_at": {"$type": "date"}})
+    return {"$and": [query, {"$or": after}]}
+
+async def paginate(collection, query: dict, limit: int, cursor: Optional[str] = None,
+                   projection: Optional[dict] = None) -> Tuple[list, Optional[str]]:
+    """Fetch one page; returns (documents, next_cursor or None)"""
+    projection = projection or {"_id": 0}
+    docs = await collection.find(_after_cursor(query, cursor), projection) \
+        .sort(SORT_ORDER).limit(limit + 1).to_list(limit + 1)
+
+    if len(docs) > limit:
+        docs = docs[:limit]
+        return docs, encode_cursor(docs[-1])
+    return docs, None
+
+def set_next_cursor(response: Response, next_cursor: Optional[str]):
+    if next_cursor:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
+
+def stream_ndjson(collection, query: dict, model: Type[BaseModel], projection: Optional[dict] = None,
+                  filename: str = "export.ndjson") -> StreamingResponse:
+    """Stream every matching document as one JSON line, in list order.
+
+    Documents are pulled from the cursor in driver-sized batches, so the full
+    result set is never held in memory.
+    """
+    projection = projection or {"_id": 0}
+
+    async def lines():
+        async for doc in collection.find(query, projection).sort(SORT_ORDER):
+            yield model(**doc).model_dump_json() + "\n"
+
+    return StreamingResponse(
+        lines(),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
@@ -0,0 +1,39 @@
+"""
+Per-user invoice PDF branding.
+
+One ``pdf_branding`` record per user holds the title, colours, font, footer
+and logo used for that user's PDFs. Every save gets a new ``version``, the
+key under which worker processes cache the compiled template
+(``pdf_generator.template_for``) and part of the PDF cache key.
+"""
+from database import pdf_branding_collection
+from reportlab.lib.utils import ImageReader
+from io import BytesIO
+from typing import Optional
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+BRANDING_LOGO_MAX_BYTES = int(os.getenv("BRANDING_LOGO_MAX_BYTES", str(512 * 1024)))
+BRANDING_LOGO_TYPES = ["image/png", "image/jpeg"]
+
+async def fetch_branding(user_id: str) -> Optional[dict]:
+    """A user's branding record, logo included, or None for the default look"""
+    return await pdf_branding_collection.find_one({"user_id": user_id}, {"_id": 0})
+
+def branding_view(branding: Optional[dict]) -> dict:
+    """Branding as returned by the API: the logo is reported, not sent"""
+    branding = dict(branding or {})
+    logo = branding.pop("logo", None)
+    branding["has_logo"] = bool(logo)
+    return branding
+
+def is_valid_logo(content: bytes) -> bool:
+    """Whether the bytes decode as an image ReportLab can place"""
+    try:
+        width, height = ImageReader(BytesIO(content)).getSize()
+    except Exception as e:
+        logger.info(f"Rejected branding logo: {e}")
+        return False
+    return width > 0 and height > 0
@@ -0,0 +1,224 @@
+"""
+Content-addressed disk cache for invoice PDFs.
+
+A PDF is keyed by a SHA-256 of exactly the inputs ``generate_invoice_pdf``
+reads (selected invoice fields, items, client, company), the owner's branding
+version and ``PDF_RENDER_VERSION``. Items enter as an ``ItemsDigest``, fed a
+batch at a time, so hashing a 100k-item invoice never holds all of it. Any change to those inputs therefore yields a new key
+and stale entries are never served. Unrelated updates such as reminder
+bookkeeping keep the key. The key doubles as the strong ETag, so a repeat
+download with a matching ``If-None-Match`` costs only the hash.
+
+Files live in ``PDF_CACHE_DIR``. The least recently used ones are evicted
+once the directory exceeds ``PDF_CACHE_MAX_BYTES`` (0 disables the cache).
+Several workers may share the directory: writes are atomic renames, a file
+evicted by another process is simply a miss, and each worker re-reads the
+directory every ``PDF_CACHE_RESCAN_SECONDS`` so the limit also counts files
+the others wrote. Recency is the file mtime, shared by all of them.
+"""
+from collections import OrderedDict
+from pathlib import Path
+from typing import Awaitable, Callable, Iterable, Optional
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+PDF_CACHE_DIR = Path(os.getenv("PDF_CACHE_DIR", os.path.join(tempfile.gettempdir(), "clientnudge-pdf-cache")))
+PDF_CACHE_MAX_BYTES = int(os.getenv("PDF_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+# How often each worker re-reads the shared directory; between scans it can
+# overshoot the limit by what the other workers wrote
+PDF_CACHE_RESCAN_SECONDS = float(os.getenv("PDF_CACHE_RESCAN_SECONDS", "60"))
+# Bump when the PDF layout changes so cached renders are not reused
+PDF_RENDER_VERSION = "3"
+
+PDF_INVOICE_FIELDS = (
+    "invoice_number", "status", "created_at", "due_date", "currency", "subtotal",
+    "discount_amount", "discount_value", "discount_type", "tax_amount", "tax_percentage",
+    "late_fee_amount", "total_amount",
+)
+PDF_ITEM_FIELDS = ("description", "quantity", "rate", "amount")
+PDF_ITEM_PROJECTION = {"_id": 0, **{field: 1 for field in PDF_ITEM_FIELDS}}
+# Item documents read per round trip when hashing or rendering items
+PDF_ITEMS_BATCH_SIZE = int(os.getenv("PDF_ITEMS_BATCH_SIZE", "1000"))
+PDF_CLIENT_FIELDS = ("name", "company", "email", "phone")
+
+class ItemsDigest:
+    """Running SHA-256 of an invoice's line items, in order"""
+
+    def __init__(self):
+        self._hash = hashlib.sha256()
+
+    def update(self, items: Iterable[dict]):
+        for item in items:
+            row = [item.get(field) for field in PDF_ITEM_FIELDS]
+            self._hash.update(json.dumps(row, separators=(",", ":"), default=str).encode())
+            self._hash.update(b"\n")
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+def pdf_cache_key(invoice: dict, items_digest: str, client: dict, company: dict, branding: Optional[dict] = None) -> str:
+    """Hash of everything that ends up in the PDF"""
+    inputs = {
+        "version": PDF_RENDER_VERSION,
+        "invoice": {field: invoice.get(field) for field in PDF_INVOICE_FIELDS},
+        "items": items_digest,
+        "client": {field: client.get(field) for field in PDF_CLIENT_FIELDS},
+        "company": company,
+        "branding": branding and [branding["user_id"], branding["version"]],
+    }
+    encoded = json.dumps(inputs, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match check (weak comparison, as RFC 9110 specifies for it)"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+class PdfCache:
+    def __init__(self, directory: Path = PDF_CACHE_DIR, max_bytes: int = PDF_CACHE_MAX_BYTES,
+                 rescan_seconds: float = PDF_CACHE_RESCAN_SECONDS):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.rescan_seconds = rescan_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._index = None
+        self._size = 0
+        self._scanned_at = 0.0
+        self._scan_lock = asyncio.Lock()
+        self._in_flight = {}
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.pdf"
+
+    def _scan(self) -> OrderedDict:
+        """Files already on disk, least recently used first"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        entries = []
+        for path in self.directory.glob("*.pdf"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, path.stem, stat.st_size))
+        return OrderedDict((key, size) for _, key, size in sorted(entries))
+
+    def _read_file(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            pdf = path.read_bytes()
+            # mtime records recency for other processes and restarts
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return pdf
+
+    def _write_file(self, key: str, pdf: bytes):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(pdf)
+        os.replace(tmp, self._path(key))
+
+    def _delete_files(self, keys: list):
+        for key in keys:
+            try:
+                self._path(key).unlink()
+            except FileNotFoundError:
+                pass
+
+    # The index is only touched on the event loop; file I/O runs in threads
+
+    def _track(self, key: str, size: int):
+        self._forget(key)
+        self._index[key] = size
+        self._size += size
+
+    def _forget(self, key: str):
+        size = self._index.pop(key, None)
+        if size is not None:
+            self._size -= size
+
+    def _evict(self) -> list:
+        evicted = []
+        while self._size > self.max_bytes and self._index:
+            key, size = self._index.popitem(last=False)
+            self._size -= size
+            evicted.append(key)
+        self.evictions += len(evicted)
+        return evicted
+
+    def _scan_due(self) -> bool:
+        return self._index is None or time.monotonic() - self._scanned_at >= self.rescan_seconds
+
+    async def _rescan(self):
+        """Rebuild the index from the directory, including other workers' files, and trim it"""
+        async with self._scan_lock:
+            if not self._scan_due():
+                return
+            index = await asyncio.to_thread(self._scan)
+            self._index, self._size = index, sum(index.values())
+            self._scanned_at = time.monotonic()
+            evicted = self._evict()
+        if evicted:
+            await asyncio.to_thread(self._delete_files, evicted)
+
+    async def get_or_render(self, key: str, render: Callable[[], Awaitable[bytes]]) -> bytes:
+        """Cached PDF for ``key``, rendering and storing it on a miss"""
+        if self.max_bytes <= 0:
+            return await render()
+        if self._scan_due():
+            await self._rescan()
+
+        pdf = await asyncio.to_thread(self._read_file, key)
+        if pdf is not None:
+            self.hits += 1
+            self._track(key, len(pdf))
+            return pdf
+        self.misses += 1
+        self._forget(key)
+
+        # Concurrent misses for one PDF share a single render
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._render_and_store(key, render))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _render_and_store(self, key: str, render: Callable[[], Awaitable[bytes]]) -> bytes:
+        pdf = await render()
+        try:
+            await asyncio.to_thread(self._write_file, key, pdf)
+        except OSError as e:
+            logger.error(f"Could not cache PDF {key}: {e}")
+            return pdf
+        self._track(key, len(pdf))
+        evicted = self._evict()
+        if evicted:
+            await asyncio.to_thread(self._delete_files, evicted)
+        return pdf
+
+    def metrics(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": len(self._index or ()),
+            "bytes": self._size,
+            "max_bytes": self.max_bytes,
+        }
+
+pdf_cache = PdfCache()
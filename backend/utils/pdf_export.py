@@ -0,0 +1,125 @@
+"""
+Streaming ZIP export of invoice PDFs.
+
+The archive is written by ``zipfile`` into a sink that cannot seek. Each
+entry therefore carries a data descriptor and its bytes can be sent as soon
+as it is added. Invoices are read from a cursor in batches. Up to
+``PDF_EXPORT_CONCURRENCY`` PDFs render in the PDF pool at once, and entries
+are added in invoice order. Memory stays flat however many invoices match:
+one batch of invoice documents, the renders in flight and the archive's
+central directory. PDFs already in the PDF cache are not rendered again.
+"""
+from database import invoices_collection, clients_collection, users_collection
+from utils.invoice_helpers import invoice_items_digest
+from utils.pagination import SORT_ORDER
+from utils.pdf_branding import fetch_branding
+from utils.pdf_cache import pdf_cache, pdf_cache_key
+from utils.pdf_pool import pdf_pool, PDF_WORKERS
+from collections import deque
+from typing import AsyncIterator, Optional
+import asyncio
+import logging
+import os
+import re
+import zipfile
+
+logger = logging.getLogger(__name__)
+
+# PDFs rendered at once per export, and invoices read per batch
+PDF_EXPORT_CONCURRENCY = max(1, int(os.getenv("PDF_EXPORT_CONCURRENCY", str(PDF_WORKERS))))
+PDF_EXPORT_BATCH_SIZE = int(os.getenv("PDF_EXPORT_BATCH_SIZE", "100"))
+
+class _ZipSink:
+    """Write-only stream that holds what zipfile writes until it is drained.
+
+    It has no ``tell`` or ``seek``, so zipfile streams entries instead of
+    going back to patch their headers.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def _entry_name(invoice: dict, used: set) -> str:
+    name = f"invoice_{re.sub(r'[^A-Za-z0-9._-]', '_', invoice['invoice_number'])}.pdf"
+    if name in used:
+        name = f"{name[:-4]}_{invoice['id']}.pdf"
+    used.add(name)
+    return name
+
+async def _render(invoice: dict, client: Optional[dict], company: dict, branding: Optional[dict]) -> bytes:
+    if not client:
+        raise LookupError("client not found")
+    key = pdf_cache_key(invoice, await invoice_items_digest(invoice), client, company, branding)
+    return await pdf_cache.get_or_render(key, lambda: pdf_pool.render(invoice, client, company, branding, wait=True))
+
+async def export_invoice_pdfs(user_id: str, query: dict) -> AsyncIterator[bytes]:
+    """ZIP archive bytes, piece by piece, of the PDFs of the matching invoices"""
+    user = await users_collection.find_one({"id": user_id}, {"_id": 0, "full_name": 1, "email": 1})
+    company = {"name": user.get("full_name", ""), "email": user.get("email", "")}
+    branding = await fetch_branding(user_id)
+
+    sink = _ZipSink()
+    # PDFs are compressed internally; deflating them again costs CPU for little gain
+    archive = zipfile.ZipFile(sink, "w", zipfile.ZIP_STORED)
+    pending = deque()
+    used_names = set()
+    failures = []
+
+    async def add_next() -> bytes:
+        invoice, task = pending.popleft()
+        try:
+            pdf = await task
+        except Exception as e:
+            logger.error(f"PDF export of invoice {invoice['id']} failed: {e}")
+            failures.append(f"{invoice['invoice_number']}: {e}")
+            return b""
+        archive.writestr(_entry_name(invoice, used_names), pdf)
+        return sink.drain()
+
+    cursor = invoices_collection.find({**query, "user_id": user_id}, {"_id": 0}) \
+        .sort(SORT_ORDER).batch_size(PDF_EXPORT_BATCH_SIZE)
+    try:
+        while True:
+            invoices = await cursor.to_list(PDF_EXPORT_BATCH_SIZE)
+            if not invoices:
+                break
+            client_ids = list({invoice["client_id"] for invoice in invoices})
+            clients = {
+                client["id"]: client
+                for client in await clients_collection.find({"id": {"$in": client_ids}}, {"_id": 0}).to_list(None)
+            }
+            for invoice in invoices:
+                pending.append((invoice, asyncio.ensure_future(
+                    _render(invoice, clients.get(invoice["client_id"]), company, branding)
+                )))
+                if len(pending) >= PDF_EXPORT_CONCURRENCY:
+                    chunk = await add_next()
+                    if chunk:
+                        yield chunk
+
+        while pending:
+            chunk = await add_next()
+            if chunk:
+                yield chunk
+
+        if failures:
+            archive.writestr("errors.txt", "Invoices that could not be exported:\n" + "\n".join(failures) + "\n")
+        archive.close()
+        yield sink.drain()
+    finally:
+        # The client went away mid-download: stop rendering for it
+        for _, task in pending:
+            task.cancel()
+        await cursor.close()
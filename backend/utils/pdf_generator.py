@@ -1,87 +1,285 @@
+"""
+Invoice PDF rendering.
+
+Layout styles (paragraph styles, table styles, fonts and colours) live in a
+``PdfTemplate``, compiled once and reused for every render. The default
+template is built at import. Users with custom branding (title, colours,
+font, logo, footer) get their own template, compiled on first use and cached
+by ``template_for`` under the branding record's version.
+
+Line items arrive as an iterable of (description, quantity, rate, amount)
+rows and are laid out by ``ItemRowsTable``. At most ``PDF_TABLE_CHUNK_ROWS``
+rows exist as a ReportLab Table at once, and the header repeats on every
+page. Item data is never held in full: what grows with a 100k-item invoice
+is only ReportLab's content for finished pages (a few KB each) until the
+file is written.
+
+Benchmark with:
+
+    python -m utils.pdf_generator bench [--count N]
+    python -m utils.pdf_generator bench-large [--items 10000 50000 100000]
+"""
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import letter, A4
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import inch
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Image
+from reportlab.lib.utils import ImageReader
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Image, Flowable
 from reportlab.lib.enums import TA_CENTER, TA_RIGHT, TA_LEFT
+from collections import OrderedDict
 from datetime import datetime
 from io import BytesIO
+from itertools import islice
+from typing import Iterable, Iterator, Optional, Tuple
+import argparse
 import os
+import sys
+import time
+import tracemalloc
+from xml.sax.saxutils import escape
+from utils.dates import parse_timestamp
+
+DEFAULT_TITLE = "ClientNudge AI"
+DEFAULT_PRIMARY_COLOR = "#4361EE"
+DEFAULT_SECONDARY_COLOR = "#F5F5F5"
+DEFAULT_FOOTER_TEXT = "Thank you for your business!"
+# Standard PDF fonts: no embedding needed -> bold variant
+FONTS = {
+    "Helvetica": "Helvetica-Bold",
+    "Times-Roman": "Times-Bold",
+    "Courier": "Courier-Bold",
+}
+LOGO_MAX_WIDTH = 2 * inch
+LOGO_MAX_HEIGHT = 0.8 * inch
+# Compiled branded templates kept per process
+TEMPLATE_CACHE_SIZE = int(os.getenv("PDF_TEMPLATE_CACHE_SIZE", "256"))
+# Item rows laid out as one ReportLab Table at a time. A little more than a
+# page holds: every page re-lays out its whole chunk
+PDF_TABLE_CHUNK_ROWS = int(os.getenv("PDF_TABLE_CHUNK_ROWS", "60"))
+ITEM_COLUMNS = ['Description', 'Quantity', 'Rate', 'Amount']
+ITEM_COL_WIDTHS = [3*inch, 1*inch, 1.2*inch, 1.2*inch]
+
+class PdfTemplate:
+    """Styles for one look of the invoice, built once and shared by renders"""
+
+    def __init__(self, branding: Optional[dict] = None):
+        branding = branding or {}
+        # Branding text is plain text, but Paragraph parses markup: escape it
+        self.title = escape(branding.get("title") or DEFAULT_TITLE)
+        self.footer_text = escape(branding.get("footer_text") or DEFAULT_FOOTER_TEXT)
+        primary = colors.HexColor(branding.get("primary_color") or DEFAULT_PRIMARY_COLOR)
+        secondary = colors.HexColor(branding.get("secondary_color") or DEFAULT_SECONDARY_COLOR)
+        font = branding.get("font") if branding.get("font") in FONTS else "Helvetica"
+        bold = FONTS[font]
+
+        self.logo = None
+        if branding.get("logo"):
+            # Decoded once to size it; each render wraps the raw bytes
+            logo = bytes(branding["logo"])
+            width, height = ImageReader(BytesIO(logo)).getSize()
+            scale = min(LOGO_MAX_WIDTH / width, LOGO_MAX_HEIGHT / height, 1)
+            self.logo = (logo, width * scale, height * scale)
+
+        styles = getSampleStyleSheet()
 
-def generate_invoice_pdf(invoice_data, items_data, client_data, company_data):
+        self.title_style = ParagraphStyle(
+            'CustomTitle',
+            parent=styles['Heading1'],
+            fontSize=28,
+            textColor=primary,
+            spaceAfter=12,
+            alignment=TA_LEFT,
+            fontName=bold
+        )
+
+        self.heading_style = ParagraphStyle(
+            'CustomHeading',
+            parent=styles['Heading2'],
+            fontSize=16,
+            textColor=primary,
+            spaceAfter=6,
+            fontName=bold
+        )
+
+        self.normal_style = ParagraphStyle(
+            'CustomNormal',
+            parent=styles['Normal'],
+            fontSize=10,
+            spaceAfter=6,
+            fontName=font
+        )
+
+        self.footer_style = ParagraphStyle(
+            'Footer',
+            parent=styles['Normal'],
+            fontSize=10,
+            textColor=colors.grey,
+            alignment=TA_CENTER,
+            fontName=font
+        )
+
+        self.header_table_style = TableStyle([
+            ('FONTNAME', (0, 0), (0, -1), bold),
+            ('FONTNAME', (1, 0), (1, -1), font),
+            ('FONTSIZE', (0, 0), (-1, -1), 11),
+            ('TEXTCOLOR', (0, 0), (0, -1), primary),
+            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+            ('TOPPADDING', (0, 0), (-1, -1), 6),
+            ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
+        ])
+
+        # Indexed by the parity of a chunk's first item, so stripes carry on across chunks
+        self.items_table_styles = tuple(
+            TableStyle([
+                ('BACKGROUND', (0, 0), (-1, 0), primary),
+                ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+                ('ALIGN', (1, 0), (-1, -1), 'RIGHT'),
+                ('FONTNAME', (0, 1), (-1, -1), font),
+                ('FONTNAME', (0, 0), (-1, 0), bold),
+                ('FONTSIZE', (0, 0), (-1, -1), 10),
+                ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+                ('TOPPADDING', (0, 0), (-1, 0), 12),
+                ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
+                ('ROWBACKGROUNDS', (0, 1), (-1, -1), stripes)
+            ])
+            for stripes in ([colors.white, secondary], [secondary, colors.white])
+        )
+
+        self.totals_table_style = TableStyle([
+            ('ALIGN', (0, 0), (-1, -1), 'RIGHT'),
+            ('FONTNAME', (0, 0), (-1, -2), font),
+            ('FONTNAME', (0, -1), (-1, -1), bold),
+            ('FONTSIZE', (0, -1), (-1, -1), 14),
+            ('FONTSIZE', (0, 0), (-1, -2), 10),
+            ('TEXTCOLOR', (0, -1), (-1, -1), primary),
+            ('LINEABOVE', (0, -1), (-1, -1), 2, primary),
+            ('TOPPADDING', (0, -1), (-1, -1), 12),
+        ])
+
+DEFAULT_TEMPLATE = PdfTemplate()
+_templates = OrderedDict()
+
+def template_for(branding: Optional[dict]) -> PdfTemplate:
+    """Compiled template for a branding record, cached under its user and version"""
+    if not branding:
+        return DEFAULT_TEMPLATE
+    key = (branding["user_id"], branding["version"])
+    template = _templates.get(key)
+    if template is None:
+        template = PdfTemplate(branding)
+        _templates[key] = template
+        while len(_templates) > TEMPLATE_CACHE_SIZE:
+            _templates.popitem(last=False)
+    else:
+        _templates.move_to_end(key)
+    return template
+
+class ItemRowsTable(Flowable):
+    """Items table fed from an iterator of rows, built a chunk at a time.
+
+    Each frame gets a Table of the header plus at most ``chunk_rows`` rows,
+    split to the space left. What did not fit, plus the rest of the iterator,
+    becomes a new ItemRowsTable for the next page.
+    """
+
+    def __init__(self, rows: Iterator[list], template: PdfTemplate, chunk_rows: int = PDF_TABLE_CHUNK_ROWS,
+                 pending: list = None, offset: int = 0):
+        super().__init__()
+        self.rows = rows
+        self.template = template
+        self.chunk_rows = max(1, chunk_rows)
+        self.pending = pending or []
+        self.offset = offset
+        self._table = None
+
+    def _fill(self):
+        # One row beyond the chunk tells us whether more follow
+        if self.rows is not None and len(self.pending) <= self.chunk_rows:
+            self.pending.extend(islice(self.rows, self.chunk_rows + 1 - len(self.pending)))
+            if len(self.pending) <= self.chunk_rows:
+                self.rows = None
+
+    def wrap(self, availWidth, availHeight):
+        self._fill()
+        self._table = Table([ITEM_COLUMNS] + self.pending[:self.chunk_rows], colWidths=ITEM_COL_WIDTHS, repeatRows=1)
+        self._table.setStyle(self.template.items_table_styles[self.offset % 2])
+        self.width, self.height = self._table.wrap(availWidth, availHeight)
+        if len(self.pending) > self.chunk_rows:
+            # Rows beyond this chunk: never fits, so the frame always splits it
+            return self.width, max(self.height, availHeight + 1)
+        return self.width, self.height
+
+    def split(self, availWidth, availHeight):
+        self.wrap(availWidth, availHeight)
+        parts = self._table.split(availWidth, availHeight)
+        if not parts:
+            return []
+        placed = parts[0]._nrows - 1
+        rest = ItemRowsTable(self.rows, self.template, self.chunk_rows, self.pending[placed:], self.offset + placed)
+        if not rest.pending and rest.rows is None:
+            return [parts[0]]
+        return [parts[0], rest]
+
+    def draw(self):
+        self._table.drawOn(self.canv, 0, 0)
+
+def item_rows(items: Iterable[dict]) -> Iterator[tuple]:
+    """(description, quantity, rate, amount) rows from item documents"""
+    for item in items:
+        yield item['description'], item['quantity'], item['rate'], item['amount']
+
+def generate_invoice_pdf(invoice_data, items_data, client_data, company_data, template: PdfTemplate = None):
     """
     Generate a professional PDF invoice
-    
+
     Args:
         invoice_data: Invoice details dict
-        items_data: List of invoice items
+        items_data: Iterable of (description, quantity, rate, amount) rows,
+            consumed page by page
         client_data: Client information dict
         company_data: Company/freelancer information dict
-    
+        template: Compiled styles to render with (default branding if None)
+
     Returns:
         BytesIO: PDF file buffer
     """
+    template = template or DEFAULT_TEMPLATE
+    heading_style = template.heading_style
+    normal_style = template.normal_style
+
     buffer = BytesIO()
     doc = SimpleDocTemplate(buffer, pagesize=letter, rightMargin=72, leftMargin=72,
                            topMargin=72, bottomMargin=18)
-    
+
     # Container for PDF elements
     elements = []
-    styles = getSampleStyleSheet()
-    
-    # Custom styles
-    title_style = ParagraphStyle(
-        'CustomTitle',
-        parent=styles['Heading1'],
-        fontSize=28,
-        textColor=colors.HexColor('#4361EE'),
-        spaceAfter=12,
-        alignment=TA_LEFT,
-        fontName='Helvetica-Bold'
-    )
-    
-    heading_style = ParagraphStyle(
-        'CustomHeading',
-        parent=styles['Heading2'],
-        fontSize=16,
-        textColor=colors.HexColor('#4361EE'),
-        spaceAfter=6,
-        fontName='Helvetica-Bold'
-    )
-    
-    normal_style = ParagraphStyle(
-        'CustomNormal',
-        parent=styles['Normal'],
-        fontSize=10,
-        spaceAfter=6
-    )
-    
-    # Header - Company Name and Invoice Title
-    elements.append(Paragraph("ClientNudge AI", title_style))
+
+    # Header - Logo or title, then company name
+    if template.logo:
+        logo, width, height = template.logo
+        logo_image = Image(BytesIO(logo), width=width, height=height)
+        logo_image.hAlign = 'LEFT'
+        elements.append(logo_image)
+        elements.append(Spacer(1, 0.15*inch))
+    else:
+        elements.append(Paragraph(template.title, template.title_style))
     elements.append(Paragraph(company_data.get('name', 'Company Name'), heading_style))
     elements.append(Paragraph(company_data.get('email', ''), normal_style))
     elements.append(Spacer(1, 0.3*inch))
-    
+
     # Invoice Number and Status
     invoice_header_data = [
         ['INVOICE', invoice_data['invoice_number']],
         ['Status', invoice_data['status'].upper()],
-        ['Date', datetime.fromisoformat(invoice_data['created_at'].replace('Z', '+00:00')).strftime('%B %d, %Y')],
-        ['Due Date', datetime.fromisoformat(invoice_data['due_date'].replace('Z', '+00:00')).strftime('%B %d, %Y')]
+        ['Date', parse_timestamp(invoice_data['created_at']).strftime('%B %d, %Y')],
+        ['Due Date', parse_timestamp(invoice_data['due_date']).strftime('%B %d, %Y')]
     ]
-    
+
     invoice_header_table = Table(invoice_header_data, colWidths=[2*inch, 3*inch])
-    invoice_header_table.setStyle(TableStyle([
-        ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, -1), 11),
-        ('TEXTCOLOR', (0, 0), (0, -1), colors.HexColor('#4361EE')),
-        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-        ('TOPPADDING', (0, 0), (-1, -1), 6),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
-    ]))
+    invoice_header_table.setStyle(template.header_table_style)
     elements.append(invoice_header_table)
     elements.append(Spacer(1, 0.3*inch))
-    
+
     # Bill To Section
     elements.append(Paragraph('BILL TO', heading_style))
     elements.append(Paragraph(client_data['name'], normal_style))
@@ -91,93 +289,58 @@ def generate_invoice_pdf(invoice_data, items_data, client_data, company_data):
     if client_data.get('phone'):
         elements.append(Paragraph(client_data['phone'], normal_style))
     elements.append(Spacer(1, 0.3*inch))
-    
+
     # Invoice Items Table
     elements.append(Paragraph('ITEMS', heading_style))
     elements.append(Spacer(1, 0.1*inch))
-    
+
     currency_symbol = get_currency_symbol(invoice_data['currency'])
-    
-    # Table header
-    items_table_data = [['Description', 'Quantity', 'Rate', 'Amount']]
-    
-    # Table rows
-    for item in items_data:
-        items_table_data.append([
-            item['description'],
-            str(item['quantity']),
-            f"{currency_symbol}{item['rate']:.2f}",
-            f"{currency_symbol}{item['amount']:.2f}"
-        ])
-    
-    items_table = Table(items_table_data, colWidths=[3*inch, 1*inch, 1.2*inch, 1.2*inch])
-    items_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#4361EE')),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-        ('ALIGN', (1, 0), (-1, -1), 'RIGHT'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, -1), 10),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-        ('TOPPADDING', (0, 0), (-1, 0), 12),
-        ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
-        ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#F5F5F5')])
-    ]))
-    elements.append(items_table)
+
+    # Table rows, formatted as the table reaches them
+    rows = (
+        [description, str(quantity), f"{currency_symbol}{rate:.2f}", f"{currency_symbol}{amount:.2f}"]
+        for description, quantity, rate, amount in items_data
+    )
+    elements.append(ItemRowsTable(rows, template))
     elements.append(Spacer(1, 0.3*inch))
-    
+
     # Totals Section
     totals_data = [
         ['Subtotal:', f"{currency_symbol}{invoice_data['subtotal']:.2f}"]
     ]
-    
+
     if invoice_data['discount_amount'] > 0:
         discount_label = f"Discount ({invoice_data['discount_value']}{'%' if invoice_data['discount_type'] == 'percentage' else ' ' + invoice_data['currency']}):"
         totals_data.append([discount_label, f"-{currency_symbol}{invoice_data['discount_amount']:.2f}"])
-    
+
     if invoice_data['tax_amount'] > 0:
         totals_data.append([f"Tax ({invoice_data['tax_percentage']}%):", f"{currency_symbol}{invoice_data['tax_amount']:.2f}"])
-    
+
     if invoice_data['late_fee_amount'] > 0:
         totals_data.append(['Late Fee:', f"{currency_symbol}{invoice_data['late_fee_amount']:.2f}"])
-    
+
     totals_data.append(['', ''])  # Spacer
     totals_data.append(['TOTAL DUE:', f"{currency_symbol}{invoice_data['total_amount']:.2f}"])
-    
+
     totals_table = Table(totals_data, colWidths=[4.4*inch, 1.8*inch])
-    totals_table.setStyle(TableStyle([
-        ('ALIGN', (0, 0), (-1, -1), 'RIGHT'),
-        ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, -1), (-1, -1), 14),
-        ('FONTSIZE', (0, 0), (-1, -2), 10),
-        ('TEXTCOLOR', (0, -1), (-1, -1), colors.HexColor('#4361EE')),
-        ('LINEABOVE', (0, -1), (-1, -1), 2, colors.HexColor('#4361EE')),
-        ('TOPPADDING', (0, -1), (-1, -1), 12),
-    ]))
+    totals_table.setStyle(template.totals_table_style)
     elements.append(totals_table)
     elements.append(Spacer(1, 0.5*inch))
-    
+
     # Payment Instructions
     elements.append(Paragraph('PAYMENT INSTRUCTIONS', heading_style))
-    payment_text = f"""Please make payment before the due date to avoid late fees. 
+    payment_text = f"""Please make payment before the due date to avoid late fees.
     You can pay securely online through our client portal using the invoice link provided in your email.
-    
+
     For questions about this invoice, please contact {company_data.get('email', '')}."""
     elements.append(Paragraph(payment_text, normal_style))
     elements.append(Spacer(1, 0.3*inch))
-    
+
     # Footer
-    footer_text = "Thank you for your business!"
-    footer_style = ParagraphStyle(
-        'Footer',
-        parent=styles['Normal'],
-        fontSize=10,
-        textColor=colors.grey,
-        alignment=TA_CENTER
-    )
     elements.append(Spacer(1, 0.5*inch))
-    elements.append(Paragraph(footer_text, footer_style))
-    elements.append(Paragraph("Generated by ClientNudge AI", footer_style))
-    
+    elements.append(Paragraph(template.footer_text, template.footer_style))
+    elements.append(Paragraph("Generated by ClientNudge AI", template.footer_style))
+
     # Build PDF
     doc.build(elements)
     buffer.seek(0)
@@ -194,3 +357,70 @@ def get_currency_symbol(code):
         'CAD': 'C$'
     }
     return symbols.get(code, '$')
+
+def _sample_rows(item_count: int) -> Iterator[tuple]:
+    return ((f"Consulting, day {i + 1}", 1, 10.0, 10.0) for i in range(item_count))
+
+def _sample_invoice(item_count: int):
+    invoice = {
+        "invoice_number": "INV-00042", "status": "sent", "currency": "USD",
+        "created_at": "2026-01-01T00:00:00+00:00", "due_date": "2026-01-31T00:00:00+00:00",
+        "subtotal": 10.0 * item_count, "discount_amount": 0, "discount_value": 0, "discount_type": "percentage",
+        "tax_amount": 0, "tax_percentage": 0, "late_fee_amount": 0, "total_amount": 10.0 * item_count,
+    }
+    items = list(_sample_rows(item_count))
+    client = {"name": "Acme Corp", "email": "billing@acme.example"}
+    company = {"name": "Ada Lovelace", "email": "ada@example.com"}
+    return invoice, items, client, company
+
+def _bench(count: int, item_count: int) -> dict:
+    """Seconds per render with a template compiled per call vs reused"""
+    invoice, items, client, company = _sample_invoice(item_count)
+    branding = {"user_id": "bench", "version": "1", "primary_color": "#0F766E", "footer_text": "Thanks!"}
+    results = {}
+    for label, template in (("compiled per render", lambda: PdfTemplate(branding)),
+                            ("cached template", lambda: template_for(branding))):
+        started = time.perf_counter()
+        for _ in range(count):
+            generate_invoice_pdf(invoice, items, client, company, template())
+        results[label] = (time.perf_counter() - started) / count
+    started = time.perf_counter()
+    for _ in range(count):
+        PdfTemplate(branding)
+    results["template compile only"] = (time.perf_counter() - started) / count
+    return results
+
+def _bench_large(item_count: int) -> Tuple[float, int, int]:
+    """Seconds, peak traced bytes and PDF size for one invoice whose rows are streamed"""
+    invoice, _, client, company = _sample_invoice(0)
+    started = time.perf_counter()
+    size = len(generate_invoice_pdf(invoice, _sample_rows(item_count), client, company).getvalue())
+    seconds = time.perf_counter() - started
+
+    tracemalloc.start()
+    try:
+        generate_invoice_pdf(invoice, _sample_rows(item_count), client, company)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return seconds, peak, size
+
+def _main(argv):
+    parser = argparse.ArgumentParser(description="Invoice PDF rendering")
+    parser.add_argument("command", choices=["bench", "bench-large"])
+    parser.add_argument("--count", type=int, default=200)
+    parser.add_argument("--items", type=int, nargs="+")
+    args = parser.parse_args(argv)
+
+    if args.command == "bench-large":
+        for item_count in args.items or [10000, 50000, 100000]:
+            seconds, peak, size = _bench_large(item_count)
+            print(f"{item_count:>7} items: {seconds:.2f}s, peak {peak / 2**20:.1f} MiB traced, PDF {size / 2**20:.1f} MiB")
+        return 0
+
+    for label, seconds in _bench(args.count, (args.items or [10])[0]).items():
+        print(f"{label:>22}: {seconds * 1000:.2f} ms")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(_main(sys.argv[1:]))
@@ -0,0 +1,160 @@
+"""
+Invoice PDFs rendered in a process pool, off the event loop.
+
+ReportLab is CPU-bound, so rendering inline would freeze every other request
+in the worker. ``pdf_pool.render`` hands the same ``generate_invoice_pdf``
+call to a pool of ``PDF_WORKERS`` processes and returns its bytes unchanged.
+At most ``PDF_QUEUE_LIMIT`` renders may be running or waiting at once.
+Beyond that, requests get 503 with Retry-After instead of piling up. Bulk
+exports pass ``wait=True`` to wait for room instead.
+
+Line items stored in invoice_items are not shipped to the worker. It gets a
+``StreamedItems`` marker and reads them from MongoDB itself, a batch at a
+time, as the items table lays them out page by page.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from fastapi import HTTPException
+from pymongo import MongoClient
+from utils.pdf_generator import generate_invoice_pdf, item_rows, template_for
+from utils.pdf_cache import PDF_ITEM_PROJECTION, PDF_ITEMS_BATCH_SIZE
+from typing import Iterator, List, NamedTuple, Optional, Tuple, Union
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+PDF_WORKERS = max(1, int(os.getenv("PDF_WORKERS", str(min(4, os.cpu_count() or 1)))))
+# Renders running or queued before new ones are turned away
+PDF_QUEUE_LIMIT = int(os.getenv("PDF_QUEUE_LIMIT", str(PDF_WORKERS * 8)))
+PDF_RETRY_AFTER_SECONDS = int(os.getenv("PDF_RETRY_AFTER_SECONDS", "5"))
+
+class StreamedItems(NamedTuple):
+    """Items in invoice_items, read by the pool process while it renders"""
+    invoice_id: str
+
+# Per pool process, opened on its first streamed render
+_items_collection = None
+
+def _streamed_rows(items: StreamedItems) -> Iterator[tuple]:
+    global _items_collection
+    if _items_collection is None:
+        _items_collection = MongoClient(os.environ["MONGO_URL"], tz_aware=True)[os.environ["DB_NAME"]].invoice_items
+    with _items_collection.find({"invoice_id": items.invoice_id}, PDF_ITEM_PROJECTION) \
+            .batch_size(PDF_ITEMS_BATCH_SIZE) as cursor:
+        yield from item_rows(cursor)
+
+def _render(invoice: dict, items: Union[List[tuple], StreamedItems], client: dict, company: dict,
+            branding: Optional[dict]) -> Tuple[bytes, float]:
+    """Runs in a pool process: the PDF bytes and how long they took"""
+    started = time.perf_counter()
+    rows = _streamed_rows(items) if isinstance(items, StreamedItems) else items
+    pdf = generate_invoice_pdf(invoice, rows, client, company, template_for(branding)).getvalue()
+    return pdf, time.perf_counter() - started
+
+class PdfRenderMetrics:
+    def __init__(self):
+        self.rendered = 0
+        self.rejected = 0
+        self.failed = 0
+        self.render_seconds = 0.0
+        self.max_render_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def record(self, render_seconds: float, wait_seconds: float):
+        self.rendered += 1
+        self.render_seconds += render_seconds
+        self.max_render_seconds = max(self.max_render_seconds, render_seconds)
+        self.wait_seconds += wait_seconds
+        self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+
+    def snapshot(self) -> dict:
+        return {
+            "rendered": self.rendered,
+            "rejected": self.rejected,
+            "failed": self.failed,
+            "avg_render_seconds": round(self.render_seconds / self.rendered, 4) if self.rendered else 0.0,
+            "max_render_seconds": round(self.max_render_seconds, 4),
+            "avg_wait_seconds": round(self.wait_seconds / self.rendered, 4) if self.rendered else 0.0,
+            "max_wait_seconds": round(self.max_wait_seconds, 4),
+        }
+
+class PdfRenderPool:
+    def __init__(self, workers: int = PDF_WORKERS, queue_limit: int = PDF_QUEUE_LIMIT):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.metrics = PdfRenderMetrics()
+        self._executor = None
+        self._in_flight = 0
+        self._room = asyncio.Condition()
+
+    def _pool(self) -> ProcessPoolExecutor:
+        # Created on first use; spawned rather than forked, so workers start
+        # clean instead of inheriting the app's threads and sockets
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    def depth(self) -> dict:
+        return {
+            "in_flight": self._in_flight,
+            "queued": max(0, self._in_flight - self.workers),
+            "workers": self.workers,
+            "limit": self.queue_limit,
+        }
+
+    async def render(self, invoice: dict, client: dict, company: dict,
+                     branding: Optional[dict] = None, wait: bool = False) -> bytes:
+        """PDF bytes for an invoice in the owner's branding; 503 when the
+        queue is full, unless ``wait`` is set"""
+        # Embedded items go along as compact rows; the rest are streamed by the worker
+        if "items" in invoice:
+            invoice = dict(invoice)
+            items = list(item_rows(invoice.pop("items")))
+        else:
+            items = StreamedItems(invoice["id"])
+
+        if wait:
+            async with self._room:
+                await self._room.wait_for(lambda: self._in_flight < self.queue_limit)
+        elif self._in_flight >= self.queue_limit:
+            self.metrics.rejected += 1
+            raise HTTPException(
+                status_code=503,
+                detail="PDF rendering is busy, please retry shortly",
+                headers={"Retry-After": str(PDF_RETRY_AFTER_SECONDS)}
+            )
+
+        self._in_flight += 1
+        started = time.perf_counter()
+        try:
+            pdf, render_seconds = await asyncio.get_running_loop().run_in_executor(
+                self._pool(), _render, invoice, items, client, company, branding
+            )
+        except BrokenProcessPool:
+            # A worker died (e.g. killed for memory); start a fresh pool next time
+            self.metrics.failed += 1
+            logger.error("PDF worker pool broke; restarting it")
+            self._executor = None
+            raise HTTPException(status_code=500, detail="Failed to render PDF")
+        except Exception:
+            self.metrics.failed += 1
+            raise
+        finally:
+            self._in_flight -= 1
+            async with self._room:
+                self._room.notify()
+
+        self.metrics.record(render_seconds, time.perf_counter() - started - render_seconds)
+        return pdf
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+pdf_pool = PdfRenderPool()
@@ -0,0 +1,41 @@
+"""
+Sparse fieldsets for read endpoints.
+
+``?fields=a,b,c`` selects the fields Mongo returns and the API serialises;
+``?fields=all`` returns the full model. List endpoints pass a slim default so
+their busiest callers only pay for the columns they display.
+"""
+from fastapi import HTTPException
+from pydantic import BaseModel
+from utils.dates import to_iso
+from datetime import datetime
+from typing import List, Optional, Type
+
+ALL_FIELDS = "all"
+# Always returned: identity plus the pagination sort key
+REQUIRED_FIELDS = ["id", "created_at"]
+
+def build_projection(fields: Optional[str], model: Type[BaseModel],
+                     default: Optional[List[str]] = None) -> Optional[dict]:
+    """Mongo projection for the requested fields, or None for the full document"""
+    if fields is None:
+        if default is None:
+            return None
+        names = default
+    elif fields.strip() == ALL_FIELDS:
+        return None
+    else:
+        names = [name.strip() for name in fields.split(",") if name.strip()]
+
+    unknown = [name for name in names if name not in model.model_fields]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+
+    projection = {"_id": 0}
+    for name in REQUIRED_FIELDS + names:
+        projection[name] = 1
+    return projection
+
+def serialize_fields(doc: dict) -> dict:
+    """Serialise a projected document without full model validation"""
+    return {key: to_iso(value) if isinstance(value, datetime) else value for key, value in doc.items()}
@@ -0,0 +1,45 @@
+"""
+Async token-bucket rate limiter for calls to external providers.
+
+The clock and sleep function are injectable so behaviour can be tested
+deterministically without real waiting.
+"""
+import asyncio
+import time
+
+class TokenBucket:
+    """At most ``rate`` acquisitions per second, with bursts up to ``capacity``.
+
+    A rate of 0 or less disables limiting. Waiters are served in arrival order.
+    """
+
+    def __init__(self, rate: float, capacity: float = None, clock=time.monotonic, sleep=asyncio.sleep):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = self.capacity
+        self._updated = clock()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            self._refill()
+            while self._tokens < 1:
+                await self._sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= 1
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
@@ -0,0 +1,193 @@
+"""
+Precomputed reminder schedule.
+
+Open invoices with auto reminders carry ``next_reminder_at`` (the first
+moment one of the reminder rules can fire) and ``next_reminder_type``. Both
+are refreshed whenever an invoice is sent, paid or reminded, so the scheduler
+only reads invoices with ``next_reminder_at <= now`` instead of the whole open
+book. The rules match ``choose_reminder_type`` in the scheduler:
+
+    polite     3 days before due, only if nothing was sent yet
+    due_today  on the due date, 1 day after the last reminder
+    firm       1 day overdue, 1 day after the last reminder
+    final      7+ days overdue, every 3 days
+
+Within a rule's window the reminder waits for the invoice's send slot: a
+fixed local time of day inside the owner's send window (``timezone``,
+``reminder_window_start`` and ``reminder_window_end`` on the user). The slot
+is derived from the invoice id, so sends spread evenly across everyone's
+windows instead of arriving in one burst.
+
+Backfill invoices created before the schedule existed (or reschedule them
+after changing the defaults below) with:
+
+    python -m utils.reminder_schedule backfill [--batch-size N]
+"""
+from database import invoices_collection, reminders_collection, users_collection
+from pymongo import UpdateOne
+from utils.dates import utc_now, parse_timestamp
+from datetime import datetime, timedelta, timezone, tzinfo
+from typing import List, NamedTuple, Optional, Tuple
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+import asyncio
+import argparse
+import logging
+import os
+import sys
+import zlib
+
+logger = logging.getLogger(__name__)
+
+REMINDER_STATUSES = ["sent", "viewed", "overdue"]
+CLEAR_REMINDER_SCHEDULE = {"next_reminder_at": None, "next_reminder_type": None}
+
+# Send window for users who have not set their own: local hours [start, end)
+DEFAULT_TIMEZONE = os.getenv("REMINDER_DEFAULT_TIMEZONE", "UTC")
+DEFAULT_WINDOW_START = int(os.getenv("REMINDER_WINDOW_START", "9"))
+DEFAULT_WINDOW_END = int(os.getenv("REMINDER_WINDOW_END", "17"))
+SEND_WINDOW_PROJECTION = {"_id": 0, "id": 1, "timezone": 1, "reminder_window_start": 1, "reminder_window_end": 1}
+
+DAY = timedelta(days=1)
+# Reminder windows are open at their start: (due - now).days == 3 first holds
+# just after due - 4 days
+_JUST_AFTER = timedelta(milliseconds=1)
+
+class SendWindow(NamedTuple):
+    timezone: tzinfo
+    start_hour: int
+    end_hour: int
+
+def load_timezone(name: Optional[str]) -> tzinfo:
+    try:
+        return ZoneInfo(name or DEFAULT_TIMEZONE)
+    except (ZoneInfoNotFoundError, ValueError):
+        logger.warning(f"Unknown timezone {name!r}; using UTC")
+        return timezone.utc
+
+def send_window(user: Optional[dict]) -> SendWindow:
+    """A user's send window, falling back to the defaults for unset fields"""
+    user = user or {}
+    start = user.get("reminder_window_start")
+    end = user.get("reminder_window_end")
+    return SendWindow(
+        load_timezone(user.get("timezone")),
+        DEFAULT_WINDOW_START if start is None else start,
+        DEFAULT_WINDOW_END if end is None else end,
+    )
+
+def send_slot(at: datetime, window: SendWindow, invoice_id: str) -> datetime:
+    """First moment at or after ``at`` that is the invoice's local send time"""
+    span = max(1, window.end_hour - window.start_hour) * 3600
+    offset = timedelta(hours=window.start_hour, seconds=zlib.crc32(invoice_id.encode()) % span)
+    local_day = at.astimezone(window.timezone).date()
+    # Two days ahead covers a full day plus any DST shift
+    for days in range(-1, 3):
+        day = local_day + timedelta(days=days)
+        # Aware arithmetic within one zone is wall-clock time
+        slot = (datetime(day.year, day.month, day.day, tzinfo=window.timezone) + offset).astimezone(timezone.utc)
+        if slot >= at:
+            return slot
+    return at
+
+def next_reminder(invoice: dict, last_sent_at: Optional[datetime], after: datetime,
+                  window: Optional[SendWindow] = None) -> Tuple[Optional[datetime], Optional[str]]:
+    """Earliest send slot at or after ``after`` a reminder can go out, and its type.
+
+    Without a ``window`` this is the earliest moment the rules allow.
+    """
+    if invoice.get("status") not in REMINDER_STATUSES or not invoice.get("auto_reminders"):
+        return None, None
+    due = parse_timestamp(invoice["due_date"])
+
+    # (type, window start, window end or None, minimum gap since the last reminder)
+    rules = [
+        ("due_today", due - DAY + _JUST_AFTER, due, DAY),
+        ("firm", due + _JUST_AFTER, due + DAY, DAY),
+        ("final", due + 6 * DAY + _JUST_AFTER, None, 3 * DAY),
+    ]
+    if not last_sent_at:
+        rules.insert(0, ("polite", due - 4 * DAY + _JUST_AFTER, due - 3 * DAY, None))
+
+    for reminder_type, start, end, gap in rules:
+        at = max(start, after)
+        if last_sent_at and gap:
+            at = max(at, last_sent_at + gap)
+        if window:
+            at = send_slot(at, window, invoice["id"])
+        if end is None or at <= end:
+            return at, reminder_type
+    return None, None
+
+def reminder_schedule(invoice: dict, last_sent_at: Optional[datetime], after: datetime, window: SendWindow) -> dict:
+    """The ``$set`` fields for an invoice's next reminder"""
+    at, reminder_type = next_reminder(invoice, last_sent_at, after, window)
+    return {"next_reminder_at": at, "next_reminder_type": reminder_type}
+
+async def last_reminder_dates(invoice_ids: List[str]) -> dict:
+    """invoice id -> when its latest reminder went out, in one aggregation"""
+    pipeline = [
+        {"$match": {"invoice_id": {"$in": invoice_ids}, "sent_at": {"$ne": None}}},
+        {"$sort": {"invoice_id": 1, "sent_at": -1}},
+        {"$group": {"_id": "$invoice_id", "sent_at": {"$first": "$sent_at"}}},
+    ]
+    rows = await reminders_collection.aggregate(pipeline).to_list(None)
+    return {row["_id"]: parse_timestamp(row["sent_at"]) for row in rows}
+
+async def send_windows(user_ids) -> dict:
+    """user id -> SendWindow, in one query"""
+    users = await users_collection.find({"id": {"$in": list(set(user_ids))}}, SEND_WINDOW_PROJECTION).to_list(None)
+    return {user["id"]: send_window(user) for user in users}
+
+async def refresh_reminder_schedule(invoice: dict, last_sent_at: Optional[datetime] = None, user: dict = None):
+    """Recompute one invoice's schedule, looking up its last reminder and
+    owner's send window unless given"""
+    if last_sent_at is None:
+        last_sent_at = (await last_reminder_dates([invoice["id"]])).get(invoice["id"])
+    if user is None:
+        user = await users_collection.find_one({"id": invoice["user_id"]}, SEND_WINDOW_PROJECTION)
+    schedule = reminder_schedule(invoice, last_sent_at, utc_now(), send_window(user))
+    await invoices_collection.update_one({"id": invoice["id"]}, {"$set": schedule})
+    invoice.update(schedule)
+
+async def backfill_reminder_schedule(batch_size: int = 1000, user_id: str = None) -> int:
+    """Compute the schedule for every open invoice (of one user, if given);
+    returns how many were updated"""
+    now = utc_now()
+    query = {"status": {"$in": REMINDER_STATUSES}, "auto_reminders": True}
+    if user_id:
+        query["user_id"] = user_id
+    cursor = invoices_collection.find(
+        query,
+        {"_id": 0, "id": 1, "user_id": 1, "status": 1, "auto_reminders": 1, "due_date": 1}
+    ).batch_size(batch_size)
+
+    updated = 0
+    while True:
+        invoices = await cursor.to_list(batch_size)
+        if not invoices:
+            break
+        last_sent = await last_reminder_dates([invoice["id"] for invoice in invoices])
+        windows = await send_windows(invoice["user_id"] for invoice in invoices)
+        await invoices_collection.bulk_write([
+            UpdateOne({"id": invoice["id"]}, {"$set": reminder_schedule(
+                invoice, last_sent.get(invoice["id"]), now, windows.get(invoice["user_id"]) or send_window(None)
+            )})
+            for invoice in invoices
+        ], ordered=False)
+        updated += len(invoices)
+        logger.info(f"Scheduled reminders for {updated} invoices")
+    return updated
+
+async def _main(argv):
+    parser = argparse.ArgumentParser(description="Maintain the precomputed reminder schedule")
+    parser.add_argument("command", choices=["backfill"])
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    updated = await backfill_reminder_schedule(args.batch_size)
+    print(f"Scheduled reminders for {updated} open invoices")
+    return 0
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    sys.exit(asyncio.run(_main(sys.argv[1:])))
@@ -0,0 +1,210 @@
+"""
+Reminder text engine.
+
+Free plans get fixed templates. Paid plans get templates written by the LLM
+with placeholders ({client_name}, {invoice_number}, {amount}, {currency},
+{due_date}, {late_fee_percentage}). Each template is cached per (reminder
+type, tone, user, locale) with TTL and LRU eviction and filled locally for
+every invoice. LLM calls therefore drop from one per reminder to a handful
+per user per day. Concurrent misses for the same key share one LLM call.
+The LLM is injectable, so the engine can be driven by a stub in tests.
+"""
+from collections import OrderedDict
+from utils.dates import format_date
+from utils.rate_limit import TokenBucket
+from typing import Awaitable, Callable, Optional
+from dotenv import load_dotenv
+import asyncio
+import logging
+import os
+import string
+import time
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+EMERGENT_LLM_KEY = os.getenv("EMERGENT_LLM_KEY")
+REMINDER_TEMPLATE_TTL_SECONDS = float(os.getenv("REMINDER_TEMPLATE_TTL_SECONDS", "86400"))
+REMINDER_TEMPLATE_CACHE_SIZE = int(os.getenv("REMINDER_TEMPLATE_CACHE_SIZE", "10000"))
+# Failed generations fall back to the fixed template for this long before retrying
+REMINDER_TEMPLATE_RETRY_SECONDS = float(os.getenv("REMINDER_TEMPLATE_RETRY_SECONDS", "300"))
+LLM_RATE_LIMIT = float(os.getenv("LLM_RATE_LIMIT", "5"))
+DEFAULT_LOCALE = "en"
+
+PLACEHOLDERS = {"client_name", "invoice_number", "amount", "currency", "due_date", "late_fee_percentage"}
+REQUIRED_PLACEHOLDERS = {"invoice_number", "amount"}
+
+REMINDER_TONES = {
+    "polite": "friendly",
+    "due_today": "professional",
+    "firm": "firm",
+    "late_fee_warning": "firm",
+    "final": "urgent",
+}
+
+TEMPLATES = {
+    "polite": "Hi {client_name},\n\nThis is a friendly reminder that invoice {invoice_number} for ${amount} {currency} is due on {due_date}.\n\nPlease let me know if you have any questions.\n\nBest regards",
+    "due_today": "Hi {client_name},\n\nJust a reminder that invoice {invoice_number} for ${amount} {currency} is due today.\n\nPlease arrange payment at your earliest convenience.",
+    "firm": "Dear {client_name},\n\nInvoice {invoice_number} for ${amount} {currency} is now overdue. Please arrange payment at your earliest convenience.\n\nThank you",
+    "final": "URGENT: Dear {client_name},\n\nThis is a final notice for invoice {invoice_number} (${amount} {currency}), which is now significantly overdue. Please settle this immediately to avoid further action.\n\nRegards",
+    "late_fee_warning": "Dear {client_name},\n\nPlease note that invoice {invoice_number} is overdue. As per our terms, a late fee of {late_fee_percentage}% will be applied if payment is not received promptly.\n\nCurrent amount due: ${amount} {currency}\n\nThank you",
+}
+
+def uses_llm(user_plan: str) -> bool:
+    """Free plans get fixed templates; paid plans get LLM-written ones"""
+    return user_plan != "free"
+
+def is_valid_template(template: str) -> bool:
+    """Only known placeholders, no format specs, and the essentials present"""
+    try:
+        fields = [(name, spec, conversion) for _, name, spec, conversion in string.Formatter().parse(template) if name is not None]
+    except ValueError:
+        return False
+    names = {name for name, _, _ in fields}
+    return (
+        names <= PLACEHOLDERS
+        and REQUIRED_PLACEHOLDERS <= names
+        and not any(spec or conversion for _, spec, conversion in fields)
+    )
+
+def fill_template(template: str, invoice: dict, client: dict) -> str:
+    return template.format(
+        client_name=client["name"],
+        invoice_number=invoice["invoice_number"],
+        amount=invoice["total_amount"],
+        currency=invoice["currency"],
+        due_date=format_date(invoice["due_date"]),
+        late_fee_percentage=invoice.get("late_fee_percentage", 5),
+    )
+
+def template_prompt(reminder_type: str, tone: str, locale: str) -> str:
+    return f"""Write a reusable payment reminder email body template.
+
+Reminder type: {reminder_type}
+Tone: {tone}
+Language/locale: {locale}
+
+Use these placeholders exactly, in curly braces, instead of real values:
+{{client_name}}, {{invoice_number}}, {{amount}}, {{currency}}, {{due_date}}
+(and {{late_fee_percentage}} if a late fee is mentioned).
+Write amounts as ${{amount}} {{currency}}.
+
+Guidelines:
+- Be professional and {tone}
+- Keep it concise (3-4 sentences)
+- Don't use subject line
+- Don't sign off with a name
+- Don't use any other curly braces
+- Reply with the template only"""
+
+async def emergent_llm(prompt: str, session_id: str) -> str:
+    """Default LLM: one chat completion through emergentintegrations"""
+    from emergentintegrations.llm.chat import LlmChat, UserMessage
+    chat = LlmChat(
+        api_key=EMERGENT_LLM_KEY,
+        session_id=session_id,
+        system_message="You are a professional payment reminder assistant. Generate concise, professional reminder templates."
+    ).with_model("openai", "gpt-5.2")
+    return await chat.send_message(UserMessage(text=prompt))
+
+class TTLCache:
+    """Bounded mapping whose entries expire; least recently used go first when full"""
+
+    def __init__(self, maxsize: int, ttl: float, clock: Callable[[], float] = time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if self._clock() >= expires_at:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        self._entries[key] = (value, self._clock() + (self.ttl if ttl is None else ttl))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+class ReminderTextEngine:
+    def __init__(self, llm: Callable[[str, str], Awaitable[str]] = None, cache: TTLCache = None,
+                 limiter: TokenBucket = None):
+        self.llm = llm or emergent_llm
+        # An empty TTLCache is falsy, so test for None
+        self.cache = cache if cache is not None else TTLCache(REMINDER_TEMPLATE_CACHE_SIZE, REMINDER_TEMPLATE_TTL_SECONDS)
+        self.limiter = limiter or TokenBucket(LLM_RATE_LIMIT)
+        self.hits = 0
+        self.misses = 0
+        self.llm_calls = 0
+        self.llm_failures = 0
+        self._in_flight = {}
+
+    async def _generate_template(self, key: tuple) -> str:
+        reminder_type, tone, user_id, locale = key
+        await self.limiter.acquire()
+        self.llm_calls += 1
+        try:
+            template = (await self.llm(template_prompt(reminder_type, tone, locale), f"reminder-template-{user_id}-{reminder_type}")).strip()
+            if not is_valid_template(template):
+                raise ValueError("template has missing or unknown placeholders")
+        except Exception as e:
+            self.llm_failures += 1
+            logger.error(f"AI reminder template generation failed: {e}")
+            template = TEMPLATES.get(reminder_type, TEMPLATES["polite"])
+            self.cache.set(key, template, ttl=REMINDER_TEMPLATE_RETRY_SECONDS)
+            return template
+        self.cache.set(key, template)
+        return template
+
+    async def template_for(self, reminder_type: str, user_id: str, locale: str = DEFAULT_LOCALE) -> str:
+        key = (reminder_type, REMINDER_TONES.get(reminder_type, "professional"), user_id, locale)
+        template = self.cache.get(key)
+        if template is not None:
+            self.hits += 1
+            return template
+
+        self.misses += 1
+        # Single flight: concurrent misses for one key wait on the same call
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._generate_template(key))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def render(self, invoice: dict, client: dict, reminder_type: str, user_plan: str,
+                     locale: Optional[str] = None) -> str:
+        """Reminder text for one invoice"""
+        if not uses_llm(user_plan):
+            template = TEMPLATES.get(reminder_type, TEMPLATES["polite"])
+        else:
+            template = await self.template_for(reminder_type, invoice["user_id"], locale or DEFAULT_LOCALE)
+        return fill_template(template, invoice, client)
+
+    def metrics(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "llm_calls": self.llm_calls,
+            "llm_failures": self.llm_failures,
+            "cached_templates": len(self.cache),
+        }
+
+reminder_text_engine = ReminderTextEngine()
+
+async def generate_ai_reminder(invoice_data: dict, client_data: dict, reminder_type: str, user_plan: str,
+                               locale: Optional[str] = None) -> str:
+    """Generate reminder message"""
+    return await reminder_text_engine.render(invoice_data, client_data, reminder_type, user_plan, locale)
@@ -1,213 +1,330 @@
-from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
-from datetime import datetime, timezone, timedelta
-from database import invoices_collection, clients_collection, users_collection, reminders_collection
+from datetime import datetime, timedelta
+from database import invoices_collection, clients_collection, users_collection, reminders_collection, subscriptions_collection
+from pymongo import UpdateOne
+from utils.user_stats import apply_invoice_update
+from utils.dates import utc_now, parse_timestamp, timestamp_range
+from utils.leases import run_until_done
+from utils.reminder_schedule import REMINDER_STATUSES, last_reminder_dates, reminder_schedule, send_window
+from utils.email_outbox import enqueue_email
+from utils.reminder_text import generate_ai_reminder
+from utils.email_templates import render_reminder_email
+from typing import List, Optional, Tuple
 import asyncio
 import logging
 import os
+import time
+import uuid
 from dotenv import load_dotenv
-from emergentintegrations.llm.chat import LlmChat, UserMessage
-import resend
 
 load_dotenv()
 logger = logging.getLogger(__name__)
 
-EMERGENT_LLM_KEY = os.getenv("EMERGENT_LLM_KEY")
-RESEND_API_KEY = os.getenv("RESEND_API_KEY")
 SENDER_EMAIL = os.getenv("SENDER_EMAIL", "noreply@clientnudge.ai")
+# Open invoices are read and prefetched for in batches of this size
+REMINDER_BATCH_SIZE = int(os.getenv("REMINDER_BATCH_SIZE", "1000"))
+# Reminders generated at once; LLM calls are rate limited by the reminder
+# text engine and email delivery by the outbox worker
+REMINDER_CONCURRENCY = int(os.getenv("REMINDER_CONCURRENCY", "10"))
+# Expired subscriptions cancelled per bulk write
+SUBSCRIPTION_BATCH_SIZE = int(os.getenv("SUBSCRIPTION_BATCH_SIZE", "1000"))
+# Split the reminder scan into this many user ranges, leased independently
+# so several workers can share one run
+REMINDER_SHARDS = max(1, int(os.getenv("REMINDER_SHARDS", "1")))
+# Minutes between reminder runs (a divisor of 60). Each run sends the
+# reminders whose send slot has arrived since the last one
+REMINDER_INTERVAL_MINUTES = int(os.getenv("REMINDER_INTERVAL_MINUTES", "15"))
+# A slot picked up within this long is judged by the rules as of the slot
+# itself; older ones (e.g. after downtime) are re-checked as of now
+REMINDER_SLOT_GRACE = timedelta(minutes=int(os.getenv("REMINDER_SLOT_GRACE_MINUTES", "60")))
+# How long shutdown waits for running jobs before cancelling them
+SCHEDULER_SHUTDOWN_TIMEOUT = float(os.getenv("SCHEDULER_SHUTDOWN_TIMEOUT", "30"))
 
-resend.api_key = RESEND_API_KEY
+# Jobs run as tasks on the application's event loop, sharing its Motor client
+scheduler = AsyncIOScheduler(job_defaults={"coalesce": True, "max_instances": 1, "misfire_grace_time": 3600})
+_running_jobs = set()
 
-scheduler = BackgroundScheduler()
+async def send_reminder_email(invoice, client, user, reminder_type, message, reminder_id: str,
+                              idempotency_key: str = None) -> Optional[str]:
+    """Queue the reminder email to the client.
 
-async def generate_ai_reminder(invoice_data, client_data, reminder_type, user_plan):
-    """Generate AI reminder message"""
-    if user_plan == "free":
-        templates = {
-            "polite": f"Hi {client_data['name']},\n\nFriendly reminder that invoice {invoice_data['invoice_number']} for ${invoice_data['total_amount']} {invoice_data['currency']} is due soon on {invoice_data['due_date']}.\n\nThank you!",
-            "due_today": f"Hi {client_data['name']},\n\nJust a reminder that invoice {invoice_data['invoice_number']} for ${invoice_data['total_amount']} {invoice_data['currency']} is due today.\n\nPlease arrange payment at your earliest convenience.",
-            "firm": f"Dear {client_data['name']},\n\nInvoice {invoice_data['invoice_number']} for ${invoice_data['total_amount']} {invoice_data['currency']} is now overdue. Please arrange payment as soon as possible.\n\nThank you",
-            "final": f"URGENT: Dear {client_data['name']},\n\nThis is a final notice for invoice {invoice_data['invoice_number']} (${invoice_data['total_amount']} {invoice_data['currency']}), which is significantly overdue.\n\nPlease settle immediately."
+    Returns the id of the reminder the queued email belongs to: ``reminder_id``,
+    or an earlier reminder's if the idempotency key was already queued. None if
+    it could not be queued.
+    """
+    try:
+        params = {
+            "from": SENDER_EMAIL,
+            "to": [client["email"]],
+            **render_reminder_email(invoice, user, message, automated=True)
         }
-        return templates.get(reminder_type, templates["polite"])
+        
+        email, queued = await enqueue_email(params, idempotency_key or f"reminder:{reminder_id}", reminder_id)
+        if queued:
+            logger.info(f"Reminder queued for invoice {invoice['invoice_number']} to {client['email']}")
+        else:
+            logger.info(f"Reminder for invoice {invoice['invoice_number']} was already queued")
+        return email.get("reminder_id") or reminder_id
+    except Exception as e:
+        logger.error(f"Failed to queue reminder email: {e}")
+        return None
+
+def choose_reminder_type(invoice: dict, last_sent_date: Optional[datetime], now: datetime) -> Optional[str]:
+    """Which reminder, if any, an invoice is due for today"""
+    days_until_due = (parse_timestamp(invoice['due_date']) - now).days
+    
+    # 3 days before due (only if no reminder sent yet)
+    if days_until_due == 3 and not last_sent_date:
+        return "polite"
+    
+    # On due date
+    if days_until_due == 0 and (not last_sent_date or (now - last_sent_date).days >= 1):
+        return "due_today"
     
-    # AI-powered reminder for Pro/Agency users
-    prompt = f"""Generate a professional payment reminder for:
+    # 1 day overdue
+    if days_until_due == -1 and (not last_sent_date or (now - last_sent_date).days >= 1):
+        return "firm"
     
-Client: {client_data['name']}
-Invoice: {invoice_data['invoice_number']}
-Amount: ${invoice_data['total_amount']} {invoice_data['currency']}
-Due Date: {invoice_data['due_date']}
-Type: {reminder_type}
+    # 7 days overdue - final reminder with late fee
+    if days_until_due <= -7 and (not last_sent_date or (now - last_sent_date).days >= 3):
+        return "final"
+    
+    return None
+
+async def _find_by_ids(collection, ids, projection: dict) -> dict:
+    if not ids:
+        return {}
+    docs = await collection.find({"id": {"$in": list(ids)}}, projection).to_list(None)
+    return {doc["id"]: doc for doc in docs}
+
+async def process_reminder_batch(invoices: List[dict], now: datetime, dispatcher: "ReminderDispatcher") -> int:
+    """Send every reminder due in a batch of invoices; returns how many went out.
 
-Be professional and {reminder_type}. Keep it 3-4 sentences."""
+    Reads cost a fixed number of queries per batch: last reminders and users,
+    then the clients of the invoices that qualify. Afterwards every invoice
+    in the batch gets its next reminder time in one bulk write.
+    """
+    last_sent = await last_reminder_dates([invoice['id'] for invoice in invoices])
+    users = await _find_by_ids(users_collection, {invoice['user_id'] for invoice in invoices}, {"_id": 0, "password_hash": 0})
     
-    try:
-        chat = LlmChat(
-            api_key=EMERGENT_LLM_KEY,
-            session_id=f"auto-reminder-{invoice_data['id']}",
-            system_message="You are a professional payment reminder assistant."
-        ).with_model("openai", "gpt-5.2")
+    due = []
+    for invoice in invoices:
+        # Judge the invoice at its send slot: a run can start up to an
+        # interval later, possibly just past the end of the rule's window
+        slot = parse_timestamp(invoice.get('next_reminder_at'))
+        checked_at = slot if slot and now - slot <= REMINDER_SLOT_GRACE else now
+        reminder_type = choose_reminder_type(invoice, last_sent.get(invoice['id']), checked_at)
+        if not reminder_type:
+            continue
         
-        response = await chat.send_message(UserMessage(text=prompt))
-        return response
-    except Exception as e:
-        logger.error(f"AI reminder generation failed: {e}")
-        return f"Reminder: Invoice {invoice_data['invoice_number']} requires attention. Due: {invoice_data['due_date']}."
-
-async def send_reminder_email(invoice, client, user, reminder_type, message):
-    """Send reminder email to client"""
-    try:
-        html_content = f"""
-        <div style="font-family: Inter, sans-serif; max-width: 600px; margin: 0 auto;">
-            <h2 style="color: #4361EE;">Payment Reminder</h2>
-            <div style="white-space: pre-wrap; line-height: 1.6;">
-                {message}
-            </div>
-            <hr style="margin: 30px 0; border: none; border-top: 1px solid #e5e7eb;">
-            <p style="font-size: 14px; color: #6b7280;">
-                <strong>Invoice Details:</strong><br>
-                Invoice #: {invoice['invoice_number']}<br>
-                Amount: ${invoice['total_amount']} {invoice['currency']}<br>
-                Due Date: {invoice['due_date']}
-            </p>
-            <a href="{os.getenv('FRONTEND_URL', 'http://localhost:3000')}/portal/{invoice['id']}" 
-               style="display: inline-block; background: #4361EE; color: white; padding: 12px 24px; 
-                      text-decoration: none; border-radius: 6px; margin-top: 20px;">
-                View & Pay Invoice
-            </a>
-            <p style="margin-top: 30px; font-size: 12px; color: #9ca3af;">
-                Automated reminder from {user['full_name']} via ClientNudge AI
-            </p>
-        </div>
-        """
+        if reminder_type == "firm":
+            # Update invoice status to overdue
+            await apply_invoice_update(
+                {"id": invoice['id'], "user_id": invoice['user_id']},
+                {"status": "overdue"}
+            )
         
-        params = {
-            "from": SENDER_EMAIL,
-            "to": [client["email"]],
-            "subject": f"Payment Reminder: Invoice {invoice['invoice_number']}",
-            "html": html_content
-        }
+        elif reminder_type == "final":
+            # Apply late fee if enabled and not already applied
+            if invoice['late_fee_enabled'] and invoice['late_fee_amount'] == 0:
+                late_fee = invoice['total_amount'] * (invoice['late_fee_percentage'] / 100)
+                new_total = invoice['total_amount'] + late_fee
+                await apply_invoice_update(
+                    {"id": invoice['id'], "user_id": invoice['user_id']},
+                    {
+                        "late_fee_amount": round(late_fee, 2),
+                        "total_amount": round(new_total, 2)
+                    }
+                )
+                invoice['late_fee_amount'] = late_fee
+                invoice['total_amount'] = new_total
         
-        # Send email synchronously (called from async context)
-        email = await asyncio.to_thread(resend.Emails.send, params)
-        logger.info(f"Reminder sent for invoice {invoice['invoice_number']} to {client['email']}")
-        return True
-    except Exception as e:
-        logger.error(f"Failed to send reminder email: {e}")
-        return False
+        due.append((invoice, reminder_type))
+    
+    if not due:
+        await _reschedule(invoices, last_sent, users, now)
+        return 0
+    
+    # Get client info
+    clients = await _find_by_ids(clients_collection, {invoice['client_id'] for invoice, _ in due}, {"_id": 0})
+    
+    jobs = []
+    for invoice, reminder_type in due:
+        client = clients.get(invoice['client_id'])
+        user = users.get(invoice['user_id'])
+        if client and user:
+            jobs.append((invoice, client, user, reminder_type))
+    
+    # Generate and queue concurrently
+    reminder_docs = [doc for doc in await dispatcher.dispatch(jobs, now) if doc]
+    for doc in reminder_docs:
+        last_sent[doc['invoice_id']] = now
+        logger.info(f"Automated reminder sent: invoice {doc['invoice_id']} ({doc['reminder_type']})")
+    
+    # Failed reminders keep their slot, so the next run retries them (judged
+    # as of the slot within the grace period) instead of a day later
+    failed = {invoice['id'] for invoice, *_ in jobs} - {doc['invoice_id'] for doc in reminder_docs}
+    await _reschedule([invoice for invoice in invoices if invoice['id'] not in failed], last_sent, users, now)
+    return len(reminder_docs)
+
+async def _reschedule(invoices: List[dict], last_sent: dict, users: dict, now: datetime):
+    """Move each invoice's next_reminder_at to its next send slot after this run"""
+    if not invoices:
+        return
+    await invoices_collection.bulk_write([
+        UpdateOne({"id": invoice['id']}, {"$set": reminder_schedule(
+            invoice, last_sent.get(invoice['id']), now + timedelta(milliseconds=1), send_window(users.get(invoice['user_id']))
+        )})
+        for invoice in invoices
+    ], ordered=False)
+
+class ReminderDispatcher:
+    """Generates reminders concurrently and queues their emails.
+
+    ``generate`` and ``send`` default to the reminder text engine and outbox and
+    can be replaced with stubs; ``send`` returns the id of the reminder its
+    email is filed under, as ``send_reminder_email`` does. Each reminder is
+    isolated: a failure is logged and yields None without affecting the rest,
+    and results come back in the order the jobs were given.
+    """
 
-async def check_and_send_reminders():
+    def __init__(self, generate=None, send=None, concurrency: int = REMINDER_CONCURRENCY):
+        self.generate = generate or generate_ai_reminder
+        self.send = send or send_reminder_email
+        self.concurrency = max(1, concurrency)
+
+    async def _dispatch_one(self, semaphore, invoice, client, user, reminder_type, now) -> Optional[dict]:
+        # One automated email per invoice, reminder type and day, even if a run is repeated
+        idempotency_key = f"auto-reminder:{invoice['id']}:{reminder_type}:{now.strftime('%Y-%m-%d')}"
+        async with semaphore:
+            try:
+                message = await self.generate(invoice, client, reminder_type, user['subscription_plan'],
+                                              locale=user.get('locale'))
+                
+                # Saved before queueing so the outbox worker can always mark its delivery
+                reminder_doc = {
+                    "id": str(uuid.uuid4()),
+                    "invoice_id": invoice['id'],
+                    "reminder_type": reminder_type,
+                    "message": message,
+                    "sent_at": now,
+                    "channel": "email",
+                    "email_status": "queued",
+                    "created_at": now
+                }
+                await reminders_collection.insert_one(reminder_doc)
+                reminder_doc.pop("_id", None)
+                
+                filed_under = await self.send(invoice, client, user, reminder_type, message,
+                                              reminder_id=reminder_doc["id"], idempotency_key=idempotency_key)
+                if filed_under is None:
+                    await reminders_collection.delete_one({"id": reminder_doc["id"]})
+                    return None
+                if filed_under != reminder_doc["id"]:
+                    # Queued by an earlier run today: that reminder stands, and
+                    # counting it as sent stops the next runs from retrying
+                    earlier = await reminders_collection.find_one({"id": filed_under}, {"_id": 0})
+                    if earlier:
+                        await reminders_collection.delete_one({"id": reminder_doc["id"]})
+                        return earlier
+            except Exception as e:
+                logger.error(f"Reminder for invoice {invoice['invoice_number']} failed: {e}")
+                return None
+        
+        return reminder_doc
+
+    async def dispatch(self, jobs: list, now: datetime) -> List[Optional[dict]]:
+        """Run (invoice, client, user, reminder_type) jobs; returns the saved reminder doc or None per job"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        return await asyncio.gather(*(
+            self._dispatch_one(semaphore, invoice, client, user, reminder_type, now)
+            for invoice, client, user, reminder_type in jobs
+        ))
+
+def shard_user_range(shard: int, shards: int) -> Tuple[Optional[str], Optional[str]]:
+    """[low, high) bounds on user_id for one shard.
+
+    User ids are random UUID4 hex strings, so splitting on their leading
+    four hex digits spreads users evenly, like hashing them would, while
+    each shard remains an index range scan.
+    """
+    low = f"{shard * 0x10000 // shards:04x}" if shard > 0 else None
+    high = f"{(shard + 1) * 0x10000 // shards:04x}" if shard < shards - 1 else None
+    return low, high
+
+async def check_and_send_reminders(dispatcher: ReminderDispatcher = None, user_range: Tuple[Optional[str], Optional[str]] = (None, None)):
     """Check all invoices and send automated reminders based on due dates"""
     try:
         logger.info("Running automated reminder check...")
-        now = datetime.now(timezone.utc)
+        now = utc_now()
+        dispatcher = dispatcher or ReminderDispatcher()
         
-        # Get all unpaid invoices with auto_reminders enabled
-        invoices = await invoices_collection.find({
-            "status": {"$in": ["sent", "viewed", "overdue"]},
+        # Only invoices whose precomputed next reminder is due
+        query = {
+            "next_reminder_at": {"$lte": now},
+            "status": {"$in": REMINDER_STATUSES},
             "auto_reminders": True
-        }, {"_id": 0}).to_list(10000)
+        }
+        low, high = user_range
+        if low or high:
+            query["user_id"] = {key: value for key, value in (("$gte", low), ("$lt", high)) if value}
         
-        for invoice in invoices:
-            due_date = datetime.fromisoformat(invoice['due_date'].replace('Z', '+00:00'))
-            days_until_due = (due_date - now).days
-            
-            # Get last reminder sent
-            last_reminder = await reminders_collection.find_one(
-                {"invoice_id": invoice['id'], "sent_at": {"$ne": None}},
-                {"_id": 0},
-                sort=[("sent_at", -1)]
-            )
-            
-            last_sent_date = None
-            if last_reminder and last_reminder.get('sent_at'):
-                last_sent_date = datetime.fromisoformat(last_reminder['sent_at'].replace('Z', '+00:00'))
-            
-            # Determine if we should send a reminder
-            should_send = False
-            reminder_type = None
-            
-            # 3 days before due (only if no reminder sent yet)
-            if days_until_due == 3 and not last_sent_date:
-                should_send = True
-                reminder_type = "polite"
-            
-            # On due date
-            elif days_until_due == 0 and (not last_sent_date or (now - last_sent_date).days >= 1):
-                should_send = True
-                reminder_type = "due_today"
-            
-            # 1 day overdue
-            elif days_until_due == -1 and (not last_sent_date or (now - last_sent_date).days >= 1):
-                should_send = True
-                reminder_type = "firm"
-                # Update invoice status to overdue
-                await invoices_collection.update_one(
-                    {"id": invoice['id']},
-                    {"$set": {"status": "overdue"}}
-                )
-            
-            # 7 days overdue - final reminder with late fee
-            elif days_until_due <= -7 and (not last_sent_date or (now - last_sent_date).days >= 3):
-                should_send = True
-                reminder_type = "final"
-                
-                # Apply late fee if enabled and not already applied
-                if invoice['late_fee_enabled'] and invoice['late_fee_amount'] == 0:
-                    late_fee = invoice['total_amount'] * (invoice['late_fee_percentage'] / 100)
-                    new_total = invoice['total_amount'] + late_fee
-                    await invoices_collection.update_one(
-                        {"id": invoice['id']},
-                        {"$set": {
-                            "late_fee_amount": round(late_fee, 2),
-                            "total_amount": round(new_total, 2)
-                        }}
-                    )
-                    invoice['late_fee_amount'] = late_fee
-                    invoice['total_amount'] = new_total
-            
-            if should_send:
-                # Get client and user info
-                client = await clients_collection.find_one({"id": invoice['client_id']}, {"_id": 0})
-                user = await users_collection.find_one({"id": invoice['user_id']}, {"_id": 0})
-                
-                if client and user:
-                    # Generate reminder message
-                    message = await generate_ai_reminder(invoice, client, reminder_type, user['subscription_plan'])
-                    
-                    # Send email
-                    sent = await send_reminder_email(invoice, client, user, reminder_type, message)
-                    
-                    if sent:
-                        # Save reminder record
-                        import uuid
-                        reminder_doc = {
-                            "id": str(uuid.uuid4()),
-                            "invoice_id": invoice['id'],
-                            "reminder_type": reminder_type,
-                            "message": message,
-                            "sent_at": now.isoformat(),
-                            "channel": "email",
-                            "created_at": now.isoformat()
-                        }
-                        await reminders_collection.insert_one(reminder_doc)
-                        logger.info(f"Automated reminder sent: {invoice['invoice_number']} ({reminder_type})")
+        # Stream them a batch at a time
+        cursor = invoices_collection.find(query, {"_id": 0}).batch_size(REMINDER_BATCH_SIZE)
         
-        logger.info(f"Automated reminder check completed. Checked {len(invoices)} invoices.")
+        checked = sent = 0
+        while True:
+            invoices = await cursor.to_list(REMINDER_BATCH_SIZE)
+            if not invoices:
+                break
+            checked += len(invoices)
+            sent += await process_reminder_batch(invoices, now, dispatcher)
+        
+        logger.info(f"Automated reminder check completed. Checked {checked} invoices, sent {sent} reminders.")
     except Exception as e:
         logger.error(f"Error in automated reminder check: {e}")
 
-def run_reminder_check():
-    """Wrapper to run async function in sync scheduler"""
-    asyncio.run(check_and_send_reminders())
+def _daily_run_key() -> str:
+    return utc_now().strftime("%Y-%m-%d")
+
+def _interval_run_key(minutes: int) -> str:
+    """The start of the current ``minutes``-long slice of the day"""
+    now = utc_now()
+    return now.replace(minute=now.minute - now.minute % minutes).strftime("%Y-%m-%dT%H:%M")
+
+def _reminder_shard_job(shard: int):
+    async def job():
+        await check_and_send_reminders(user_range=shard_user_range(shard, REMINDER_SHARDS))
+    return job
+
+async def run_reminder_check():
+    """Scheduled entry point: only the worker holding a shard's lease scans it"""
+    jobs = {f"automated_reminders:{shard}": _reminder_shard_job(shard) for shard in range(REMINDER_SHARDS)}
+    # Stop waiting on other workers' shards once the next run is due
+    await _tracked(run_until_done(jobs, _interval_run_key(REMINDER_INTERVAL_MINUTES), window=REMINDER_INTERVAL_MINUTES * 60))
+
+async def run_subscription_check():
+    await _tracked(run_until_done({"subscription_check": check_and_cancel_expired_subscriptions}, _daily_run_key()))
+
+async def _tracked(job):
+    """Run a job coroutine, registered so shutdown can wait for it"""
+    task = asyncio.current_task()
+    _running_jobs.add(task)
+    try:
+        await job
+    finally:
+        _running_jobs.discard(task)
 
 def start_scheduler():
-    """Start the background scheduler for automated reminders and subscription checks"""
-    # Run daily at 9 AM UTC for reminders
+    """Start the in-loop scheduler for automated reminders and subscription checks.
+
+    Must be called from the running event loop (the app lifespan).
+    """
+    # Send reminders as their owners' local send slots arrive
     scheduler.add_job(
         run_reminder_check,
-        CronTrigger(hour=9, minute=0),
+        CronTrigger(minute=f"*/{REMINDER_INTERVAL_MINUTES}"),
         id='automated_reminders',
         replace_existing=True
     )
@@ -221,58 +338,86 @@ def start_scheduler():
     )
     
     scheduler.start()
-    logger.info("Automated scheduler started (reminders at 9 AM, subscriptions at 10 AM UTC)")
+    logger.info(f"Automated scheduler started (reminders every {REMINDER_INTERVAL_MINUTES} minutes, subscriptions at 10 AM UTC)")
 
-def stop_scheduler():
-    """Stop the scheduler"""
-    scheduler.shutdown()
+async def stop_scheduler(timeout: float = SCHEDULER_SHUTDOWN_TIMEOUT):
+    """Stop scheduling new runs and let in-flight jobs finish, cancelling any
+    still running after ``timeout`` seconds"""
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+    
+    if _running_jobs:
+        logger.info(f"Waiting up to {timeout}s for {len(_running_jobs)} running job(s)")
+        _, pending = await asyncio.wait(set(_running_jobs), timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+            logger.warning(f"Cancelled {len(pending)} job(s) still running at shutdown")
     logger.info("Scheduler stopped")
 
 
-async def check_and_cancel_expired_subscriptions():
-    """Check and cancel expired subscriptions (30 days unpaid)"""
+async def check_and_cancel_expired_subscriptions(batch_size: int = SUBSCRIPTION_BATCH_SIZE) -> dict:
+    """Cancel expired subscriptions (30 days unpaid) and downgrade their users.
+
+    Expired subscriptions are read through the (status, end_date) index in
+    batches; each batch costs one bulk_write to users and one to
+    subscriptions. Users are downgraded first, so an interrupted run simply
+    picks up the remaining (still active) subscriptions next time. Returns a
+    summary of the run.
+    """
+    started = time.monotonic()
+    summary = {"expired": 0, "users_downgraded": 0, "batches": 0, "seconds": 0.0}
     try:
         logger.info("Checking for expired subscriptions...")
-        now = datetime.now(timezone.utc)
-        
-        from database import subscriptions_collection, users_collection
+        now = utc_now()
         
-        # Get all active subscriptions
-        subscriptions = await subscriptions_collection.find({"status": "active"}, {"_id": 0}).to_list(10000)
+        cursor = subscriptions_collection.find(
+            {"status": "active", **timestamp_range("end_date", end=now)},
+            {"_id": 0, "id": 1, "user_id": 1}
+        ).sort("end_date", 1).batch_size(batch_size)
         
-        for subscription in subscriptions:
-            if not subscription.get("end_date"):
-                continue
+        while True:
+            expired = await cursor.to_list(batch_size)
+            if not expired:
+                break
             
-            end_date = datetime.fromisoformat(subscription["end_date"].replace('Z', '+00:00'))
+            # Users who renewed have a newer subscription still running
+            user_ids = list({subscription["user_id"] for subscription in expired})
+            renewed = set(await subscriptions_collection.distinct(
+                "user_id",
+                {"user_id": {"$in": user_ids}, "status": "active", **timestamp_range("end_date", start=now)}
+            ))
             
-            # Check if subscription has expired
-            if now > end_date:
-                # Cancel subscription
-                await subscriptions_collection.update_one(
-                    {"id": subscription["id"]},
-                    {"$set": {
-                        "status": "cancelled",
-                        "cancelled_at": now.isoformat(),
-                        "cancellation_reason": "expired_unpaid"
-                    }}
-                )
-                
-                # Downgrade user to free plan
-                await users_collection.update_one(
-                    {"id": subscription["user_id"]},
-                    {"$set": {
-                        "subscription_plan": "free",
-                        "subscription_status": "inactive"
-                    }}
-                )
-                
-                logger.info(f"Subscription {subscription['id']} cancelled due to expiry")
+            # Downgrade users to free plan
+            downgrades = [
+                UpdateOne({"id": user_id}, {"$set": {
+                    "subscription_plan": "free",
+                    "subscription_status": "inactive"
+                }})
+                for user_id in user_ids if user_id not in renewed
+            ]
+            if downgrades:
+                result = await users_collection.bulk_write(downgrades, ordered=False)
+                summary["users_downgraded"] += result.modified_count
+            
+            # Cancel subscriptions
+            result = await subscriptions_collection.bulk_write([
+                UpdateOne({"id": subscription["id"], "status": "active"}, {"$set": {
+                    "status": "cancelled",
+                    "cancelled_at": now,
+                    "cancellation_reason": "expired_unpaid"
+                }})
+                for subscription in expired
+            ], ordered=False)
+            summary["expired"] += result.modified_count
+            summary["batches"] += 1
         
-        logger.info(f"Checked {len(subscriptions)} subscriptions")
+        summary["seconds"] = round(time.monotonic() - started, 3)
+        logger.info(
+            f"Cancelled {summary['expired']} expired subscriptions and downgraded "
+            f"{summary['users_downgraded']} users in {summary['batches']} batches ({summary['seconds']}s)"
+        )
     except Exception as e:
         logger.error(f"Error checking expired subscriptions: {e}")
-
-def run_subscription_check():
-    """Wrapper to run async subscription check"""
-    asyncio.run(check_and_cancel_expired_subscriptions())
+    return summary
@@ -0,0 +1,72 @@
+"""
+Atomic, collision-free sequences backed by the ``counters`` collection.
+
+Each sequence is one counter document advanced with ``$inc``. With a block
+size above 1, a process reserves that many numbers per round trip and hands
+them out locally, so a busy sequence stops being a write hotspot; the cost is
+that numbers can skip (unused blocks are lost on restart) and interleave
+across processes, though they never repeat.
+
+Blocks are kept for the ``SEQUENCE_CACHE_KEYS`` most recently used keys; an
+evicted key's unused numbers are skipped, as after a restart.
+"""
+from pymongo import ReturnDocument
+from database import counters_collection
+from collections import OrderedDict
+import asyncio
+import os
+
+# Sequences (e.g. users) holding a local block per process
+SEQUENCE_CACHE_KEYS = int(os.getenv("SEQUENCE_CACHE_KEYS", "10000"))
+
+async def reserve_range(key: str, count: int = 1) -> int:
+    """Reserve ``count`` consecutive values; returns the first one"""
+    counter = await counters_collection.find_one_and_update(
+        {"_id": key},
+        {"$inc": {"seq": count}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return counter["seq"] - count + 1
+
+class SequenceAllocator:
+    """Hands out sequence values from per-process blocks"""
+
+    def __init__(self, block_size: int = 1, max_keys: int = SEQUENCE_CACHE_KEYS):
+        self.block_size = max(1, block_size)
+        self.max_keys = max(1, max_keys)
+        # key -> [lock, next value, last value], least recently used first
+        self._blocks = OrderedDict()
+
+    async def next(self, key: str) -> int:
+        if self.block_size == 1:
+            # Nothing is handed out locally, so no block or lock to keep
+            return await reserve_range(key)
+
+        block = self._blocks.get(key)
+        if block is None:
+            block = self._blocks[key] = [asyncio.Lock(), 1, 0]
+            self._evict()
+        self._blocks.move_to_end(key)
+        async with block[0]:
+            if block[1] > block[2]:
+                first = await reserve_range(key, self.block_size)
+                block[1], block[2] = first, first + self.block_size - 1
+            value = block[1]
+            block[1] += 1
+            return value
+
+    def _evict(self):
+        # Idle keys only. Dropping one a waiter still holds is safe: it keeps
+        # drawing from its own reserved range
+        for key in list(self._blocks):
+            if len(self._blocks) <= self.max_keys:
+                break
+            if not self._blocks[key][0].locked():
+                del self._blocks[key]
+
+    async def take(self, key: str, count: int) -> int:
+        """Reserve a contiguous run for bulk work, bypassing the local block"""
+        return await reserve_range(key, count)
+
+invoice_sequences = SequenceAllocator(int(os.getenv("INVOICE_NUMBER_BLOCK_SIZE", "1")))
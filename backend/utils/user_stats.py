@@ -0,0 +1,364 @@
+"""
+Per-user dashboard rollups.
+
+Each user has one ``user_stats`` document holding running totals that are
+adjusted with ``$inc`` whenever an invoice is created or changes state, so the
+dashboard is a single document read. Every write path computes the delta
+between an invoice's contribution before and after the change.
+
+Every write also bumps ``version``. A rebuild recomputes from the invoices
+and replaces the document only if ``version`` has not moved in the meantime,
+otherwise it starts over, so deltas applied during a rebuild are never lost.
+Writers upsert. A document they create holds only their delta and lacks
+``schema``, so the next dashboard read rebuilds it.
+
+A rebuild can also land between a writer's invoice write and its ``$inc``.
+Its aggregation then already counts the change, and the ``$inc`` would count
+it again. Each rebuild stores a new ``generation``, so writers read it before
+touching invoices (``rollup_generation``) and pass it to the rollup update.
+If it changed in between, the update drops ``schema`` and the next dashboard
+read rebuilds the document.
+
+Maintenance command (recompute from invoices / report drift):
+
+    python -m utils.user_stats rebuild [--user USER_ID]
+    python -m utils.user_stats verify [--user USER_ID] [--fix]
+"""
+from datetime import datetime, time, timezone
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from database import invoices_collection, users_collection, user_stats_collection
+from models import DashboardStats
+from utils.dashboard_stats import compute_dashboard_stats
+from utils.dates import utc_now, parse_timestamp, timestamp_range
+from typing import List, Optional
+import asyncio
+import argparse
+import logging
+import sys
+import uuid
+
+logger = logging.getLogger(__name__)
+
+CONTRIBUTION_FIELDS = {"_id": 0, "status": 1, "total_amount": 1, "late_fee_amount": 1,
+                       "paid_at": 1, "created_at": 1, "due_date": 1}
+# Bump when the document layout changes; older rollups are rebuilt on read
+USER_STATS_SCHEMA = 2
+# Rebuild attempts before giving up on storing the result (it is still returned)
+REBUILD_ATTEMPTS = 3
+
+def due_day_key(due_date: datetime) -> str:
+    return due_date.astimezone(timezone.utc).strftime("%Y-%m-%d")
+
+def invoice_contribution(invoice: Optional[dict]) -> dict:
+    """Dotted-path amounts this invoice adds to its owner's rollup"""
+    if not invoice:
+        return {}
+
+    status = invoice.get("status")
+    amount = invoice.get("total_amount", 0.0)
+    contribution = {"total_invoices": 1}
+
+    if status == "paid":
+        contribution["paid_invoices"] = 1
+        contribution["late_fee_collected"] = invoice.get("late_fee_amount", 0.0)
+        paid_at = parse_timestamp(invoice.get("paid_at"))
+        if paid_at:
+            month_key = paid_at.astimezone(timezone.utc).strftime("%Y-%m")
+            contribution[f"paid_by_month.{month_key}"] = amount
+            created_at = parse_timestamp(invoice.get("created_at"))
+            if created_at:
+                contribution["payment_days_sum"] = (paid_at - created_at).days
+                contribution["payment_days_count"] = 1
+
+    elif status in ["sent", "viewed"]:
+        contribution["pending_invoices"] = 1
+        contribution["pending_amount"] = amount
+        # Bucketed by UTC due day so the read can tell which are past due "now"
+        due_date = parse_timestamp(invoice.get("due_date"))
+        if due_date:
+            due_key = due_day_key(due_date)
+            contribution[f"pending_by_due.{due_key}.count"] = 1
+            contribution[f"pending_by_due.{due_key}.amount"] = amount
+
+    elif status == "overdue":
+        contribution["overdue_invoices"] = 1
+        contribution["overdue_amount"] = amount
+
+    return contribution
+
+def _contribution_delta(before: Optional[dict], after: Optional[dict]) -> dict:
+    old = invoice_contribution(before)
+    new = invoice_contribution(after)
+    delta = {}
+    for key in old.keys() | new.keys():
+        change = new.get(key, 0) - old.get(key, 0)
+        if change:
+            delta[key] = change
+    return delta
+
+def empty_user_stats(user_id: str) -> dict:
+    return {
+        "user_id": user_id,
+        "total_invoices": 0,
+        "paid_invoices": 0,
+        "pending_invoices": 0,
+        "pending_amount": 0.0,
+        "overdue_invoices": 0,
+        "overdue_amount": 0.0,
+        "late_fee_collected": 0.0,
+        "payment_days_sum": 0,
+        "payment_days_count": 0,
+        "paid_by_month": {},
+        "pending_by_due": {},
+        "schema": USER_STATS_SCHEMA,
+        "version": 0,
+        "generation": None,
+        "updated_at": utc_now()
+    }
+
+async def create_user_stats(user_id: str):
+    """Start an empty rollup for a brand new user"""
+    await user_stats_collection.insert_one(empty_user_stats(user_id))
+
+async def rollup_generation(user_id: str) -> Optional[str]:
+    """Read before an invoice write and pass to the rollup update after it"""
+    stats = await user_stats_collection.find_one({"user_id": user_id}, {"_id": 0, "generation": 1})
+    return stats.get("generation") if stats else None
+
+async def record_invoice_change(before: Optional[dict], after: Optional[dict], generation: Optional[str]):
+    """Apply the rollup delta for an invoice going from ``before`` to ``after``"""
+    invoice = after or before
+    delta = _contribution_delta(before, after)
+    if not delta:
+        return
+    await _apply_delta(invoice["user_id"], delta, generation)
+
+async def _apply_delta(user_id: str, delta: dict, generation: Optional[str]):
+    # Upserted so a rebuild in progress sees the write; a document created
+    # here has no schema and is rebuilt on the next dashboard read
+    stats = await user_stats_collection.find_one_and_update(
+        {"user_id": user_id},
+        {"$inc": {**delta, "version": 1}, "$set": {"updated_at": utc_now()}},
+        projection={"_id": 0, "generation": 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    if stats.get("generation") != generation:
+        # A rebuild since the invoice write may already count this delta
+        logger.info(f"Rollup for user {user_id} was rebuilt during a write; rebuilding on next read")
+        await user_stats_collection.update_one(
+            {"user_id": user_id, "generation": stats.get("generation")}, {"$unset": {"schema": ""}}
+        )
+
+async def record_new_invoices(user_id: str, invoices: List[dict], generation: Optional[str]):
+    """One rollup update for a batch of newly inserted invoices of one user"""
+    totals = _sum_contributions(invoices)
+    if not totals:
+        return
+    await _apply_delta(user_id, totals, generation)
+
+async def apply_invoice_update(query: dict, changes: dict) -> Optional[dict]:
+    """``$set`` changes on one invoice and keep the owner's rollup in step.
+
+    Returns the updated invoice, or None if nothing matched. Include
+    ``user_id`` in ``query`` when known; otherwise it is looked up first.
+    """
+    user_id = query.get("user_id")
+    if user_id is None:
+        owner = await invoices_collection.find_one(query, {"_id": 0, "user_id": 1})
+        if owner is None:
+            return None
+        user_id = owner["user_id"]
+    generation = await rollup_generation(user_id)
+
+    before = await invoices_collection.find_one_and_update(
+        query,
+        {"$set": changes},
+        projection={"_id": 0},
+        return_document=ReturnDocument.BEFORE
+    )
+    if before is None:
+        return None
+
+    after = {**before, **changes}
+    await record_invoice_change(before, after, generation)
+    return after
+
+def _expand(dotted: dict) -> dict:
+    nested = {}
+    for path, value in dotted.items():
+        target = nested
+        *parents, leaf = path.split(".")
+        for part in parents:
+            target = target.setdefault(part, {})
+        target[leaf] = value
+    return nested
+
+def _sum_contributions(invoices) -> dict:
+    totals = {}
+    for invoice in invoices:
+        for key, value in invoice_contribution(invoice).items():
+            totals[key] = totals.get(key, 0) + value
+    return totals
+
+async def compute_user_stats(user_id: str) -> dict:
+    """Recompute a rollup document from the user's invoices (streamed, not materialised)"""
+    totals = {}
+    cursor = invoices_collection.find({"user_id": user_id}, CONTRIBUTION_FIELDS)
+    async for invoice in cursor:
+        for key, value in invoice_contribution(invoice).items():
+            totals[key] = totals.get(key, 0) + value
+
+    stats = empty_user_stats(user_id)
+    stats.update(_expand(totals))
+    return stats
+
+async def rebuild_user_stats(user_id: str) -> dict:
+    """Recompute a user's rollup and store it unless another write got there first"""
+    for _ in range(REBUILD_ATTEMPTS):
+        current = await user_stats_collection.find_one({"user_id": user_id}, {"_id": 0, "version": 1})
+        stats = await compute_user_stats(user_id)
+        stats["generation"] = uuid.uuid4().hex
+        if current is None:
+            # Only if still missing: a writer's upsert in the meantime means try again
+            stats["version"] = 1
+            insert = {key: value for key, value in stats.items() if key != "user_id"}
+            try:
+                result = await user_stats_collection.update_one(
+                    {"user_id": user_id}, {"$setOnInsert": insert}, upsert=True
+                )
+            except DuplicateKeyError:
+                continue
+            if result.upserted_id is not None:
+                return stats
+        else:
+            version = current.get("version")
+            stats["version"] = (version or 0) + 1
+            result = await user_stats_collection.replace_one({"user_id": user_id, "version": version}, stats)
+            if result.matched_count:
+                return stats
+    logger.warning(f"Rollup for user {user_id} kept changing during rebuild; serving it unsaved")
+    return stats
+
+async def overdue_since_midnight(user_id: str, stats: dict, now: datetime) -> tuple:
+    """(count, amount) of sent/viewed invoices due earlier today.
+
+    Only today's due-day bucket can be partly overdue, so it alone needs the
+    invoices themselves; skipped when that bucket is empty.
+    """
+    if stats.get("pending_by_due", {}).get(due_day_key(now), {}).get("count", 0) <= 0:
+        return 0, 0.0
+    midnight = datetime.combine(now.astimezone(timezone.utc).date(), time.min, tzinfo=timezone.utc)
+    rows = await invoices_collection.aggregate([
+        {"$match": {"user_id": user_id, "status": {"$in": ["sent", "viewed"]}, **timestamp_range("due_date", midnight, now)}},
+        {"$group": {"_id": None, "count": {"$sum": 1}, "amount": {"$sum": "$total_amount"}}},
+    ]).to_list(1)
+    return (rows[0]["count"], rows[0]["amount"]) if rows else (0, 0.0)
+
+def stats_to_dashboard(stats: dict, now: datetime = None, overdue_today: tuple = (0, 0.0)) -> DashboardStats:
+    """Turn a rollup document into the DashboardStats response.
+
+    ``overdue_today`` is what ``overdue_since_midnight`` found in today's bucket.
+    """
+    now = now or datetime.now(timezone.utc)
+    today = due_day_key(now)
+
+    overdue_invoices = stats.get("overdue_invoices", 0) + overdue_today[0]
+    overdue_amount = stats.get("overdue_amount", 0.0) + overdue_today[1]
+    for due_key, bucket in stats.get("pending_by_due", {}).items():
+        if due_key < today:
+            overdue_invoices += bucket.get("count", 0)
+            overdue_amount += bucket.get("amount", 0.0)
+
+    payment_days_count = stats.get("payment_days_count", 0)
+    average_payment_time = stats.get("payment_days_sum", 0) / payment_days_count if payment_days_count else 0.0
+
+    return DashboardStats(
+        total_outstanding=round(stats.get("pending_amount", 0.0) + stats.get("overdue_amount", 0.0), 2),
+        paid_this_month=round(stats.get("paid_by_month", {}).get(now.strftime("%Y-%m"), 0.0), 2),
+        overdue_amount=round(overdue_amount, 2),
+        average_payment_time=round(average_payment_time, 1),
+        late_fee_collected=round(stats.get("late_fee_collected", 0.0), 2),
+        total_invoices=stats.get("total_invoices", 0),
+        paid_invoices=stats.get("paid_invoices", 0),
+        pending_invoices=stats.get("pending_invoices", 0),
+        overdue_invoices=overdue_invoices
+    )
+
+async def get_dashboard_from_rollup(user_id: str) -> DashboardStats:
+    """Dashboard from one rollup read, building it on first use or after a layout change.
+
+    The document holds one bucket per due day of open invoices, not one per
+    invoice; only when some are due today does the read also count those.
+    """
+    now = datetime.now(timezone.utc)
+    stats = await user_stats_collection.find_one({"user_id": user_id}, {"_id": 0})
+    if not stats or stats.get("schema") != USER_STATS_SCHEMA:
+        stats = await rebuild_user_stats(user_id)
+
+    # Drop due-date buckets emptied by payments so the document stays small
+    empty_buckets = {
+        f"pending_by_due.{due_key}": ""
+        for due_key, bucket in stats.get("pending_by_due", {}).items()
+        if bucket.get("count", 0) <= 0
+    }
+    if empty_buckets:
+        # Only if they are all still empty; a concurrent $inc wins and we retry next read
+        still_empty = {f"{path}.count": {"$lte": 0} for path in empty_buckets}
+        await user_stats_collection.update_one({"user_id": user_id, **still_empty}, {"$unset": empty_buckets})
+
+    return stats_to_dashboard(stats, now, await overdue_since_midnight(user_id, stats, now))
+
+async def verify_user_stats(user_id: str) -> dict:
+    """Compare the rollup-derived dashboard with a fresh aggregation; return drifted fields"""
+    now = datetime.now(timezone.utc)
+    stats = await user_stats_collection.find_one({"user_id": user_id}, {"_id": 0})
+    if not stats:
+        return {"missing": True}
+
+    from_rollup = stats_to_dashboard(stats, now, await overdue_since_midnight(user_id, stats, now)).model_dump()
+    expected = (await compute_dashboard_stats(user_id, now)).model_dump()
+    return {
+        field: {"rollup": from_rollup[field], "expected": expected[field]}
+        for field in expected
+        if abs(from_rollup[field] - expected[field]) > 0.01
+    }
+
+async def _user_ids(user_id: Optional[str]):
+    if user_id:
+        yield user_id
+        return
+    async for user in users_collection.find({}, {"_id": 0, "id": 1}):
+        yield user["id"]
+
+async def _main(argv):
+    parser = argparse.ArgumentParser(description="Rebuild or verify per-user dashboard rollups")
+    parser.add_argument("command", choices=["rebuild", "verify"])
+    parser.add_argument("--user", help="only this user id")
+    parser.add_argument("--fix", action="store_true", help="rebuild rollups that drifted (verify only)")
+    args = parser.parse_args(argv)
+
+    checked = drifted = 0
+    async for user_id in _user_ids(args.user):
+        checked += 1
+        if args.command == "rebuild":
+            await rebuild_user_stats(user_id)
+            continue
+
+        drift = await verify_user_stats(user_id)
+        if drift:
+            drifted += 1
+            print(f"{user_id}: {drift}")
+            if args.fix:
+                await rebuild_user_stats(user_id)
+
+    if args.command == "rebuild":
+        print(f"Rebuilt rollups for {checked} users")
+        return 0
+    print(f"{drifted} of {checked} rollups drifted" + (" (rebuilt)" if args.fix and drifted else ""))
+    return 1 if drifted and not args.fix else 0
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    sys.exit(asyncio.run(_main(sys.argv[1:])))
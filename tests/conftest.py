@@ -0,0 +1,10 @@
+import os
+import sys
+from pathlib import Path
+
+# Backend modules import each other as top-level packages (database, utils)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+# database.py reads these at import; no server is contacted until a query runs
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "clientnudge_test")
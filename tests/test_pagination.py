@@ -0,0 +1,88 @@
+import base64
+import json
+from datetime import datetime, timezone
+
+import pytest
+from fastapi import HTTPException
+
+from utils.pagination import _after_cursor, decode_cursor, encode_cursor
+
+
+def _raw_cursor(payload) -> str:
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip("=")
+
+
+def test_cursor_round_trip():
+    created_at = datetime(2026, 3, 9, 14, 30, 15, 123000, tzinfo=timezone.utc)
+    cursor = encode_cursor({"created_at": created_at, "id": "inv-1"})
+
+    assert "=" not in cursor
+    assert decode_cursor(cursor) == (created_at, "inv-1")
+
+
+def test_cursor_keeps_legacy_string_timestamps_verbatim():
+    cursor = encode_cursor({"created_at": "2026-03-09T14:30:00", "id": "inv-2"})
+
+    assert decode_cursor(cursor) == ("2026-03-09T14:30:00", "inv-2")
+
+
+def _bson_rank(value):
+    # MongoDB sorts strings before dates
+    return 0 if isinstance(value, str) else 1
+
+
+def _matches(doc, query):
+    """Evaluate the cursor query shapes with MongoDB's same-type comparisons"""
+    if "$and" in query:
+        return all(_matches(doc, part) for part in query["$and"])
+    if "$or" in query:
+        return any(_matches(doc, part) for part in query["$or"])
+    for field, condition in query.items():
+        value = doc.get(field)
+        if not isinstance(condition, dict):
+            if value != condition:
+                return False
+        elif "$type" in condition:
+            if not isinstance(value, datetime):
+                return False
+        elif "$gt" in condition:
+            bound = condition["$gt"]
+            if _bson_rank(value) != _bson_rank(bound) or not value > bound:
+                return False
+    return True
+
+
+def test_pages_cover_mixed_string_and_date_timestamps():
+    docs = [
+        {"id": "a", "created_at": "2026-01-01T00:00:00"},
+        {"id": "b", "created_at": "2026-01-02T00:00:00"},
+        {"id": "c", "created_at": "2026-01-02T00:00:00"},
+        {"id": "d", "created_at": datetime(2026, 1, 1, tzinfo=timezone.utc)},
+        {"id": "e", "created_at": datetime(2026, 1, 3, tzinfo=timezone.utc)},
+    ]
+    ordered = sorted(docs, key=lambda doc: (_bson_rank(doc["created_at"]), doc["created_at"], doc["id"]))
+
+    seen, cursor = [], None
+    while True:
+        page = [doc for doc in ordered if _matches(doc, _after_cursor({}, cursor))][:2]
+        if not page:
+            break
+        seen.extend(doc["id"] for doc in page)
+        cursor = encode_cursor(page[-1])
+
+    assert seen == ["a", "b", "c", "d", "e"]
+
+
+@pytest.mark.parametrize("cursor", [
+    "not base64!",
+    base64.urlsafe_b64encode(b"not json").decode(),
+    _raw_cursor({}),
+    _raw_cursor([1, 2]),
+    _raw_cursor({"c": 5, "i": "inv-1"}),
+    _raw_cursor({"c": "yesterday", "i": "inv-1"}),
+    _raw_cursor({"c": 5, "i": "inv-1", "s": True}),
+])
+def test_malformed_cursor_is_a_bad_request(cursor):
+    with pytest.raises(HTTPException) as excinfo:
+        decode_cursor(cursor)
+    assert excinfo.value.status_code == 400
@@ -0,0 +1,98 @@
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+
+from utils.pdf_cache import ItemsDigest, PdfCache, etag_matches, pdf_cache_key
+
+INVOICE = {
+    "invoice_number": "INV-0001",
+    "status": "sent",
+    "created_at": datetime(2026, 3, 1, tzinfo=timezone.utc),
+    "due_date": datetime(2026, 3, 31, tzinfo=timezone.utc),
+    "currency": "USD",
+    "total_amount": 150.0,
+}
+CLIENT = {"name": "Acme", "email": "billing@acme.test"}
+COMPANY = {"name": "Studio", "email": "hello@studio.test"}
+ITEMS = [
+    {"description": "Design", "quantity": 1, "rate": 100.0, "amount": 100.0},
+    {"description": "Hosting", "quantity": 1, "rate": 50.0, "amount": 50.0},
+]
+
+
+def _digest(items) -> str:
+    digest = ItemsDigest()
+    digest.update(items)
+    return digest.hexdigest()
+
+
+def test_key_is_stable_for_the_same_inputs():
+    first = pdf_cache_key(dict(INVOICE), _digest(ITEMS), dict(CLIENT), dict(COMPANY))
+    second = pdf_cache_key(dict(INVOICE), _digest(ITEMS), dict(CLIENT), dict(COMPANY))
+    assert first == second
+
+
+def test_key_ignores_fields_the_pdf_does_not_show():
+    changed = {**INVOICE, "next_reminder_at": datetime(2026, 3, 30, tzinfo=timezone.utc), "_id": "x"}
+    client = {**CLIENT, "notes": "pays late"}
+
+    assert pdf_cache_key(changed, _digest(ITEMS), client, COMPANY) == pdf_cache_key(INVOICE, _digest(ITEMS), CLIENT, COMPANY)
+
+
+@pytest.mark.parametrize("invoice, items, client, company, branding", [
+    ({**INVOICE, "status": "paid"}, ITEMS, CLIENT, COMPANY, None),
+    (INVOICE, ITEMS[:1], CLIENT, COMPANY, None),
+    (INVOICE, ITEMS[::-1], CLIENT, COMPANY, None),
+    (INVOICE, ITEMS, {**CLIENT, "phone": "555"}, COMPANY, None),
+    (INVOICE, ITEMS, CLIENT, {**COMPANY, "name": "Other"}, None),
+    (INVOICE, ITEMS, CLIENT, COMPANY, {"user_id": "u1", "version": "1"}),
+])
+def test_key_changes_with_anything_the_pdf_shows(invoice, items, client, company, branding):
+    base = pdf_cache_key(INVOICE, _digest(ITEMS), CLIENT, COMPANY)
+    assert pdf_cache_key(invoice, _digest(items), client, company, branding) != base
+
+
+def test_key_changes_with_branding_version():
+    v1 = pdf_cache_key(INVOICE, _digest(ITEMS), CLIENT, COMPANY, {"user_id": "u1", "version": "1"})
+    v2 = pdf_cache_key(INVOICE, _digest(ITEMS), CLIENT, COMPANY, {"user_id": "u1", "version": "2"})
+    assert v1 != v2
+
+
+def test_items_digest_is_the_same_across_batches():
+    whole = _digest(ITEMS)
+    batched = ItemsDigest()
+    for item in ITEMS:
+        batched.update([item])
+    assert batched.hexdigest() == whole
+
+
+@pytest.mark.parametrize("header, expected", [
+    (None, False),
+    ("", False),
+    ('"abc"', True),
+    ('W/"abc"', True),
+    ('"other", "abc"', True),
+    ('"other"', False),
+    ("*", True),
+    (' * ', True),
+    ('"abcd"', False),
+])
+def test_etag_matches(header, expected):
+    assert etag_matches(header, '"abc"') is expected
+
+
+def test_workers_sharing_the_directory_stay_under_the_limit(tmp_path):
+    # Two workers, each of which re-reads the directory on every lookup
+    workers = [PdfCache(tmp_path, max_bytes=250, rescan_seconds=0) for _ in range(2)]
+
+    async def render():
+        return b"%" * 100
+
+    async def run():
+        for number in range(6):
+            await workers[number % 2].get_or_render(f"pdf-{number}", render)
+
+    asyncio.run(run())
+    assert sum(path.stat().st_size for path in tmp_path.glob("*.pdf")) <= 250
+    assert sum(worker.evictions for worker in workers) > 0
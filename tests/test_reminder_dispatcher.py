@@ -0,0 +1,134 @@
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+
+import utils.scheduler as scheduler
+from utils.email_outbox import FakeEmailProvider
+from utils.scheduler import ReminderDispatcher
+
+NOW = datetime(2026, 3, 9, 14, 0, tzinfo=timezone.utc)
+USER = {"id": "user-1", "subscription_plan": "pro", "locale": "en"}
+
+
+class FakeReminders:
+    """The slice of the reminders collection the dispatcher writes to"""
+
+    def __init__(self):
+        self.docs = {}
+
+    async def insert_one(self, doc):
+        self.docs[doc["id"]] = dict(doc)
+        doc["_id"] = len(self.docs)
+
+    async def find_one(self, query, projection=None):
+        doc = self.docs.get(query["id"])
+        return dict(doc) if doc else None
+
+    async def delete_one(self, query):
+        self.docs.pop(query["id"], None)
+
+
+@pytest.fixture
+def reminders(monkeypatch):
+    collection = FakeReminders()
+    monkeypatch.setattr(scheduler, "reminders_collection", collection)
+    return collection
+
+
+def _job(number, email=None, reminder_type="firm"):
+    invoice = {"id": f"inv-{number}", "invoice_number": f"INV-{number:04d}", "user_id": USER["id"]}
+    client = {"name": f"Client {number}", "email": email or f"client{number}@example.test"}
+    return invoice, client, USER, reminder_type
+
+
+class Mailer:
+    """Send stub that delivers straight through a FakeEmailProvider.
+
+    Like the outbox it keeps the first reminder queued under an idempotency key.
+    """
+
+    def __init__(self, provider):
+        self.provider = provider
+        self.keys = []
+        self.queued = {}
+
+    async def __call__(self, invoice, client, user, reminder_type, message, reminder_id, idempotency_key=None):
+        self.keys.append(idempotency_key)
+        if idempotency_key in self.queued:
+            return self.queued[idempotency_key]
+        message = {"idempotency_key": idempotency_key, "params": {"to": [client["email"]], "text": message}}
+        [result] = await self.provider.send_batch([message])
+        if not result["ok"]:
+            return None
+        self.queued[idempotency_key] = reminder_id
+        return reminder_id
+
+
+async def _generate(invoice, client, reminder_type, user_plan, locale=None):
+    return f"{reminder_type} reminder for {invoice['invoice_number']}"
+
+
+def test_dispatch_saves_and_sends_every_reminder_in_job_order(reminders):
+    provider = FakeEmailProvider()
+    dispatcher = ReminderDispatcher(generate=_generate, send=Mailer(provider), concurrency=3)
+    jobs = [_job(number) for number in range(1, 8)]
+
+    results = asyncio.run(dispatcher.dispatch(jobs, NOW))
+
+    assert [doc["invoice_id"] for doc in results] == [f"inv-{number}" for number in range(1, 8)]
+    assert all("_id" not in doc and doc["email_status"] == "queued" for doc in results)
+    assert set(reminders.docs) == {doc["id"] for doc in results}
+    assert [params["text"] for params in provider.sent] == [f"firm reminder for INV-{number:04d}" for number in range(1, 8)]
+
+
+def test_failures_are_isolated_per_invoice(reminders):
+    provider = FakeEmailProvider(fail_addresses={"bounce@example.test"})
+
+    async def generate(invoice, client, reminder_type, user_plan, locale=None):
+        if invoice["id"] == "inv-2":
+            raise RuntimeError("llm down")
+        return await _generate(invoice, client, reminder_type, user_plan, locale)
+
+    dispatcher = ReminderDispatcher(generate=generate, send=Mailer(provider))
+    jobs = [_job(1), _job(2), _job(3, email="bounce@example.test"), _job(4)]
+
+    results = asyncio.run(dispatcher.dispatch(jobs, NOW))
+
+    assert [doc and doc["invoice_id"] for doc in results] == ["inv-1", None, None, "inv-4"]
+    # The rejected email's reminder record is removed again
+    assert {doc["invoice_id"] for doc in reminders.docs.values()} == {"inv-1", "inv-4"}
+    assert [params["to"] for params in provider.sent] == [["client1@example.test"], ["client4@example.test"]]
+
+
+def test_concurrency_is_bounded(reminders):
+    active = 0
+    peak = 0
+
+    async def generate(invoice, client, reminder_type, user_plan, locale=None):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0.001)
+        active -= 1
+        return "text"
+
+    dispatcher = ReminderDispatcher(generate=generate, send=Mailer(FakeEmailProvider()), concurrency=2)
+    asyncio.run(dispatcher.dispatch([_job(number) for number in range(1, 11)], NOW))
+
+    assert peak == 2
+
+
+def test_repeated_run_on_the_same_day_sends_once(reminders):
+    provider = FakeEmailProvider()
+    mailer = Mailer(provider)
+    dispatcher = ReminderDispatcher(generate=_generate, send=mailer)
+
+    [first] = asyncio.run(dispatcher.dispatch([_job(1)], NOW))
+    [again] = asyncio.run(dispatcher.dispatch([_job(1)], NOW.replace(hour=18)))
+
+    assert mailer.keys == ["auto-reminder:inv-1:firm:2026-03-09"] * 2
+    assert len(provider.sent) == 1
+    # Already queued counts as sent, under the reminder recorded the first time
+    assert again == first
+    assert list(reminders.docs) == [first["id"]]
@@ -0,0 +1,90 @@
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+import pytest
+
+from utils.reminder_schedule import SendWindow, next_reminder, send_slot, send_window
+
+DUE = datetime(2026, 3, 20, tzinfo=timezone.utc)
+DAY = timedelta(days=1)
+MS = timedelta(milliseconds=1)
+UTC_WINDOW = SendWindow(timezone.utc, 9, 17)
+
+
+def _invoice(**fields):
+    return {"id": "inv-1", "status": "sent", "auto_reminders": True, "due_date": DUE, **fields}
+
+
+def test_first_reminder_is_polite_three_days_before_due():
+    at, reminder_type = next_reminder(_invoice(), None, DUE - 10 * DAY)
+    assert (at, reminder_type) == (DUE - 4 * DAY + MS, "polite")
+
+
+def test_polite_is_skipped_once_a_reminder_went_out():
+    at, reminder_type = next_reminder(_invoice(), DUE - 5 * DAY, DUE - 10 * DAY)
+    assert (at, reminder_type) == (DUE - DAY + MS, "due_today")
+
+
+def test_firm_waits_a_day_after_the_last_reminder():
+    last_sent = DUE + timedelta(hours=12)
+    at, reminder_type = next_reminder(_invoice(), last_sent, DUE + timedelta(hours=2))
+    # The firm window closes before a day has passed, so the next rule applies
+    assert (at, reminder_type) == (DUE + 6 * DAY + MS, "final")
+
+    at, reminder_type = next_reminder(_invoice(), DUE - DAY, DUE + timedelta(hours=12))
+    assert (at, reminder_type) == (DUE + timedelta(hours=12), "firm")
+
+
+def test_final_repeats_every_three_days():
+    at, reminder_type = next_reminder(_invoice(), DUE + 8 * DAY, DUE + 9 * DAY)
+    assert (at, reminder_type) == (DUE + 11 * DAY, "final")
+
+
+@pytest.mark.parametrize("invoice", [
+    _invoice(status="paid"),
+    _invoice(status="draft"),
+    _invoice(auto_reminders=False),
+])
+def test_no_reminder_for_closed_or_opted_out_invoices(invoice):
+    assert next_reminder(invoice, None, DUE - 10 * DAY) == (None, None)
+
+
+def test_next_reminder_with_a_window_lands_on_the_send_slot():
+    at, reminder_type = next_reminder(_invoice(), None, DUE - 10 * DAY, UTC_WINDOW)
+    assert reminder_type == "polite"
+    assert at == send_slot(DUE - 4 * DAY + MS, UTC_WINDOW, "inv-1")
+    assert 9 <= at.hour < 17
+
+
+def test_send_slot_is_inside_the_window_and_not_before_at():
+    at = datetime(2026, 3, 9, 20, tzinfo=timezone.utc)
+    for invoice_id in ("inv-1", "inv-2", "inv-3", "a" * 36):
+        slot = send_slot(at, UTC_WINDOW, invoice_id)
+        assert slot >= at
+        assert slot - at < DAY
+        assert 9 <= slot.hour < 17
+
+
+def test_send_slot_is_the_same_local_time_every_day():
+    first = send_slot(datetime(2026, 3, 9, tzinfo=timezone.utc), UTC_WINDOW, "inv-1")
+    assert send_slot(first + MS, UTC_WINDOW, "inv-1") == first + DAY
+    assert send_slot(first, UTC_WINDOW, "inv-1") == first
+
+
+def test_send_slot_keeps_local_time_across_dst():
+    window = SendWindow(ZoneInfo("America/New_York"), 9, 17)
+    # US clocks go forward on 2026-03-08
+    before = send_slot(datetime(2026, 3, 7, 5, tzinfo=timezone.utc), window, "inv-1")
+    after = send_slot(datetime(2026, 3, 9, 5, tzinfo=timezone.utc), window, "inv-1")
+
+    local_before = before.astimezone(window.timezone)
+    local_after = after.astimezone(window.timezone)
+    assert (local_before.hour, local_before.minute) == (local_after.hour, local_after.minute)
+    assert after - before == 2 * DAY - timedelta(hours=1)
+
+
+def test_send_window_falls_back_for_unset_and_unknown_fields():
+    window = send_window({"timezone": "Not/AZone", "reminder_window_start": 0})
+    assert window.timezone == timezone.utc
+    assert window.start_hour == 0
+    assert window.end_hour == send_window(None).end_hour
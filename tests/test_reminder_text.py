@@ -0,0 +1,125 @@
+import asyncio
+from datetime import datetime, timezone
+
+from utils.rate_limit import TokenBucket
+from utils.reminder_text import (
+    REMINDER_TEMPLATE_RETRY_SECONDS, ReminderTextEngine, TTLCache, is_valid_template,
+)
+
+INVOICE = {
+    "user_id": "user-1",
+    "invoice_number": "INV-0007",
+    "total_amount": 250.0,
+    "currency": "USD",
+    "due_date": datetime(2026, 3, 20, tzinfo=timezone.utc),
+}
+CLIENT = {"name": "Acme"}
+GOOD_TEMPLATE = "Hello {client_name}, invoice {invoice_number} for ${amount} {currency} is due {due_date}."
+
+
+class StubLLM:
+    """Returns canned replies, optionally holding every call until released"""
+
+    def __init__(self, reply=GOOD_TEMPLATE, error: Exception = None):
+        self.reply = reply
+        self.error = error
+        self.prompts = []
+        self.release = None
+
+    async def __call__(self, prompt: str, session_id: str) -> str:
+        self.prompts.append(prompt)
+        if self.release is not None:
+            await self.release.wait()
+        if self.error:
+            raise self.error
+        return self.reply
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _engine(llm, clock=None):
+    cache = TTLCache(maxsize=100, ttl=60, clock=clock or FakeClock())
+    return ReminderTextEngine(llm=llm, cache=cache, limiter=TokenBucket(0))
+
+
+def test_free_plan_uses_the_fixed_template_without_the_llm():
+    llm = StubLLM()
+    text = asyncio.run(_engine(llm).render(INVOICE, CLIENT, "polite", "free"))
+
+    assert llm.prompts == []
+    assert text.startswith("Hi Acme,")
+    assert "INV-0007" in text and "$250.0 USD" in text
+
+
+def test_generated_template_is_cached_per_user_and_type():
+    llm = StubLLM()
+    engine = _engine(llm)
+
+    async def run():
+        first = await engine.render(INVOICE, CLIENT, "polite", "pro")
+        second = await engine.render({**INVOICE, "invoice_number": "INV-0008"}, CLIENT, "polite", "pro")
+        await engine.render({**INVOICE, "user_id": "user-2"}, CLIENT, "polite", "pro")
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first.startswith("Hello Acme, invoice INV-0007")
+    assert "INV-0008" in second
+    assert len(llm.prompts) == 2
+    assert engine.metrics()["hits"] == 1
+    assert engine.metrics()["misses"] == 2
+
+
+def test_concurrent_misses_share_one_llm_call():
+    llm = StubLLM()
+    engine = _engine(llm)
+
+    async def run():
+        llm.release = asyncio.Event()
+        renders = [asyncio.ensure_future(engine.render(INVOICE, CLIENT, "firm", "pro")) for _ in range(5)]
+        await asyncio.sleep(0)
+        llm.release.set()
+        return await asyncio.gather(*renders)
+
+    texts = asyncio.run(run())
+    assert len(llm.prompts) == 1
+    assert len(set(texts)) == 1
+    assert engine.metrics()["llm_calls"] == 1
+
+
+def test_invalid_template_falls_back_and_is_retried_later():
+    clock = FakeClock()
+    llm = StubLLM(reply="Pay {amount:.2f} for {secret}")
+    engine = _engine(llm, clock)
+
+    text = asyncio.run(engine.render(INVOICE, CLIENT, "final", "pro"))
+    assert text.startswith("URGENT: Dear Acme,")
+    assert engine.metrics()["llm_failures"] == 1
+
+    # The fallback is cached only briefly, then the LLM is asked again
+    llm.reply = GOOD_TEMPLATE
+    clock.now += REMINDER_TEMPLATE_RETRY_SECONDS
+    text = asyncio.run(engine.render(INVOICE, CLIENT, "final", "pro"))
+    assert text.startswith("Hello Acme")
+    assert len(llm.prompts) == 2
+
+
+def test_llm_error_falls_back_to_the_fixed_template():
+    engine = _engine(StubLLM(error=RuntimeError("provider down")))
+
+    text = asyncio.run(engine.render(INVOICE, CLIENT, "due_today", "pro"))
+    assert text.startswith("Hi Acme,\n\nJust a reminder that invoice INV-0007")
+    assert engine.metrics()["llm_failures"] == 1
+
+
+def test_template_validation():
+    assert is_valid_template(GOOD_TEMPLATE)
+    assert not is_valid_template("Invoice {invoice_number} is due")
+    assert not is_valid_template("Invoice {invoice_number} for {amount!r}")
+    assert not is_valid_template("Invoice {invoice_number} for {amount} {bank_account}")
+    assert not is_valid_template("Invoice {invoice_number} for {amount")
@@ -0,0 +1,157 @@
+import asyncio
+import copy
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+from pymongo import ReturnDocument
+
+import utils.user_stats as user_stats
+
+PAID_AT = datetime(2026, 3, 9, 12, tzinfo=timezone.utc)
+
+
+def _matches(doc, query):
+    # Equality only; None also matches a missing field, as in MongoDB
+    return all(doc.get(key) == value for key, value in query.items())
+
+
+def _project(doc, projection):
+    fields = [field for field, include in (projection or {}).items() if include and field != "_id"]
+    if not fields:
+        return copy.deepcopy(doc)
+    return {field: copy.deepcopy(doc[field]) for field in fields if field in doc}
+
+
+def _apply(doc, update, inserting=False):
+    for path, value in update.get("$inc", {}).items():
+        *parents, leaf = path.split(".")
+        target = doc
+        for part in parents:
+            target = target.setdefault(part, {})
+        target[leaf] = target.get(leaf, 0) + value
+    doc.update(update.get("$set", {}))
+    if inserting:
+        doc.update(update.get("$setOnInsert", {}))
+    for path in update.get("$unset", {}):
+        doc.pop(path, None)
+
+
+class FakeCollection:
+    """The slice of a Motor collection the rollup code uses, in memory"""
+
+    def __init__(self, docs=()):
+        self.docs = [dict(doc) for doc in docs]
+        self.after_update = None
+        self.during_find = None
+
+    def _first(self, query):
+        return next((doc for doc in self.docs if _matches(doc, query)), None)
+
+    def _upsert(self, query, update):
+        doc = {key: value for key, value in query.items()}
+        _apply(doc, update, inserting=True)
+        self.docs.append(doc)
+        return doc
+
+    async def find_one(self, query, projection=None):
+        doc = self._first(query)
+        return _project(doc, projection) if doc else None
+
+    async def find(self, query, projection=None):
+        for index, doc in enumerate([doc for doc in self.docs if _matches(doc, query)]):
+            if index == 1 and self.during_find:
+                hook, self.during_find = self.during_find, None
+                await hook()
+            yield _project(doc, projection)
+
+    async def update_one(self, query, update, upsert=False):
+        doc = self._first(query)
+        if doc is None:
+            if not upsert:
+                return SimpleNamespace(matched_count=0, upserted_id=None)
+            self._upsert(query, update)
+            return SimpleNamespace(matched_count=0, upserted_id=object())
+        _apply(doc, update)
+        return SimpleNamespace(matched_count=1, upserted_id=None)
+
+    async def replace_one(self, query, replacement):
+        doc = self._first(query)
+        if doc is None:
+            return SimpleNamespace(matched_count=0)
+        doc.clear()
+        doc.update(copy.deepcopy(replacement))
+        return SimpleNamespace(matched_count=1)
+
+    async def find_one_and_update(self, query, update, projection=None, upsert=False,
+                                  return_document=ReturnDocument.BEFORE):
+        doc = self._first(query)
+        before = copy.deepcopy(doc)
+        if doc is None:
+            if not upsert:
+                return None
+            doc = self._upsert(query, update)
+        else:
+            _apply(doc, update)
+        result = _project(doc if return_document == ReturnDocument.AFTER else before, projection)
+        if self.after_update:
+            hook, self.after_update = self.after_update, None
+            await hook()
+        return result
+
+
+@pytest.fixture
+def collections(monkeypatch):
+    invoices = FakeCollection([
+        {"id": f"inv-{number}", "user_id": "user-1", "status": "draft", "total_amount": 100.0}
+        for number in range(1, 4)
+    ])
+    stats = FakeCollection()
+    monkeypatch.setattr(user_stats, "invoices_collection", invoices)
+    monkeypatch.setattr(user_stats, "user_stats_collection", stats)
+    asyncio.run(user_stats.rebuild_user_stats("user-1"))
+    return invoices, stats
+
+
+def _mark_paid():
+    return user_stats.apply_invoice_update(
+        {"id": "inv-1", "user_id": "user-1"}, {"status": "paid", "paid_at": PAID_AT}
+    )
+
+
+def _rollup(stats):
+    return stats.docs[0]
+
+
+def test_write_updates_the_rollup_in_place(collections):
+    _, stats = collections
+    asyncio.run(_mark_paid())
+
+    rollup = _rollup(stats)
+    assert rollup["paid_invoices"] == 1
+    assert rollup["schema"] == user_stats.USER_STATS_SCHEMA
+
+
+def test_rebuild_between_invoice_write_and_inc_is_not_double_counted(collections):
+    invoices, stats = collections
+    # The rebuild sees the paid invoice, then the writer's $inc lands on top
+    invoices.after_update = lambda: user_stats.rebuild_user_stats("user-1")
+
+    asyncio.run(_mark_paid())
+
+    assert "schema" not in _rollup(stats)
+    dashboard = asyncio.run(user_stats.get_dashboard_from_rollup("user-1"))
+    assert dashboard.paid_invoices == 1
+    assert dashboard.total_invoices == 3
+    assert _rollup(stats)["paid_invoices"] == 1
+
+
+def test_write_during_rebuild_aggregation_restarts_the_rebuild(collections):
+    invoices, stats = collections
+    invoices.during_find = _mark_paid
+
+    rebuilt = asyncio.run(user_stats.rebuild_user_stats("user-1"))
+
+    assert rebuilt["paid_invoices"] == 1
+    assert _rollup(stats)["paid_invoices"] == 1
+    assert _rollup(stats)["schema"] == user_stats.USER_STATS_SCHEMA